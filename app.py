@@ -1,20 +1,181 @@
-from flask import Flask, render_template, request, jsonify, Response
+import click
+from flask import Flask, render_template, request, jsonify, abort, g, send_file, Response, stream_with_context
 import pg8000
 import re
+import bisect
+import secrets
 import os
-import base64
+import sys
+import hashlib
+import io
+import json
+import math
+import sqlite3
+import tempfile
+import time
+import threading
+import uuid
+import weakref
+import zipfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
 from datetime import datetime
+from functools import wraps
+from types import MappingProxyType
 import urllib.parse as urlparse
 
 # ========== NUEVO (XHTML2PDF) ==========
 from xhtml2pdf import pisa
+from xhtml2pdf import document as pisa_document
+from xhtml2pdf.context import pisaContext, pisaCSSBuilder, pisaCSSParser
+from xhtml2pdf.w3c import css as pisa_css
 from io import BytesIO
+from pypdf import PdfReader, PdfWriter
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from markupsafe import escape
 
 app = Flask(__name__)
+# Firma las cookies y los enlaces de descarga; con varios workers/nodos
+# debe venir de SECRET_KEY para que todos acepten los mismos tokens.
+app.secret_key = os.environ.get("SECRET_KEY") or secrets.token_hex(32)
+
+def exigir_secret_key(workers):
+    """Al arrancar: sin SECRET_KEY cada worker firmaría con su propia clave."""
+    if workers > 1 and not os.environ.get("SECRET_KEY"):
+        raise RuntimeError(
+            f"SECRET_KEY es obligatorio con {workers} workers: sin ella los enlaces "
+            "de descarga firmados por un worker dan 404 en los demás."
+        )
+
+# ============================================================
+#  MÉTRICAS (formato de texto de Prometheus)
+# ============================================================
+# Histogramas en memoria, sin dependencias: observar() es un bisect y una
+# suma bajo un lock, así que se pueden dejar activos en producción.
+# Cada proceso (worker de gunicorn/uvicorn) lleva sus propios contadores;
+# /metrics expone los del worker que atiende el scrape.
+METRICAS_LIMITES = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _etiqueta(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _etiquetas(nombres, valores, extra=""):
+    pares = [f'{n}="{_etiqueta(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+class Histograma:
+    """Histograma acumulado por combinación de etiquetas (tupla de valores)."""
+
+    def __init__(self, nombre, ayuda, etiquetas, limites=METRICAS_LIMITES):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.limites = tuple(limites)
+        self._series = {}   # valores -> [conteo por cubeta..., +Inf, suma]
+        self._lock = threading.Lock()
+
+    def observar(self, segundos, *valores):
+        i = bisect.bisect_left(self.limites, segundos)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = [0] * (len(self.limites) + 1) + [0.0]
+            serie[i] += 1
+            serie[-1] += segundos
+
+    @contextmanager
+    def medir(self, *valores):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, *valores)
+
+    def exponer(self):
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        for valores, serie in sorted(series.items()):
+            acumulado = 0
+            for limite, n in zip(self.limites + ("+Inf",), serie):
+                acumulado += n
+                le = f'le="{limite}"'
+                lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas, valores, le)} {acumulado}")
+            base = _etiquetas(self.etiquetas, valores)
+            lineas.append(f"{self.nombre}_sum{base} {serie[-1]:.6f}")
+            lineas.append(f"{self.nombre}_count{base} {acumulado}")
+        return lineas
+
+
+def exponer_valores(nombre, tipo, ayuda, etiqueta, valores):
+    """Gauge/counter calculado al momento del scrape: valores = {etiqueta: número}."""
+    lineas = [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} {tipo}"]
+    for clave, valor in valores.items():
+        sufijo = _etiquetas((etiqueta,), (clave,)) if etiqueta else ""
+        lineas.append(f"{nombre}{sufijo} {valor}")
+    return lineas
+
+
+METRICA_REQUEST = Histograma(
+    "ferreydoc_request_segundos", "Duración de cada request HTTP.", ("ruta", "metodo", "codigo")
+)
+METRICA_FASE = Histograma(
+    "ferreydoc_fase_segundos", "Duración de cada fase interna (conexión, consultas, render, PDF).", ("fase",)
+)
+METRICA_ESTADO = Histograma(
+    "ferreydoc_estado_segundos", "Tiempo del motor de diálogo por estado de la sesión.", ("estado",)
+)
+
+def medir_fase(fase):
+    """Decorador: registra la duración de la función en ferreydoc_fase_segundos."""
+    def decorar(funcion):
+        @wraps(funcion)
+        def medida(*args, **kwargs):
+            with METRICA_FASE.medir(fase):
+                return funcion(*args, **kwargs)
+        return medida
+    return decorar
+
+def medir_future(future, fase):
+    """
+    Mide desde ahora hasta que el future termina (trabajo en otro proceso).
+    Se cronometra en el padre, así que incluye la espera en la cola del pool.
+    """
+    inicio = time.perf_counter()
+    future.add_done_callback(lambda f: METRICA_FASE.observar(time.perf_counter() - inicio, fase))
+    return future
+
+@app.before_request
+def _iniciar_cronometro():
+    g.inicio_request = time.perf_counter()
+
+# Las etiquetas de ferreydoc_request_segundos salen de un conjunto fijo:
+# un cliente no puede crear series nuevas con métodos inventados o URLs
+# que no existen.
+METODOS_METRICA = frozenset(("GET", "POST", "HEAD", "OPTIONS", "PUT", "DELETE", "PATCH"))
+
+@app.after_request
+def _registrar_request(response):
+    inicio = g.pop("inicio_request", None)
+    if inicio is not None:
+        metodo = request.method if request.method in METODOS_METRICA else "otro"
+        if request.url_rule is not None:
+            ruta, codigo = request.url_rule.rule, response.status_code
+        else:
+            ruta, codigo = "(sin ruta)", f"{response.status_code // 100}xx"
+        METRICA_REQUEST.observar(time.perf_counter() - inicio, ruta, metodo, codigo)
+    return response
 
 # ============================================================
 #  CONEXIÓN A POSTGRES (pg8000)
 # ============================================================
+@medir_fase("get_conn")
 def get_conn():
     db_url = os.environ.get("DATABASE_URL")
     if not db_url:
@@ -31,549 +192,1980 @@ def get_conn():
         ssl_context=True
     )
 
+# ============================================================
+#  POOL DE CONEXIONES
+# ============================================================
+class _ConexionPool:
+    """Conexión abierta por get_conn() más sus marcas de tiempo."""
+    __slots__ = ("conn", "creada", "ultimo_uso")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.creada = time.monotonic()
+        self.ultimo_uso = self.creada
+
+
+class PoolConexiones:
+    """
+    Pool acotado y thread-safe de conexiones pg8000.
+
+    - Como máximo `max_conexiones` abiertas a la vez; si están todas
+      prestadas se espera hasta `timeout` segundos.
+    - Las conexiones ociosas más de `max_ocio` segundos se cierran.
+    - Si una conexión lleva más de `chequeo_tras` segundos sin usarse se
+      comprueba con SELECT 1 antes de prestarla (y se reabre si falló).
+    - Cada proceso (worker de gunicorn) tiene sus propias conexiones:
+      tras un fork las heredadas se descartan sin tocarlas.
+    """
+
+    def __init__(self, fabrica, max_conexiones=5, max_ocio=300.0,
+                 chequeo_tras=30.0, timeout=10.0):
+        self._fabrica = fabrica
+        self.max_conexiones = max_conexiones
+        self.max_ocio = max_ocio
+        self.chequeo_tras = chequeo_tras
+        self.timeout = timeout
+
+        self._cond = threading.Condition(threading.Lock())
+        self._libres = deque()
+        self._abiertas = 0
+        self._pid = os.getpid()
+
+        self._stats = {
+            "creadas": 0,
+            "reutilizadas": 0,
+            "cerradas_por_ocio": 0,
+            "descartadas_rotas": 0,
+            "esperas": 0,
+            "timeouts": 0,
+        }
+
+    # ---------- helpers internos (con el lock tomado) ----------
+    def _revisar_fork(self):
+        if self._pid != os.getpid():
+            # Los sockets pertenecen al proceso padre: no se cierran aquí
+            self._libres.clear()
+            self._abiertas = 0
+            self._pid = os.getpid()
+
+    def _expulsar_ociosas(self, ahora):
+        vencidas = []
+        while self._libres and ahora - self._libres[0].ultimo_uso > self.max_ocio:
+            vencidas.append(self._libres.popleft())
+        self._abiertas -= len(vencidas)
+        self._stats["cerradas_por_ocio"] += len(vencidas)
+        return vencidas
+
+    # ---------- helpers sin lock ----------
+    @staticmethod
+    def _cerrar(item):
+        try:
+            item.conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _esta_sana(item):
+        try:
+            cur = item.conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+            cur.close()
+            item.conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _liberar_cupo(self):
+        with self._cond:
+            self._abiertas -= 1
+            self._cond.notify()
+
+    # ---------- API ----------
+    def obtener(self):
+        limite = time.monotonic() + self.timeout
+        with self._cond:
+            self._revisar_fork()
+            vencidas = self._expulsar_ociosas(time.monotonic())
+            while True:
+                if self._libres:
+                    # LIFO: la más recién usada es la que probablemente sigue viva
+                    item = self._libres.pop()
+                    break
+                if self._abiertas < self.max_conexiones:
+                    self._abiertas += 1
+                    item = None
+                    break
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    self._stats["timeouts"] += 1
+                    raise RuntimeError("No hay conexiones libres en el pool de Postgres.")
+                self._stats["esperas"] += 1
+                self._cond.wait(restante)
+
+        for v in vencidas:
+            self._cerrar(v)
+
+        if item is not None:
+            if time.monotonic() - item.ultimo_uso <= self.chequeo_tras or self._esta_sana(item):
+                with self._cond:
+                    self._stats["reutilizadas"] += 1
+                return item
+            self._cerrar(item)
+            with self._cond:
+                self._stats["descartadas_rotas"] += 1
+
+        # Conexión nueva (el cupo ya está reservado)
+        try:
+            item = _ConexionPool(self._fabrica())
+        except Exception:
+            self._liberar_cupo()
+            raise
+        with self._cond:
+            self._stats["creadas"] += 1
+        return item
+
+    def devolver(self, item, rota=False):
+        if not rota:
+            try:
+                # Cerrar la transacción implícita que abre pg8000
+                item.conn.rollback()
+            except Exception:
+                rota = True
+
+        if rota:
+            self._cerrar(item)
+            with self._cond:
+                if self._pid == os.getpid():
+                    self._abiertas -= 1
+                self._stats["descartadas_rotas"] += 1
+                self._cond.notify()
+            return
+
+        item.ultimo_uso = time.monotonic()
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._libres.append(item)
+            self._cond.notify()
+
+    @contextmanager
+    def conexion(self):
+        item = self.obtener()
+        try:
+            yield item.conn
+        except (pg8000.InterfaceError, OSError):
+            # Conexión caída a mitad de la consulta: no vuelve al pool
+            self.devolver(item, rota=True)
+            raise
+        except BaseException:
+            self.devolver(item)
+            raise
+        else:
+            self.devolver(item)
+
+    def cerrar_todas(self):
+        with self._cond:
+            libres = list(self._libres)
+            self._libres.clear()
+            self._abiertas -= len(libres)
+        for item in libres:
+            self._cerrar(item)
+
+    def estadisticas(self):
+        with self._cond:
+            self._revisar_fork()
+            return {
+                "pid": self._pid,
+                "max_conexiones": self.max_conexiones,
+                "abiertas": self._abiertas,
+                "libres": len(self._libres),
+                "en_uso": self._abiertas - len(self._libres),
+                **self._stats,
+            }
+
+
+pool = PoolConexiones(
+    get_conn,
+    max_conexiones=int(os.environ.get("DB_POOL_MAX", "5")),
+    max_ocio=float(os.environ.get("DB_POOL_MAX_OCIO", "300")),
+    chequeo_tras=float(os.environ.get("DB_POOL_CHEQUEO", "30")),
+    timeout=float(os.environ.get("DB_POOL_TIMEOUT", "10")),
+)
+
+@medir_fase("query")
+def ejecutar_consulta(sql, params=()):
+    """
+    Ejecuta un SELECT con una conexión del pool y devuelve filas como dicts.
+    Si la conexión estaba caída se reintenta una vez con una conexión nueva.
+    """
+    for intento in range(2):
+        try:
+            with pool.conexion() as conn:
+                cur = conn.cursor()
+                cur.execute(sql, params)
+                cols = [c[0] for c in cur.description]
+                rows = [dict(zip(cols, r)) for r in cur.fetchall()]
+                cur.close()
+            return rows
+        except (pg8000.InterfaceError, OSError):
+            if intento:
+                raise
+
+def ejecutar_comando(sql, params=()):
+    """
+    Ejecuta un INSERT/UPDATE/DELETE con una conexión del pool, hace commit
+    y devuelve las filas afectadas.
+    """
+    with pool.conexion() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        n = cur.rowcount
+        cur.close()
+        conn.commit()
+    return n
+
+# ============================================================
+#  ADMINISTRACIÓN
+# ============================================================
+def requerir_admin():
+    """Los endpoints /admin/* exigen la cabecera X-Admin-Token = ADMIN_TOKEN."""
+    token = os.environ.get("ADMIN_TOKEN")
+    if not token or request.headers.get("X-Admin-Token") != token:
+        abort(403)
+
+# ============================================================
+#  TAREAS EN SEGUNDO PLANO
+# ============================================================
+class TareaPeriodica:
+    """
+    Hilo daemon que ejecuta `funcion` cada `intervalo` segundos.
+    Los hilos no sobreviven a un fork, así que asegurar() lo (re)lanza
+    en el proceso actual si aún no está corriendo ahí.
+    """
+
+    def __init__(self, nombre, intervalo, funcion):
+        self.nombre = nombre
+        self.intervalo = intervalo
+        self.funcion = funcion
+        self._hilo = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _bucle(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                self.funcion()
+            except Exception:
+                app.logger.exception("Falló la tarea periódica %s", self.nombre)
+
+    def asegurar(self):
+        if self._pid == os.getpid() and self._hilo is not None:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._hilo is not None:
+                return
+            self._hilo = threading.Thread(target=self._bucle, name=self.nombre, daemon=True)
+            self._hilo.start()
+            self._pid = os.getpid()
+
+
+tareas_periodicas = []
+
+def tarea_periodica(nombre, intervalo):
+    """Decorador: registra `funcion` para correr cada `intervalo` segundos."""
+    def registrar(funcion):
+        tareas_periodicas.append(TareaPeriodica(nombre, intervalo, funcion))
+        return funcion
+    return registrar
+
+@app.before_request
+def _arrancar_tareas_periodicas():
+    for tarea in tareas_periodicas:
+        tarea.asegurar()
+
 # ============================================================
 #  SESIONES
 # ============================================================
-sesiones = {}
+SESIONES_TTL = float(os.environ.get("SESIONES_TTL", "7200"))        # inactividad máx.
+SESIONES_MAX = int(os.environ.get("SESIONES_MAX", "10000"))         # tope duro
+SESIONES_BARRIDO = float(os.environ.get("SESIONES_BARRIDO", "60"))  # cada cuánto se purga
+
+@dataclass(slots=True)
+class Sesion:
+    estado: str = "inicio"
+    model: str = None
+    serial3: str = None
+    mant_maquina: str = None
+    mant_intervalo: str = None
+    mant_intervalos_lista: list = field(default_factory=list)
+    reporte_codigos: list = field(default_factory=list)
+    reporte_eventos: list = field(default_factory=list)
+
+_SESION_VACIA = asdict(Sesion())
+
+def serializar_sesion(ses):
+    """JSON compacto: sólo se guardan los campos distintos del valor inicial."""
+    datos = {k: v for k, v in asdict(ses).items() if _SESION_VACIA[k] != v}
+    return json.dumps(datos, separators=(",", ":"), ensure_ascii=False)
+
+def deserializar_sesion(texto):
+    datos = json.loads(texto)
+    return Sesion(**{k: v for k, v in datos.items() if k in _SESION_VACIA})
+
+
+class BackendSesiones(ABC):
+    """Interfaz de almacenamiento de sesiones del chat."""
+
+    @abstractmethod
+    def cargar(self, user_id):
+        """Devuelve la sesión guardada (si no expiró) o None."""
+
+    @abstractmethod
+    def guardar(self, user_id, ses):
+        ...
+
+    @abstractmethod
+    def borrar(self, user_id):
+        ...
+
+    @abstractmethod
+    def contar(self):
+        ...
+
+    @abstractmethod
+    def purgar(self):
+        """Elimina sesiones inactivas y las que exceden el tope; devuelve cuántas."""
+
+
+class BackendMemoria(BackendSesiones):
+    """LRU en el proceso: sólo sirve con un único worker."""
+
+    def __init__(self, ttl=SESIONES_TTL, max_sesiones=SESIONES_MAX):
+        self.ttl = ttl
+        self.max_sesiones = max_sesiones
+        self._datos = OrderedDict()   # user_id -> (ultimo_acceso, Sesion)
+        self._lock = threading.Lock()
+        self.expiradas = 0
+        self.desalojadas = 0
+
+    def cargar(self, user_id):
+        with self._lock:
+            entrada = self._datos.get(user_id)
+            if entrada is None:
+                return None
+            if time.monotonic() - entrada[0] > self.ttl:
+                del self._datos[user_id]
+                self.expiradas += 1
+                return None
+            return entrada[1]
+
+    def guardar(self, user_id, ses):
+        with self._lock:
+            self._datos[user_id] = (time.monotonic(), ses)
+            self._datos.move_to_end(user_id)
+            while len(self._datos) > self.max_sesiones:
+                self._datos.popitem(last=False)
+                self.desalojadas += 1
+
+    def borrar(self, user_id):
+        with self._lock:
+            self._datos.pop(user_id, None)
+
+    def contar(self):
+        return len(self._datos)
+
+    def purgar(self):
+        limite = time.monotonic() - self.ttl
+        n = 0
+        with self._lock:
+            # Orden LRU: las más antiguas están al principio
+            while self._datos:
+                user_id, (ultimo_acceso, _) = next(iter(self._datos.items()))
+                if ultimo_acceso > limite:
+                    break
+                del self._datos[user_id]
+                n += 1
+            self.expiradas += n
+        return n
+
+
+class BackendSQLite(BackendSesiones):
+    """Archivo SQLite compartido por todos los workers de la misma máquina."""
+
+    def __init__(self, ruta, ttl=SESIONES_TTL, max_sesiones=SESIONES_MAX):
+        self.ruta = ruta
+        self.ttl = ttl
+        self.max_sesiones = max_sesiones
+        self._local = threading.local()
+        with self._conexion() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sesiones ("
+                " id TEXT PRIMARY KEY,"
+                " datos TEXT NOT NULL,"
+                " actualizado REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_sesiones_actualizado ON sesiones (actualizado)"
+            )
+
+    def _conexion(self):
+        # Una conexión por hilo y por proceso (no se comparten tras un fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.ruta, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def cargar(self, user_id):
+        fila = self._conexion().execute(
+            "SELECT datos FROM sesiones WHERE id = ? AND actualizado > ?",
+            (user_id, time.time() - self.ttl)
+        ).fetchone()
+        return deserializar_sesion(fila[0]) if fila else None
+
+    def guardar(self, user_id, ses):
+        with self._conexion() as conn:
+            conn.execute(
+                "INSERT INTO sesiones (id, datos, actualizado) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET datos = excluded.datos, actualizado = excluded.actualizado",
+                (user_id, serializar_sesion(ses), time.time())
+            )
+
+    def borrar(self, user_id):
+        with self._conexion() as conn:
+            conn.execute("DELETE FROM sesiones WHERE id = ?", (user_id,))
+
+    def contar(self):
+        return self._conexion().execute("SELECT COUNT(*) FROM sesiones").fetchone()[0]
+
+    def purgar(self):
+        with self._conexion() as conn:
+            n = conn.execute(
+                "DELETE FROM sesiones WHERE actualizado <= ?", (time.time() - self.ttl,)
+            ).rowcount
+            n += conn.execute(
+                "DELETE FROM sesiones WHERE id IN ("
+                " SELECT id FROM sesiones ORDER BY actualizado DESC LIMIT -1 OFFSET ?)",
+                (self.max_sesiones,)
+            ).rowcount
+        return n
+
+
+class BackendPostgres(BackendSesiones):
+    """Tabla chat_sesiones (migrations/002 y 003): compartida entre nodos."""
+
+    def __init__(self, ttl=SESIONES_TTL, max_sesiones=SESIONES_MAX):
+        self.ttl = ttl
+        self.max_sesiones = max_sesiones
+
+    def cargar(self, user_id):
+        filas = ejecutar_consulta(
+            "SELECT datos FROM chat_sesiones "
+            "WHERE id = %s AND actualizado_en > now() - make_interval(secs => %s)",
+            (user_id, self.ttl)
+        )
+        return deserializar_sesion(filas[0]["datos"]) if filas else None
+
+    def guardar(self, user_id, ses):
+        ejecutar_comando(
+            "INSERT INTO chat_sesiones (id, datos, actualizado_en) VALUES (%s, %s, now()) "
+            "ON CONFLICT (id) DO UPDATE SET datos = EXCLUDED.datos, actualizado_en = now()",
+            (user_id, serializar_sesion(ses))
+        )
+
+    def borrar(self, user_id):
+        ejecutar_comando("DELETE FROM chat_sesiones WHERE id = %s", (user_id,))
+
+    def contar(self):
+        return ejecutar_consulta("SELECT COUNT(*) AS n FROM chat_sesiones")[0]["n"]
+
+    def purgar(self):
+        expiradas = ejecutar_comando(
+            "DELETE FROM chat_sesiones "
+            "WHERE actualizado_en <= now() - make_interval(secs => %s)",
+            (self.ttl,)
+        )
+        sobrantes = ejecutar_comando(
+            "DELETE FROM chat_sesiones WHERE id IN ("
+            " SELECT id FROM chat_sesiones ORDER BY actualizado_en DESC OFFSET %s)",
+            (self.max_sesiones,)
+        )
+        return max(expiradas, 0) + max(sobrantes, 0)
+
+
+def _crear_backend_sesiones():
+    tipo = os.environ.get("SESIONES_BACKEND", "memoria")
+    if tipo == "memoria":
+        return BackendMemoria()
+    if tipo == "sqlite":
+        ruta = os.environ.get(
+            "SESIONES_SQLITE_PATH",
+            os.path.join(tempfile.gettempdir(), "ferreydoc_sesiones.db")
+        )
+        return BackendSQLite(ruta)
+    if tipo == "postgres":
+        return BackendPostgres()
+    raise RuntimeError(f"SESIONES_BACKEND desconocido: {tipo}")
+
+sesiones = _crear_backend_sesiones()
+
+@tarea_periodica("barrido-sesiones", SESIONES_BARRIDO)
+def _purgar_sesiones():
+    sesiones.purgar()
 
 def obtener_sesion(user_id):
-    if user_id not in sesiones:
-        sesiones[user_id] = {
-            "estado": "inicio",
-            "model": None,
-            "serial3": None,
-            "mant_maquina": None,
-            "mant_intervalo": None,
-            "mant_intervalos_lista": [],
-            "reporte_codigos": [],
-            "reporte_eventos": []
-        }
-    return sesiones[user_id]
+    # Dentro de un request la sesión se carga una vez y se guarda al final
+    abiertas = g.setdefault("sesiones_abiertas", {})
+    if user_id not in abiertas:
+        abiertas[user_id] = sesiones.cargar(user_id) or Sesion()
+    return abiertas[user_id]
 
 def resetear_sesion(user_id):
-    if user_id in sesiones:
-        del sesiones[user_id]
+    g.setdefault("sesiones_abiertas", {}).pop(user_id, None)
+    sesiones.borrar(user_id)
+
+def guardar_sesiones_abiertas():
+    for user_id, ses in g.pop("sesiones_abiertas", {}).items():
+        sesiones.guardar(user_id, ses)
 
 # ============================================================
-#  PARSEO DE CÓDIGOS
+#  IDENTIFICACIÓN DEL CLIENTE
 # ============================================================
-def extraer_codigo(texto: str):
-    t = texto.upper().replace("-", " ").replace(".", " ")
-    nums = re.findall(r"\d+", t)
+SESION_COOKIE = "ferreydoc_sid"
+SESION_HEADER = "X-Session-Id"
+_SID_VALIDO = re.compile(r"[A-Za-z0-9_-]{16,128}")
+
+def id_sesion_cliente():
+    """
+    ID de sesión del técnico: cabecera X-Session-Id (clientes API) o cookie.
+    Si no trae uno válido se genera y se envía en la cookie de la respuesta.
+    Se resuelve una sola vez por request: llamadas posteriores (p. ej. la
+    huella del dueño de un reporte) reciben el mismo id.
+    """
+    if "sid" in g:
+        return g.sid
+    sid = request.headers.get(SESION_HEADER) or request.cookies.get(SESION_COOKIE)
+    if not (sid and _SID_VALIDO.fullmatch(sid)):
+        sid = secrets.token_urlsafe(24)
+        g.sid_nuevo = sid
+    g.sid = sid
+    return sid
+
+@app.after_request
+def _enviar_cookie_sesion(response):
+    sid = g.pop("sid_nuevo", None)
+    if sid:
+        response.set_cookie(
+            SESION_COOKIE, sid,
+            max_age=30 * 24 * 3600, httponly=True, samesite="Lax",
+            secure=request.is_secure
+        )
+    return response
+
+_bloqueos_sesion = weakref.WeakValueDictionary()
+_bloqueos_lock = threading.Lock()
+
+def bloqueo_sesion(user_id):
+    """
+    Lock propio de cada sesión: dos requests del mismo técnico se
+    serializan, pero técnicos distintos nunca se esperan entre sí.
+    """
+    with _bloqueos_lock:
+        lock = _bloqueos_sesion.get(user_id)
+        if lock is None:
+            lock = threading.Lock()
+            _bloqueos_sesion[user_id] = lock
+        return lock
 
+# ============================================================
+#  PARSEO DE CÓDIGOS Y EVENTOS
+# ============================================================
+# Un solo patrón compilado recorre el mensaje completo y clasifica cada
+# fragmento separado por comas:
+#   código  CID-FMI con MID opcional: "168-4", "168.4", "27 168 4",
+#           "MID 27 CID 168 FMI 4", "CID168 FMI:4"
+#   evento  E####(L) con L = 1, 2 o 3: "E0117(2)", "e0117 (2)"
+# Si un fragmento no encaja en ninguno se aplica la regla original del bot:
+# con 2 o más números es un código formado por los últimos ("código 168-4"
+# -> 168-4, "1-2-3-4" -> MID 2 CID 3 FMI 4), salvo que parezca un evento.
+# Si no, queda como inválido con su texto original. Los fragmentos vacíos
+# ("168-4,,110-3,") se omiten en vez de responder "No pude interpretar".
+_SEP = r"[\s./\-]+"
+_PALABRA = r"\s*[:=]?\s*"
+_CODIGO = (
+    rf"(?:(?:MID{_PALABRA})?(?P<mid>\d+)(?:{_SEP}(?:CID{_PALABRA})?|CID{_PALABRA}))?"
+    rf"(?:CID{_PALABRA})?(?P<cid>\d+)"
+    rf"(?:{_SEP}(?:FMI{_PALABRA})?|FMI{_PALABRA})(?P<fmi>\d+)"
+)
+_EVENTO = r"E(?P<eid>\d+)\s*\(\s*(?P<level>[123])\s*\)"
+
+_RE_FRAGMENTO = re.compile(
+    rf"(?:^|,)\s*(?P<raw>{_EVENTO}|{_CODIGO}|[^,]*?)\s*(?=,|$)",
+    re.IGNORECASE,
+)
+_RE_CODIGO = re.compile(rf"\s*{_CODIGO}\s*", re.IGNORECASE)
+_RE_EVENTO = re.compile(rf"\s*{_EVENTO}\s*", re.IGNORECASE)
+_RE_NUMEROS = re.compile(r"\d+")
+_RE_PARECE_EVENTO = re.compile(r"E\s*\d", re.IGNORECASE)
+
+# tipo: "codigo" | "evento" | "invalido". Tupla liviana: se crea una por
+# fragmento en cada mensaje.
+Fragmento = namedtuple(
+    "Fragmento", "tipo raw mid cid fmi eid level", defaults=(None,) * 5
+)
+
+
+def _codigo_flexible(texto):
+    """Regla original: los 2 o 3 últimos números -> (mid, cid, fmi), o None."""
+    if _RE_PARECE_EVENTO.search(texto):
+        return None
+    nums = _RE_NUMEROS.findall(texto)
     if len(nums) >= 3:
         return nums[-3], nums[-2], nums[-1]
-
     if len(nums) == 2:
         return None, nums[0], nums[1]
+    return None
+
+
+def tokenizar(texto: str):
+    """Parte el mensaje en Fragmentos en una sola pasada (vacíos se omiten)."""
+    fragmentos = []
+    for raw, eid, level, mid, cid, fmi in _RE_FRAGMENTO.findall(texto):
+        if eid:
+            fragmentos.append(Fragmento("evento", raw, None, None, None, "E" + eid, level))
+        elif cid:
+            fragmentos.append(Fragmento("codigo", raw, mid or None, cid, fmi))
+        elif raw:
+            codigo = _codigo_flexible(raw)
+            if codigo:
+                fragmentos.append(Fragmento("codigo", raw, *codigo))
+            else:
+                fragmentos.append(Fragmento("invalido", raw))
+    return fragmentos
+
+
+# Texto libre ("tengo 168-4 y E0117(2)"): se buscan códigos y eventos en
+# cualquier parte del mensaje. Aquí un código necesita una forma inequívoca
+# (CID-FMI / CID.FMI / CID/FMI o las palabras CID y FMI), porque números
+# sueltos separados por espacios pueden ser cualquier cosa.
+_RE_EN_TEXTO = re.compile(
+    rf"(?<![\w.\-/])(?:{_EVENTO}|(?:"
+    rf"(?:MID{_PALABRA}(?P<mid>\d+){_SEP})?CID{_PALABRA}(?P<kcid>\d+){_SEP}?FMI{_PALABRA}(?P<kfmi>\d+)"
+    rf"|(?P<cid>\d+)\s*[.\-/]\s*(?P<fmi>\d+)"
+    rf")(?![\w\-/]|\.\d))",
+    re.IGNORECASE,
+)
+
+
+def buscar_fragmentos(texto: str):
+    """Fragmentos válidos encontrados en cualquier parte del texto (en orden)."""
+    fragmentos = []
+    for m in _RE_EN_TEXTO.finditer(texto):
+        if m.group("eid"):
+            fragmentos.append(
+                Fragmento("evento", m.group(0), None, None, None, "E" + m.group("eid"), m.group("level"))
+            )
+        elif m.group("kcid"):
+            fragmentos.append(Fragmento("codigo", m.group(0), m.group("mid"), m.group("kcid"), m.group("kfmi")))
+        else:
+            fragmentos.append(Fragmento("codigo", m.group(0), None, m.group("cid"), m.group("fmi")))
+    return fragmentos
+
+
+def fragmentos_texto_libre(texto: str):
+    """
+    tokenizar() para el menú principal: los fragmentos válidos se quedan y
+    sólo en los inválidos se buscan códigos/eventos sueltos. Un fragmento
+    donde no aparece ninguno sigue como inválido.
+    """
+    fragmentos = []
+    for f in tokenizar(texto):
+        encontrados = buscar_fragmentos(f.raw) if f.tipo == "invalido" else None
+        fragmentos.extend(encontrados or [f])
+    return fragmentos
+
+
+def extraer_codigo(texto: str):
+    """Un único código -> (mid, cid, fmi); (None, None, None) si no lo es."""
+    m = _RE_CODIGO.fullmatch(texto)
+    if not m:
+        return _codigo_flexible(texto) or (None, None, None)
+    return m.group("mid"), m.group("cid"), m.group("fmi")
 
-    return None, None, None
 
-# ============================================================
-#  PARSEO DE EVENTOS (NUEVO FORMATO ÚNICO)
-# ============================================================
 def extraer_evento(texto: str):
     """
     Formato único permitido: E + números + (nivel)
     Ejemplo: E1234(2)  con nivel 1, 2 o 3
     """
-    t = texto.strip().upper()
-    m = re.fullmatch(r"E(\d+)\(([123])\)", t)
+    m = _RE_EVENTO.fullmatch(texto)
     if not m:
         return None, None
-
-    eid = f"E{m.group(1)}"   # E + números
-    level = m.group(2)       # 1, 2 o 3
-    return eid, level
+    return f"E{m.group('eid')}", m.group("level")
 
 # ============================================================
 #  PLAN DE MANTENIMIENTO
 # ============================================================
-PLAN_MANTENIMIENTO = {
-    # =======================================================
-    # RODILLO
-    # =======================================================
-    "rodillo": {
-        "nombre": "Rodillo",
-        "link": "https://sis2.cat.com/#/detail?keyword=Maintenance+Interval+Schedule&infoType=13&serviceMediaNumber=M0165439&serviceIeSystemControlNumber=i09996110&tab=service",
-        "intervalos": {
-            "diario_10h": {
-                "label": "Cada día / 10 horas de servicio",
-                "bloques": {
-                    "🛡️ Seguridad y alarmas": [
-                        "Probar la alarma de retroceso",
-                        "Inspeccionar el cinturón de seguridad"
-                    ],
-                    "🛢️ Motor y enfriamiento": [
-                        "Revisar nivel de refrigerante del sistema de enfriamiento",
-                        "Revisar nivel de aceite del motor"
-                    ],
-                    "⛽ Combustible": [
-                        "Drenar separador de agua del sistema de combustible"
-                    ]
-                }
-            },
-            "50h": {
-                "label": "50 horas de servicio",
-                "bloques": {
-                    "🛢️ Motor": [
-                        "Cambiar aceite del motor y filtro según indicaciones"
-                    ]
-                }
-            },
-            "250h": {
-                "label": "250 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Obtener muestra de aceite del sistema hidráulico"
-                    ]
-                }
-            },
-            "500h": {
-                "label": "500 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Reemplazar filtro de aceite del sistema hidráulico"
-                    ]
-                }
-            },
-            "1000h": {
-                "label": "1000 horas de servicio",
-                "bloques": {
-                    "🛞 Ejes y mandos finales": [
-                        "Cambiar aceite de ejes y mandos finales según manual"
-                    ]
-                }
-            },
-            "2000h": {
-                "label": "2000 horas de servicio",
-                "bloques": {
-                    "🧊 Sistema de enfriamiento": [
-                        "Obtener muestra de refrigerante del sistema de enfriamiento"
-                    ]
-                }
-            },
-            "3000h": {
-                "label": "3000 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Reemplazar filtro de aceite del sistema hidráulico (retorno)"
-                    ]
-                }
-            },
-            "6000h": {
-                "label": "6000 horas de servicio o cada 3 años",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Cambiar aceite del sistema hidráulico"
-                    ],
-                    "🧊 Sistema de enfriamiento": [
-                        "Agregar prolongador de vida útil del refrigerante (ELC)"
-                    ]
-                }
-            },
-            "largo_plazo": {
-                "label": "Intervalos largos (3 años, 5000 h, 10 000 h, 12 000 h y tareas condicionales)",
-                "bloques": {
-                    "🛡️ Seguridad": [
-                        "Reemplazar cinturón de seguridad cada 3 años"
-                    ],
-                    "🧊 Sistema de enfriamiento": [
-                        "Cambiar refrigerante ELC cada 12 000 horas o 6 años"
-                    ],
-                    "🔁 Tareas cuando sea necesario": [
-                        "Inspeccionar filtro de aire de cabina",
-                        "Revisar nivel de electrolito de baterías",
-                        "Limpiar núcleos de enfriamiento"
-                    ]
-                }
-            },
-            "todo": {
-                "label": "Resumen general del programa de mantenimiento",
-                "bloques": {
-                    "📋 Recordatorios generales": [
-                        "Utilizar horas de servicio, consumo de combustible, kilometraje o tiempo de calendario (lo que ocurra primero) para definir los intervalos.",
-                        "Antes de efectuar las tareas de un intervalo consecutivo, realizar también las tareas de los intervalos anteriores.",
-                        "Seguir siempre las instrucciones de seguridad, advertencias y regulaciones de emisiones indicadas por el fabricante."
-                    ]
-                }
-            }
+# Los planes viven en un JSON versionado fuera del código. Se validan al
+# cargar y un hilo revisa cada PLAN_CHEQUEO segundos si el archivo cambió:
+# la versión nueva se precalcula aparte y se publica con una sola
+# asignación, así cada mensaje ve el plan anterior o el nuevo, nunca una
+# mezcla. Un archivo inválido no reemplaza al plan vigente.
+PLAN_MANTENIMIENTO_PATH = os.environ.get(
+    "PLAN_MANTENIMIENTO_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "plan_mantenimiento.json"),
+)
+PLAN_CHEQUEO = float(os.environ.get("PLAN_CHEQUEO", "30"))
+PLAN_MAX_MAQUINAS = 8   # el 9 del menú de máquinas es "Volver"
+
+
+class PlanInvalido(ValueError):
+    pass
+
+
+def _exigir(condicion, ruta, mensaje):
+    if not condicion:
+        raise PlanInvalido(f"{ruta}: {mensaje}")
+
+
+def _es_texto(valor):
+    return isinstance(valor, str) and valor.strip() != ""
+
+
+def validar_plan(datos):
+    """
+    Esquema:
+      {"version": int, "maquinas": {clave: {"nombre", "menu"?, "link"?,
+        "intervalos": {clave: {"label", "bloques": {titulo: [tarea, ...]}}}}}}
+    Devuelve (version, maquinas) o lanza PlanInvalido.
+    """
+    _exigir(isinstance(datos, dict), "plan", "debe ser un objeto")
+    version = datos.get("version")
+    _exigir(isinstance(version, int) and not isinstance(version, bool), "version", "debe ser un entero")
+    maquinas = datos.get("maquinas")
+    _exigir(isinstance(maquinas, dict) and maquinas, "maquinas", "debe ser un objeto no vacío")
+    _exigir(len(maquinas) <= PLAN_MAX_MAQUINAS, "maquinas", f"máximo {PLAN_MAX_MAQUINAS}")
+
+    for clave, info in maquinas.items():
+        ruta = f"maquinas.{clave}"
+        _exigir(isinstance(info, dict), ruta, "debe ser un objeto")
+        _exigir(_es_texto(info.get("nombre")), ruta + ".nombre", "texto obligatorio")
+        for opcional in ("menu", "link"):
+            if opcional in info:
+                _exigir(_es_texto(info[opcional]), f"{ruta}.{opcional}", "debe ser texto")
+        intervalos = info.get("intervalos")
+        _exigir(isinstance(intervalos, dict) and intervalos, ruta + ".intervalos", "objeto no vacío")
+
+        for clave_int, data in intervalos.items():
+            ruta_int = f"{ruta}.intervalos.{clave_int}"
+            _exigir(isinstance(data, dict), ruta_int, "debe ser un objeto")
+            _exigir(_es_texto(data.get("label")), ruta_int + ".label", "texto obligatorio")
+            bloques = data.get("bloques", {})
+            _exigir(isinstance(bloques, dict), ruta_int + ".bloques", "debe ser un objeto")
+            for titulo, tareas in bloques.items():
+                _exigir(
+                    isinstance(tareas, list) and all(_es_texto(t) for t in tareas),
+                    f"{ruta_int}.bloques.{titulo}", "debe ser una lista de textos",
+                )
+    return version, maquinas
+
+
+def leer_plan(ruta):
+    try:
+        with open(ruta, encoding="utf-8") as f:
+            datos = json.load(f)
+    except json.JSONDecodeError as e:
+        raise PlanInvalido(f"{ruta}: JSON inválido ({e})") from e
+    return validar_plan(datos)
+
+# Horas de servicio en la clave del intervalo: "diario_10h" -> 10, "250h" -> 250.
+# Las claves sin horas ("largo_plazo", "todo") no entran en el cálculo.
+_HORAS_INTERVALO = re.compile(r"(?:^|_)(\d+)h$")
+
+def horas_intervalo(clave):
+    m = _HORAS_INTERVALO.search(clave)
+    return int(m.group(1)) if m else None
+
+# ---------- Respuestas precalculadas ----------
+# El plan es estático: los menús de intervalos y el texto de cada
+# (máquina, intervalo) se arman una sola vez; en el chat quedan como un
+# acceso a diccionario y los ETag permiten cachearlos en el cliente.
+@dataclass(frozen=True, slots=True)
+class TextoFijo:
+    texto: str
+    etag: str
+    claves: tuple = ()
+
+
+def _texto_fijo(texto, claves=()):
+    return TextoFijo(texto, hashlib.sha1(texto.encode("utf-8")).hexdigest()[:20], tuple(claves))
+
+
+class PlanPrecalculado:
+    """Menús y respuestas de mantenimiento listos para enviar (solo lectura)."""
+
+    def __init__(self, plan, version=None):
+        self.plan = plan
+        self.version = version
+        self.cargado = time.time()
+
+        # Menú de máquinas derivado del plan, en el orden del archivo
+        self.maquinas = MappingProxyType(
+            {str(i): clave for i, clave in enumerate(plan, start=1)}
+        )
+        self.menu_maquinas = (
+            "Selecciona el tipo de maquinaria:<br>"
+            + "".join(
+                f"{i}️⃣ {info.get('menu', info['nombre'])}<br>"
+                for i, info in enumerate(plan.values(), start=1)
+            )
+            + "9️⃣ Volver"
+        )
+
+        menus = {}
+        respuestas = {}
+        for maquina, info in plan.items():
+            claves = tuple(info["intervalos"])
+            lista = "".join(
+                f"{i}️⃣ {info['intervalos'][clave]['label']}<br>"
+                for i, clave in enumerate(claves, start=1)
+            )
+            menus[maquina] = _texto_fijo(
+                f"📘 <b>Plan de mantenimiento — {info['nombre']}</b><br><br>"
+                f"Selecciona el intervalo:<br><br>{lista}<br>"
+                f"0️⃣ Volver al menú de máquinas",
+                claves,
+            )
+            for clave in claves:
+                respuestas[(maquina, clave)] = _texto_fijo(
+                    self._html_intervalo(info, info["intervalos"][clave], len(claves))
+                )
+        self.menus = MappingProxyType(menus)
+        self.respuestas = MappingProxyType(respuestas)
+
+        # Intervalos con horas, de mayor a menor, para el cálculo por horómetro
+        self.horas = MappingProxyType({
+            maquina: tuple(sorted(
+                ((h, clave) for clave in info["intervalos"]
+                 if (h := horas_intervalo(clave))),
+                reverse=True,
+            ))
+            for maquina, info in plan.items()
+        })
+
+    @staticmethod
+    def _html_intervalo(info, data_intervalo, total):
+        partes = [
+            f"📘 <b>Plan de mantenimiento — {info['nombre']}</b><br><br>"
+            f"<b>Intervalo:</b> {data_intervalo['label']}<br><br>"
+        ]
+        for titulo, tareas in data_intervalo.get("bloques", {}).items():
+            partes.append(f"{titulo}:<br>")
+            partes.extend(f"• {t}<br>" for t in tareas)
+            partes.append("<br>")
+
+        link_manual = info.get("link")
+        if link_manual:
+            partes.append(
+                "<b>Consulta más detalles en el manual oficial:</b><br>"
+                f"<a href=\"{link_manual}\" target=\"_blank\">{link_manual}</a><br><br>"
+            )
+
+        # Permitir seguir consultando más intervalos
+        partes.append(
+            f"Selecciona otro intervalo (1–{total}) o 0️⃣ Volver al menú de máquinas."
+        )
+        return "".join(partes)
+
+    def vencimientos(self, maquina, horometro, ultimo):
+        """
+        Intervalos que tocan entre el último servicio y el horómetro actual.
+        Un intervalo de h horas vence si se cruzó un múltiplo de h desde el
+        último servicio; con dos o más cruces está atrasado. Por la regla
+        acumulativa del manual, el mayor intervalo vencido arrastra a todos
+        los menores ("incluido"). Se devuelven de menor a mayor.
+        """
+        info = self.plan[maquina]
+        resultado = []
+        arrastre = False
+        for h, clave in self.horas[maquina]:
+            ciclos = int(horometro // h) - int(ultimo // h)
+            if ciclos >= 2:
+                estado = "atrasado"
+            elif ciclos == 1:
+                estado = "vencido"
+            elif arrastre:
+                estado = "incluido"
+            else:
+                continue
+            arrastre = True
+            data = info["intervalos"][clave]
+            resultado.append({
+                "clave": clave,
+                "label": data["label"],
+                "horas": h,
+                "estado": estado,
+                "ciclos": max(ciclos, 0),
+                "proximo": (int(horometro // h) + 1) * h,
+                "bloques": data.get("bloques", {}),
+            })
+        resultado.reverse()
+        return resultado
+
+    def estadisticas(self):
+        return {
+            "version": self.version,
+            "ruta": PLAN_MANTENIMIENTO_PATH,
+            "cargado": datetime.fromtimestamp(self.cargado).isoformat(timespec="seconds"),
+            "maquinas": list(self.plan),
+            "respuestas": len(self.respuestas),
         }
-    },
-
-    # =======================================================
-    # CARGADOR
-    # =======================================================
-    "cargador": {
-        "nombre": "Cargador de ruedas",
-        "link": "https://sis2.cat.com/#/detail?keyword=Maintenance+Interval+Schedule&infoType=13&serviceMediaNumber=M0080860&serviceIeSystemControlNumber=i07103985&tab=service",
-        "intervalos": {
-            "diario_10h": {
-                "label": "Cada día / 10 horas de servicio",
-                "bloques": {
-                    "🛢️ Motor y enfriamiento": [
-                        "Revisar nivel de aceite del motor",
-                        "Revisar nivel de refrigerante del sistema de enfriamiento"
-                    ],
-                    "🛞 Neumáticos y estructura": [
-                        "Inspeccionar neumáticos",
-                        "Revisar pasadores y puntos de articulación"
-                    ]
-                }
-            },
-            "50h": {
-                "label": "50 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Revisar nivel de aceite hidráulico"
-                    ]
-                }
-            },
-            "250h": {
-                "label": "250 horas de servicio",
-                "bloques": {
-                    "🛢️ Motor": [
-                        "Cambiar aceite y filtro del motor"
-                    ]
-                }
-            },
-            "500h": {
-                "label": "500 horas de servicio",
-                "bloques": {
-                    "🛞 Ejes y mandos finales": [
-                        "Obtener muestra de aceite de mandos finales y ejes"
-                    ]
-                }
-            },
-            "1000h": {
-                "label": "1000 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Reemplazar filtro de aceite del sistema hidráulico"
-                    ]
-                }
-            },
-            "2000h": {
-                "label": "2000 horas de servicio",
-                "bloques": {
-                    "🧊 Sistema de enfriamiento": [
-                        "Obtener muestra de refrigerante del sistema de enfriamiento"
-                    ]
-                }
-            },
-            "3000h": {
-                "label": "3000 horas de servicio",
-                "bloques": {
-                    "🧊 Sistema de enfriamiento": [
-                        "Reemplazar termostato del agua",
-                        "Cambiar aceite de cajas y mandos finales según instrucciones"
-                    ]
-                }
-            },
-            "6000h": {
-                "label": "6000 horas de servicio o cada 3 años",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Cambiar aceite del sistema hidráulico"
-                    ],
-                    "🧊 Sistema de enfriamiento": [
-                        "Agregar prolongador de vida útil de refrigerante (ELC)"
-                    ]
-                }
-            },
-            "largo_plazo": {
-                "label": "Intervalos largos (3 años, 5000 h, 10 000 h, 12 000 h y tareas condicionales)",
-                "bloques": {
-                    "🛡️ Seguridad": [
-                        "Reemplazar cinturón de seguridad cada 3 años"
-                    ],
-                    "🧪 Sistema de emisiones y combustible": [
-                        "Reemplazar filtro de fluido de escape diésel (cada 5 000 horas)",
-                        "Reemplazar filtros del múltiple de DEF (cada 10 000 horas)"
-                    ],
-                    "🔁 Tareas cuando sea necesario": [
-                        "Inspeccionar/reemplazar filtros de aire de cabina",
-                        "Limpiar núcleos de enfriamiento",
-                        "Llenar fluido de escape diésel"
-                    ]
-                }
-            },
-            "todo": {
-                "label": "Resumen general del programa de mantenimiento",
-                "bloques": {
-                    "📋 Recordatorios generales": [
-                        "Antes de efectuar las tareas de un intervalo consecutivo, realizar también las tareas de los intervalos anteriores.",
-                        "Seguir siempre las instrucciones de seguridad, advertencias y regulaciones de emisiones indicadas por el fabricante."
-                    ]
-                }
+
+
+plan_mant = None
+_firma_plan = None
+_lock_plan = threading.Lock()
+
+def recargar_plan(forzar=False):
+    """Relee el archivo si cambió (mtime/tamaño). Devuelve True si publicó uno nuevo."""
+    global plan_mant, _firma_plan
+    with _lock_plan:
+        st = os.stat(PLAN_MANTENIMIENTO_PATH)
+        firma = (st.st_mtime_ns, st.st_size)
+        if not forzar and firma == _firma_plan:
+            return False
+        version, maquinas = leer_plan(PLAN_MANTENIMIENTO_PATH)
+        plan_mant = PlanPrecalculado(maquinas, version)
+        _firma_plan = firma
+        return True
+
+@tarea_periodica("plan_mantenimiento", PLAN_CHEQUEO)
+def _vigilar_plan():
+    try:
+        if recargar_plan():
+            app.logger.info("Plan de mantenimiento recargado (versión %s)", plan_mant.version)
+    except (OSError, PlanInvalido) as e:
+        app.logger.error("Plan de mantenimiento no recargado, sigue la versión %s: %s",
+                         plan_mant.version, e)
+
+recargar_plan(forzar=True)
+
+# ============================================================
+#  CACHÉ DE CATÁLOGOS (LRU + TTL)
+# ============================================================
+class CacheTTL:
+    """
+    Caché LRU acotada con expiración por entrada, segura entre hilos.
+    Los resultados vacíos ("no existe") se guardan con su propio TTL.
+    """
+
+    def __init__(self, max_items=5000, ttl=3600.0, ttl_negativo=300.0):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self._datos = OrderedDict()   # clave -> (vence_en, valor)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expiradas = 0
+
+    def obtener(self, clave):
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self.misses += 1
+                return None
+            vence_en, valor = entrada
+            if vence_en <= ahora:
+                del self._datos[clave]
+                self.expiradas += 1
+                self.misses += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return valor
+
+    def presente(self, clave):
+        """Si hay una entrada vigente, sin contar hit/miss ni moverla en el LRU."""
+        entrada = self._datos.get(clave)
+        return entrada is not None and entrada[0] > time.monotonic()
+
+    def guardar(self, clave, valor):
+        ttl = self.ttl if valor else self.ttl_negativo
+        if self.max_items <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + ttl, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+                self.evictions += 1
+
+    def invalidar(self):
+        with self._lock:
+            n = len(self._datos)
+            self._datos.clear()
+        return n
+
+    def estadisticas(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entradas": len(self._datos),
+                "max_items": self.max_items,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expiradas": self.expiradas,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
             }
-        }
-    },
-
-    # =======================================================
-    # EXCAVADORA
-    # =======================================================
-    "excavadora": {
-        "nombre": "Excavadora",
-        "link": "https://sis2.cat.com/#/detail?keyword=Maintenance+Interval+Schedule&infoType=13&serviceMediaNumber=M0082496&serviceIeSystemControlNumber=i07103987&tab=service",
-        "intervalos": {
-            "diario_10h": {
-                "label": "Cada día / 10 horas de servicio",
-                "bloques": {
-                    "🛢️ Motor y enfriamiento": [
-                        "Revisar nivel de aceite del motor",
-                        "Revisar nivel de refrigerante del sistema de enfriamiento"
-                    ],
-                    "⛽ Combustible": [
-                        "Drenar separador de agua del sistema de combustible"
-                    ],
-                    "🧮 Sistema hidráulico": [
-                        "Revisar nivel de aceite del sistema hidráulico"
-                    ],
-                    "🛡️ Seguridad": [
-                        "Probar indicadores y medidores",
-                        "Inspeccionar cinturón de seguridad"
-                    ]
-                }
-            },
-            "50h": {
-                "label": "50 horas de servicio",
-                "bloques": {
-                    "🛞 Tren de rodaje": [
-                        "Inspeccionar tensión de la cadena de orugas"
-                    ]
-                }
-            },
-            "250h": {
-                "label": "250 horas de servicio",
-                "bloques": {
-                    "🛢️ Motor": [
-                        "Cambiar aceite y filtro del motor"
-                    ]
-                }
-            },
-            "500h": {
-                "label": "500 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Obtener muestra de aceite del sistema hidráulico"
-                    ]
-                }
-            },
-            "1000h": {
-                "label": "1000 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Reemplazar filtro de aceite del sistema hidráulico"
-                    ]
-                }
-            },
-            "2000h": {
-                "label": "2000 horas de servicio",
-                "bloques": {
-                    "🧊 Sistema de enfriamiento": [
-                        "Obtener muestra de refrigerante del sistema de enfriamiento"
-                    ]
-                }
-            },
-            "2500h": {
-                "label": "2500 horas de servicio",
-                "bloques": {
-                    "🛢️ Motor": [
-                        "Revisar juego de válvulas del motor"
-                    ]
-                }
-            },
-            "3000h": {
-                "label": "3000 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Reemplazar filtro de aceite del sistema hidráulico (retorno)"
-                    ]
-                }
-            },
-            "6000h": {
-                "label": "6000 horas de servicio o cada 3 años",
-                "bloques": {
-                    "🧊 Sistema de enfriamiento": [
-                        "Agregar prolongador de vida útil del refrigerante (ELC)"
-                    ]
-                }
-            },
-            "largo_plazo": {
-                "label": "Intervalos largos (10 000 h, 12 000 h y tareas anuales)",
-                "bloques": {
-                    "🧊 Sistema de enfriamiento y refrigerante": [
-                        "Obtener muestra de refrigerante cada año",
-                        "Cambiar refrigerante ELC cada 12 000 horas o 6 años"
-                    ],
-                    "🧪 Sistema de emisiones DEF": [
-                        "Reemplazar filtros del múltiple de DEF cada 10 000 horas"
-                    ],
-                    "🔁 Tareas cuando sea necesario": [
-                        "Limpiar/revisar batería",
-                        "Reemplazar batería o cables si es necesario",
-                        "Limpiar filtro de aire de la cabina"
-                    ]
-                }
-            },
-            "todo": {
-                "label": "Resumen general del programa de mantenimiento",
-                "bloques": {
-                    "📋 Recordatorios generales": [
-                        "Utilizar horas de servicio, combustible, kilometraje o tiempo para definir los intervalos.",
-                        "Antes de efectuar las tareas de un intervalo consecutivo, realizar también las tareas de los intervalos anteriores.",
-                        "Seguir siempre las instrucciones de seguridad, advertencias y regulaciones de emisiones indicadas por el fabricante."
-                    ]
+
+
+def _crear_cache():
+    return CacheTTL(
+        max_items=int(os.environ.get("CACHE_MAX_ITEMS", "5000")),
+        ttl=float(os.environ.get("CACHE_TTL", "3600")),
+        ttl_negativo=float(os.environ.get("CACHE_TTL_NEGATIVO", "300")),
+    )
+
+cache_codigos = _crear_cache()   # (model, serial3, cid, fmi) -> filas
+cache_eventos = _crear_cache()   # (model, serial3, eid, level) -> filas
+
+# ---------- Invalidación en todos los workers ----------
+# Cada worker tiene sus propias cachés. /admin/cache/invalidar sube un
+# contador por caché en un archivo compartido y cada worker, al ver que
+# cambió (lo mira como mucho una vez por segundo, antes de un request),
+# vacía su copia. Con varias máquinas el archivo debe estar en un disco
+# compartido; si no, la invalidación alcanza solo a los workers del nodo.
+CACHE_GENERACIONES_PATH = os.environ.get(
+    "CACHE_GENERACIONES_PATH",
+    os.path.join(tempfile.gettempdir(), "ferreydoc_cache_generaciones.json")
+)
+CACHE_GENERACIONES_CHEQUEO = 1.0
+
+class GeneracionesCache:
+    """Contador compartido por caché: {nombre: generación} en un JSON."""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.caches = {}         # nombre -> CacheTTL
+        self._vistas = {}        # nombre -> generación ya aplicada aquí
+        self._firma = None       # (mtime_ns, size) del último archivo leído
+        self._proximo_chequeo = 0.0
+        self._lock = threading.Lock()
+
+    def registrar(self, nombre, cache):
+        self.caches[nombre] = cache
+
+    def _leer(self):
+        try:
+            with open(self.ruta, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def invalidar(self, nombres):
+        """Sube la generación de `nombres` y vacía ya las cachés locales."""
+        with self._lock:
+            generaciones = self._leer()
+            for nombre in nombres:
+                generaciones[nombre] = generaciones.get(nombre, 0) + 1
+                self._vistas[nombre] = generaciones[nombre]
+            tmp = f"{self.ruta}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(generaciones, f)
+            os.replace(tmp, self.ruta)
+        return {nombre: self.caches[nombre].invalidar() for nombre in nombres}
+
+    def sincronizar(self):
+        ahora = time.monotonic()
+        if ahora < self._proximo_chequeo:
+            return
+        with self._lock:
+            self._proximo_chequeo = ahora + CACHE_GENERACIONES_CHEQUEO
+            try:
+                st = os.stat(self.ruta)
+            except FileNotFoundError:
+                return
+            firma = (st.st_mtime_ns, st.st_size)
+            if firma == self._firma:
+                return
+            self._firma = firma
+            for nombre, generacion in self._leer().items():
+                if nombre in self.caches and self._vistas.get(nombre) != generacion:
+                    self._vistas[nombre] = generacion
+                    self.caches[nombre].invalidar()
+
+
+generaciones_cache = GeneracionesCache(CACHE_GENERACIONES_PATH)
+generaciones_cache.registrar("codigos", cache_codigos)
+generaciones_cache.registrar("eventos", cache_eventos)
+
+@app.before_request
+def _sincronizar_caches():
+    generaciones_cache.sincronizar()
+
+# ============================================================
+#  SNAPSHOT DEL CATÁLOGO EN MEMORIA (opcional)
+# ============================================================
+# Con CATALOGO_SNAPSHOT=1 ambas tablas se cargan completas en memoria y
+# /enviar responde códigos y eventos sin ir a Postgres. Si Postgres cae,
+# se sigue sirviendo el último snapshot bueno.
+SNAPSHOT_ACTIVO = os.environ.get("CATALOGO_SNAPSHOT") == "1"
+SNAPSHOT_CHEQUEO = float(os.environ.get("CATALOGO_CHEQUEO", "60"))
+SNAPSHOT_RECARGA = float(os.environ.get("CATALOGO_RECARGA", "3600"))
+
+class CatalogoSnapshot:
+    """
+    Índices hash {(model, serial3, a, b): (fila, ...)} con filas como tuplas.
+    Cada recarga construye diccionarios nuevos y los publica con una sola
+    asignación, así los lectores nunca ven un catálogo a medio cargar.
+    """
+
+    TABLAS = {
+        "codigos": ("codigos_falla", ("cid", "fmi"), ("description", "causes", "url")),
+        "eventos": ("eventos", ("eid", "level"), ("warning_description", "url_main")),
+    }
+
+    def __init__(self):
+        self.indices = None          # {"codigos": {...}, "eventos": {...}}
+        self.version = None
+        self.cargado_en = None       # time.time() de la última carga buena
+        self.ultima_recarga = 0.0    # time.monotonic()
+        self.errores = 0
+        self._con_updated_at = {}
+        self._lock = threading.Lock()
+
+    @property
+    def listo(self):
+        return self.indices is not None
+
+    def _huella(self):
+        """Versión barata de ambas tablas: filas y último updated_at si existe."""
+        partes = []
+        for tabla, _, _ in self.TABLAS.values():
+            if tabla not in self._con_updated_at:
+                self._con_updated_at[tabla] = bool(ejecutar_consulta(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name = %s AND column_name = 'updated_at'",
+                    (tabla,)
+                ))
+            extra = ", MAX(updated_at)::text AS v" if self._con_updated_at[tabla] else ", NULL AS v"
+            fila = ejecutar_consulta(f"SELECT COUNT(*) AS n{extra} FROM {tabla}")[0]
+            partes.append((tabla, fila["n"], fila["v"]))
+        return tuple(partes)
+
+    def _cargar_tabla(self, tabla, campos, columnas):
+        sql = f"SELECT model, serial3, {campos[0]}, {campos[1]}, {', '.join(columnas)} FROM {tabla}"
+        indice = {}
+        with pool.conexion() as conn:
+            cur = conn.cursor()
+            cur.execute(sql)
+            for r in cur.fetchall():
+                clave = tuple(sys.intern(_norm(v)) for v in r[:4])
+                indice.setdefault(clave, []).append(tuple(r[4:]))
+            cur.close()
+        return {k: tuple(v) for k, v in indice.items()}
+
+    def cargar(self, forzar=False):
+        """Recarga si cambió la versión (o si toca recarga completa)."""
+        with self._lock:
+            try:
+                version = self._huella()
+                vencida = time.monotonic() - self.ultima_recarga >= SNAPSHOT_RECARGA
+                if self.listo and not forzar and not vencida and version == self.version:
+                    return False
+                indices = {
+                    nombre: self._cargar_tabla(tabla, campos, columnas)
+                    for nombre, (tabla, campos, columnas) in self.TABLAS.items()
                 }
-            }
+            except Exception as e:
+                self.errores += 1
+                app.logger.warning("No se pudo cargar el catálogo; se mantiene el anterior: %s", e)
+                return False
+            self.indices = indices
+            self.version = version
+            self.cargado_en = time.time()
+            self.ultima_recarga = time.monotonic()
+            return True
+
+    def buscar(self, nombre, claves):
+        """Misma salida que las consultas por lote: lista de filas por clave."""
+        indice = self.indices[nombre]
+        columnas = self.TABLAS[nombre][2]
+        return [
+            [dict(zip(columnas, fila)) for fila in indice.get(tuple(map(_norm, c)), ())]
+            for c in claves
+        ]
+
+    def estadisticas(self):
+        indices = self.indices or {}
+        return {
+            "activo": SNAPSHOT_ACTIVO,
+            "listo": self.listo,
+            "claves": {n: len(i) for n, i in indices.items()},
+            "version": [list(v) for v in self.version] if self.version else None,
+            "cargado_en": datetime.fromtimestamp(self.cargado_en).isoformat() if self.cargado_en else None,
+            "errores": self.errores,
         }
-    },
-
-    # =======================================================
-    # TRACTOR
-    # =======================================================
-    "tractor": {
-        "nombre": "Tractor",
-        "link": "https://sis2.cat.com/#/detail?keyword=Maintenance+Interval+Schedule&infoType=13&serviceMediaNumber=M0082498&serviceIeSystemControlNumber=i07103988&tab=service",
-        "intervalos": {
-            "diario_10h": {
-                "label": "Cada día / 10 horas de servicio",
-                "bloques": {
-                    "🛢️ Motor y enfriamiento": [
-                        "Revisar nivel de aceite del motor",
-                        "Revisar nivel de refrigerante del sistema de enfriamiento"
-                    ],
-                    "🛡️ Seguridad": [
-                        "Inspeccionar cinturón de seguridad",
-                        "Verificar funcionamiento de alarmas"
-                    ]
-                }
-            },
-            "50h": {
-                "label": "50 horas de servicio",
-                "bloques": {
-                    "🛞 Tren de rodaje": [
-                        "Inspeccionar tensión de la cadena y rodillos"
-                    ]
-                }
-            },
-            "250h": {
-                "label": "250 horas de servicio",
-                "bloques": {
-                    "🛢️ Motor": [
-                        "Cambiar aceite y filtro del motor"
-                    ]
-                }
-            },
-            "500h": {
-                "label": "500 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Obtener muestra de aceite del sistema hidráulico"
-                    ]
-                }
-            },
-            "1000h": {
-                "label": "1000 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Reemplazar filtro de aceite del sistema hidráulico"
-                    ]
-                }
-            },
-            "2000h": {
-                "label": "2000 horas de servicio",
-                "bloques": {
-                    "🧊 Sistema de enfriamiento": [
-                        "Obtener muestra de refrigerante del sistema de enfriamiento"
-                    ]
-                }
-            },
-            "3000h": {
-                "label": "3000 horas de servicio",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Reemplazar filtro de aceite del sistema hidráulico (retorno)"
-                    ]
-                }
-            },
-            "6000h": {
-                "label": "6000 horas de servicio o cada 3 años",
-                "bloques": {
-                    "🧮 Sistema hidráulico": [
-                        "Cambiar aceite del sistema hidráulico"
-                    ],
-                    "🧊 Sistema de enfriamiento": [
-                        "Agregar prolongador de vida útil del refrigerante (ELC)"
-                    ]
-                }
-            },
-            "largo_plazo": {
-                "label": "Intervalos largos (3 años, 5000 h, 10 000 h, 12 000 h y tareas condicionales)",
-                "bloques": {
-                    "🛡️ Seguridad": [
-                        "Reemplazar cinturón de seguridad cada 3 años"
-                    ],
-                    "🧊 Sistema de enfriamiento": [
-                        "Cambiar refrigerante ELC cada 12 000 horas o 6 años"
-                    ],
-                    "🔁 Tareas cuando sea necesario": [
-                        "Revisar tren de rodaje",
-                        "Inspeccionar Estructura de Protección en Caso de Vuelcos (ROPS)",
-                        "Limpiar radiador, posenfriador y núcleos del enfriador de aceite"
-                    ]
-                }
-            },
-            "todo": {
-                "label": "Resumen general del programa de mantenimiento",
-                "bloques": {
-                    "📋 Recordatorios generales": [
-                        "Antes de efectuar las tareas de un intervalo consecutivo, realizar también las tareas de los intervalos anteriores.",
-                        "Seguir siempre las instrucciones de seguridad, advertencias y regulaciones de emisiones indicadas por el fabricante."
-                    ]
-                }
+
+
+catalogo = CatalogoSnapshot()
+
+if SNAPSHOT_ACTIVO:
+    @tarea_periodica("refresco-catalogo", SNAPSHOT_CHEQUEO)
+    def _refrescar_catalogo():
+        catalogo.cargar()
+
+# ============================================================
+#  MÁQUINAS CONOCIDAS (model, serial3)
+# ============================================================
+# Pares (model, serial3) que existen en codigos_falla o eventos. Sirven para
+# validar modelo y serie al ingresarlos, autocompletar el modelo y cortar
+# antes de Postgres las búsquedas de máquinas que no existen. Mientras no se
+# haya podido cargar, todo se considera válido (mismo comportamiento de antes).
+MAQUINAS_RECARGA = float(os.environ.get("MAQUINAS_RECARGA", "600"))
+MAQUINAS_REINTENTO = 30.0   # segundos entre intentos si la carga falla
+
+class MaquinasConocidas:
+
+    def __init__(self):
+        self.series = None           # {model: frozenset(serial3)}
+        self.modelos = ()            # modelos ordenados, para autocompletar
+        self.cargado_en = None
+        self._ultimo_intento = float("-inf")
+        self._lock = threading.Lock()
+
+    @property
+    def listo(self):
+        return self.series is not None
+
+    SQL = (
+        "SELECT DISTINCT model, serial3 FROM codigos_falla "
+        "UNION SELECT DISTINCT model, serial3 FROM eventos"
+    )
+
+    def _pares(self):
+        if catalogo.listo:
+            return {
+                clave[:2] for indice in catalogo.indices.values() for clave in indice
             }
+        return ejecutar_consulta(self.SQL)
+
+    def publicar(self, filas):
+        """filas: pares (model, serial3) o dicts con esas columnas."""
+        series = {}
+        for f in filas:
+            model, serial3 = (f["model"], f["serial3"]) if isinstance(f, dict) else f
+            series.setdefault(_norm(model), set()).add(_norm(serial3))
+        self.series = {m: frozenset(s) for m, s in series.items()}
+        self.modelos = tuple(sorted(self.series))
+        self.cargado_en = time.time()
+
+    def cargar(self):
+        with self._lock:
+            self._ultimo_intento = time.monotonic()
+            try:
+                self.publicar(self._pares())
+            except Exception as e:
+                app.logger.warning("No se pudieron cargar las máquinas conocidas: %s", e)
+                return False
+            return True
+
+    def _asegurar(self):
+        if (not self.listo and os.environ.get("DATABASE_URL")
+                and time.monotonic() - self._ultimo_intento >= MAQUINAS_REINTENTO):
+            self.cargar()
+        return self.listo
+
+    def existe_modelo(self, model):
+        return not self._asegurar() or _norm(model) in self.series
+
+    def existe(self, model, serial3):
+        if not self._asegurar():
+            return True
+        return _norm(serial3) in self.series.get(_norm(model), ())
+
+    def autocompletar(self, prefijo, maximo=5):
+        """Modelos que empiezan con `prefijo`; si no hay, con sus primeros caracteres."""
+        if not self._asegurar():
+            return []
+        prefijo = prefijo.strip().upper()
+        while prefijo:
+            i = bisect.bisect_left(self.modelos, prefijo)
+            encontrados = []
+            while (i < len(self.modelos) and self.modelos[i].startswith(prefijo)
+                   and len(encontrados) < maximo):
+                encontrados.append(self.modelos[i])
+                i += 1
+            if encontrados:
+                return encontrados
+            prefijo = prefijo[:-1]
+        return []
+
+    def series_de(self, model):
+        if not self._asegurar():
+            return []
+        return sorted(self.series.get(_norm(model), ()))
+
+    def estadisticas(self):
+        return {
+            "listo": self.listo,
+            "modelos": len(self.modelos),
+            "maquinas": sum(len(s) for s in (self.series or {}).values()),
+            "cargado_en": datetime.fromtimestamp(self.cargado_en).isoformat() if self.cargado_en else None,
         }
-    }
-}
+
+
+maquinas = MaquinasConocidas()
+
+@tarea_periodica("refresco-maquinas", MAQUINAS_RECARGA)
+def _refrescar_maquinas():
+    if os.environ.get("DATABASE_URL"):
+        maquinas.cargar()
 
 # ============================================================
 #  QUERIES A BASE DE DATOS
 # ============================================================
+def _norm(valor):
+    """Normaliza un campo de clave para comparar entrada vs. fila (168 == '0168')."""
+    t = str(valor).strip().upper()
+    return str(int(t)) if t.isdigit() else t
+
+def sql_lote(select, tabla, campos, n, marcador="%s"):
+    """
+    SELECT para n claves (model, serial3, a, b) en una sola consulta.
+    marcador: "%s" (pg8000) o "$" (parámetros numerados, asyncpg).
+    """
+    if marcador == "$":
+        grupos = ", ".join(f"(${i}, ${i + 1}, ${i + 2}, ${i + 3})" for i in range(1, 4 * n, 4))
+    else:
+        grupos = ", ".join(["(%s, %s, %s, %s)"] * n)
+    return f"""
+        SELECT model, serial3, {campos[0]}, {campos[1]}, {select}
+        FROM {tabla}
+        WHERE (model, serial3, {campos[0]}, {campos[1]}) IN ({grupos})
+    """
+
+def agrupar_lote(filas, campos):
+    """{clave_normalizada: [filas]} a partir de las filas (dicts) de sql_lote."""
+    encontrados = {}
+    for fila in filas:
+        clave = tuple(_norm(fila.pop(c)) for c in ("model", "serial3") + campos)
+        encontrados.setdefault(clave, []).append(fila)
+    return encontrados
+
+def _consultar_lote(select, tabla, campos, claves):
+    """
+    Resuelve muchas claves (model, serial3, a, b) en UNA sola consulta.
+    Devuelve {clave_normalizada: [filas]} sólo para las claves encontradas.
+    """
+    unicas = list(dict.fromkeys(claves))
+    if not unicas:
+        return {}
+
+    params = tuple(v for clave in unicas for v in clave)
+    return agrupar_lote(
+        ejecutar_consulta(sql_lote(select, tabla, campos, len(unicas)), params), campos
+    )
+
+def pendientes_en_cache(cache, claves):
+    """Claves que no están en la caché (las que habría que ir a buscar)."""
+    return [c for c in claves if not cache.presente(tuple(map(_norm, c)))]
+
+def cachear_lote(cache, pendientes, encontrados):
+    """Guarda el resultado de un lote, incluidos los "no existe"."""
+    resultados = {}
+    for clave in pendientes:
+        norm = tuple(map(_norm, clave))
+        filas = encontrados.get(norm, [])
+        cache.guardar(norm, filas)
+        resultados[norm] = filas
+    return resultados
+
+def _resolver_lote(cache, select, tabla, campos, claves):
+    """
+    Resuelve claves pasando primero por la caché; sólo las que faltan van
+    a Postgres (en una única consulta). También se cachean los "no existe".
+    Devuelve una lista de filas por clave, en el mismo orden de `claves`.
+    """
+    normalizadas = [tuple(map(_norm, c)) for c in claves]
+    resultados = {}
+    pendientes = []
+    for clave, norm in zip(claves, normalizadas):
+        filas = cache.obtener(norm)
+        if filas is None:
+            pendientes.append(clave)
+        else:
+            resultados[norm] = filas
+
+    if pendientes:
+        encontrados = _consultar_lote(select, tabla, campos, pendientes)
+        resultados.update(cachear_lote(cache, pendientes, encontrados))
+
+    return [resultados[norm] for norm in normalizadas]
+
+def _solo_conocidas(claves, buscar):
+    """
+    Pasa a `buscar` sólo las claves de máquinas existentes; las demás
+    resultan vacías sin tocar la caché ni Postgres. Respeta el orden.
+    """
+    existe = [maquinas.existe(c[0], c[1]) for c in claves]
+    filas = iter(buscar([c for c, ok in zip(claves, existe) if ok]) if any(existe) else ())
+    return [next(filas) if ok else [] for ok in existe]
+
+@medir_fase("query_codigo")
+def resolver_codigos(claves):
+    """
+    claves: (model, serial3, cid, fmi) de una o varias máquinas.
+    Snapshot si está activo; si no caché + una sola consulta para lo que falte.
+    """
+    return _solo_conocidas(claves, lambda conocidas: (
+        catalogo.buscar("codigos", conocidas) if catalogo.listo else _resolver_lote(
+            cache_codigos, "description, causes, url", "codigos_falla", ("cid", "fmi"), conocidas
+        )
+    ))
+
+@medir_fase("query_evento")
+def resolver_eventos(claves):
+    """claves: (model, serial3, eid, level) de una o varias máquinas."""
+    return _solo_conocidas(claves, lambda conocidas: (
+        catalogo.buscar("eventos", conocidas) if catalogo.listo else _resolver_lote(
+            cache_eventos, "warning_description, url_main", "eventos", ("eid", "level"), conocidas
+        )
+    ))
+
+def query_codigos_lote(model, serial3, pares):
+    """
+    Busca varios (cid, fmi) del mismo modelo/serie en un solo round trip.
+    Devuelve una lista de filas por cada par, en el mismo orden de `pares`.
+    """
+    return resolver_codigos([(model, serial3, cid, fmi) for cid, fmi in pares])
+
 def query_codigo(model, serial3, cid, fmi):
-    sql = """
-        SELECT description, causes, url
-        FROM codigos_falla
-        WHERE model = %s
-          AND LEFT(serial, 3) = %s
-          AND cid = %s
-          AND fmi = %s
-    """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(sql, (model, serial3, cid, fmi))
-    rows = [dict(zip([c[0] for c in cur.description], r)) for r in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return rows
+    return query_codigos_lote(model, serial3, [(cid, fmi)])[0]
+
+def query_eventos_lote(model, serial3, pares):
+    """
+    Busca varios (eid, level) del mismo modelo/serie en un solo round trip.
+    Devuelve una lista de filas por cada par, en el mismo orden de `pares`.
+    """
+    return resolver_eventos([(model, serial3, eid, level) for eid, level in pares])
 
 def query_evento(model, serial3, eid, level):
+    return query_eventos_lote(model, serial3, [(eid, level)])[0]
+
+# ---------- Búsquedas en paralelo con plazo ----------
+# Cuando las claves no van en una sola consulta (otra máquina, lotes muy
+# grandes, códigos y eventos a la vez) cada lote corre en un hilo con su
+# propia conexión del pool. El mensaje espera como máximo BUSQUEDA_PLAZO
+# segundos en total: lo que no llegó vuelve como PENDIENTE.
+#
+# Un lote que ya empezó sigue en segundo plano llenando la caché; el
+# reintento de una clave que todavía está en vuelo se engancha a ese mismo
+# lote en vez de encolar otra consulta, y es instantáneo recién cuando el
+# lote terminó. Un lote que vence sin haber empezado y que nadie más espera
+# se cancela. La cola admite como máximo BUSQUEDA_COLA_MAX lotes sin
+# empezar: con la base lenta, lo que no entra vuelve PENDIENTE de una vez
+# en lugar de apilar consultas que nadie va a leer.
+BUSQUEDA_PLAZO = float(os.environ.get("BUSQUEDA_PLAZO", "3"))
+BUSQUEDA_HILOS = int(os.environ.get("BUSQUEDA_HILOS", os.environ.get("DB_POOL_MAX", "5")))
+BUSQUEDA_LOTE = int(os.environ.get("BUSQUEDA_LOTE", "50"))   # claves por consulta
+BUSQUEDA_COLA_MAX = int(os.environ.get("BUSQUEDA_COLA_MAX", str(BUSQUEDA_HILOS * 4)))
+
+PENDIENTE = "pendiente"   # en lugar de la lista de filas: no terminó a tiempo
+
+RESOLVEDORES = {
+    "codigos": (resolver_codigos, cache_codigos),
+    "eventos": (resolver_eventos, cache_eventos),
+}
+
+class EjecutorBusquedas:
+
+    def __init__(self, hilos, cola_max=BUSQUEDA_COLA_MAX):
+        self.hilos = hilos
+        self.cola_max = cola_max
+        self._ejecutor = None
+        self._pid = None
+        # Reentrante: cancelar un futuro corre _terminado en el mismo hilo
+        self._lock = threading.RLock()
+        self._reiniciar_estado()
+
+    def _reiniciar_estado(self):
+        self._en_vuelo = {}       # (nombre, clave) -> (futuro, posición en su lote)
+        self._interesados = {}    # futuro -> mensajes que todavía lo esperan
+        self._en_cola = 0         # lotes enviados que aún no empezaron
+        self.vencidas = 0
+        self.rechazadas = 0
+        self.canceladas = 0
+        self.enganchadas = 0
+
+    def _pool(self):
+        # Los hilos no sobreviven a un fork: un ejecutor (y su estado) por proceso
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._ejecutor = ThreadPoolExecutor(
+                        max_workers=self.hilos, thread_name_prefix="busquedas"
+                    )
+                    self._reiniciar_estado()
+                    self._pid = os.getpid()
+        return self._ejecutor
+
+    @staticmethod
+    def _en_memoria(nombre, claves):
+        return (catalogo.listo or not maquinas.existe(*claves[0][:2])
+                or not pendientes_en_cache(RESOLVEDORES[nombre][1], claves))
+
+    def _enviar(self, ejecutor, nombre, lote):
+        """Encola un lote (con el lock tomado). None si la cola está llena."""
+        if self._en_cola >= self.cola_max:
+            self.rechazadas += 1
+            return None
+        funcion = RESOLVEDORES[nombre][0]
+
+        def tarea():
+            with self._lock:
+                self._en_cola -= 1
+            return funcion(lote)
+
+        futuro = ejecutor.submit(tarea)
+        self._en_cola += 1
+        self._interesados[futuro] = 0
+        for pos, clave in enumerate(lote):
+            self._en_vuelo[(nombre, tuple(clave))] = (futuro, pos)
+        futuro.add_done_callback(lambda f: self._terminado(f, nombre, lote))
+        return futuro
+
+    def _terminado(self, futuro, nombre, lote):
+        with self._lock:
+            for clave in lote:
+                llave = (nombre, tuple(clave))
+                if self._en_vuelo.get(llave, (None,))[0] is futuro:
+                    del self._en_vuelo[llave]
+            self._interesados.pop(futuro, None)
+
+    def _abandonar(self, futuro):
+        """Un mensaje dejó de esperar el lote; sin nadie más y sin empezar, se cancela."""
+        with self._lock:
+            if futuro not in self._interesados:
+                return
+            self._interesados[futuro] -= 1
+            if self._interesados[futuro] > 0 or not futuro.cancel():
+                return
+            self._en_cola -= 1
+            self.canceladas += 1
+
+    def resolver(self, pedidos, plazo=BUSQUEDA_PLAZO):
+        """
+        pedidos: {nombre: [(model, serial3, a, b), ...]}.
+        Devuelve {nombre: [filas | PENDIENTE por clave]}, en el mismo orden.
+        """
+        limite = time.monotonic() + plazo
+        salida = {nombre: [None] * len(claves) for nombre, claves in pedidos.items()}
+        esperas = []    # (nombre, índice, futuro, posición en su lote)
+        futuros = set()
+        ejecutor = None
+
+        for nombre, claves in pedidos.items():
+            funcion = RESOLVEDORES[nombre][0]
+            grupos = {}
+            for i, clave in enumerate(claves):
+                grupos.setdefault(tuple(clave[:2]), []).append(i)
+            for indices in grupos.values():
+                for inicio in range(0, len(indices), BUSQUEDA_LOTE):
+                    parte = indices[inicio:inicio + BUSQUEDA_LOTE]
+                    lote = [claves[i] for i in parte]
+                    if self._en_memoria(nombre, lote):
+                        for i, filas in zip(parte, funcion(lote)):
+                            salida[nombre][i] = filas
+                        continue
+                    ejecutor = ejecutor or self._pool()
+                    with self._lock:
+                        nuevas = []
+                        for i in parte:
+                            en_vuelo = self._en_vuelo.get((nombre, tuple(claves[i])))
+                            if en_vuelo and not en_vuelo[0].done():
+                                self.enganchadas += 1
+                                esperas.append((nombre, i) + en_vuelo)
+                            else:
+                                nuevas.append(i)
+                        if nuevas:
+                            futuro = self._enviar(ejecutor, nombre, [claves[i] for i in nuevas])
+                            for pos, i in enumerate(nuevas):
+                                if futuro is None:
+                                    salida[nombre][i] = PENDIENTE
+                                else:
+                                    esperas.append((nombre, i, futuro, pos))
+                        # El interés se anota bajo el mismo lock que el enganche:
+                        # otro mensaje que abandona no puede cancelar el lote en medio
+                        for futuro in {e[2] for e in esperas} - futuros:
+                            futuros.add(futuro)
+                            if futuro in self._interesados:
+                                self._interesados[futuro] += 1
+
+        if futuros:
+            listos, vencidos = wait(futuros, timeout=max(0.0, limite - time.monotonic()))
+            for nombre, i, futuro, pos in esperas:
+                if futuro in listos and not futuro.cancelled():
+                    salida[nombre][i] = futuro.result()[pos]
+                else:
+                    salida[nombre][i] = PENDIENTE
+            with self._lock:
+                self.vencidas += len(vencidos)
+            for futuro in vencidos:
+                self._abandonar(futuro)
+        return salida
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "hilos": self.hilos, "plazo": BUSQUEDA_PLAZO, "cola_max": self.cola_max,
+                "en_cola": self._en_cola, "en_vuelo": len(self._interesados),
+                "vencidas": self.vencidas, "rechazadas": self.rechazadas,
+                "canceladas": self.canceladas, "enganchadas": self.enganchadas,
+            }
+
+
+busquedas = EjecutorBusquedas(BUSQUEDA_HILOS)
+
+def resolver_fragmentos(model, serial3, fragmentos, plazo=BUSQUEDA_PLAZO):
+    """
+    Resuelve códigos y eventos mezclados (salida de tokenizar) en paralelo y
+    con un plazo total. Por cada fragmento, en el mismo orden, devuelve la
+    fila encontrada, None (no existe / inválido) o PENDIENTE.
+    """
+    maquina = (model, serial3)
+    pedidos = {
+        "codigos": [maquina + (f.cid, f.fmi) for f in fragmentos if f.tipo == "codigo"],
+        "eventos": [maquina + (f.eid, f.level) for f in fragmentos if f.tipo == "evento"],
+    }
+    resueltas = busquedas.resolver({n: c for n, c in pedidos.items() if c}, plazo)
+    filas = {
+        "codigo": iter(resueltas.get("codigos", ())),
+        "evento": iter(resueltas.get("eventos", ())),
+    }
+    resultado = []
+    for f in fragmentos:
+        encontradas = next(filas[f.tipo]) if f.tipo in filas else None
+        if encontradas is PENDIENTE:
+            resultado.append(PENDIENTE)
+        else:
+            resultado.append(encontradas[0] if encontradas else None)
+    return resultado
+
+# ---------- Filas -> ítems del reporte PDF ----------
+def item_codigo(raw, cid, fmi, fila):
+    return {
+        "raw": raw,
+        "cid": cid,
+        "fmi": fmi,
+        "descripcion": fila["description"] or "Sin descripción.",
+        "causas": fila["causes"] or "Sin causas.",
+        "url": fila["url"] or ""
+    }
+
+def item_evento(raw, eid, level, fila):
+    return {
+        "raw": raw,
+        "eid": eid,
+        "level": level,
+        "descripcion": fila["warning_description"] or "Sin descripción.",
+        "url": fila["url_main"] or ""
+    }
+
+# ============================================================
+#  SUGERENCIAS "¿QUISISTE DECIR?"
+# ============================================================
+# Cuando una clave no existe se buscan las más parecidas entre las claves
+# válidas de la misma máquina. El índice por (tabla, model, serial3) sale
+# del snapshot si está listo o de una consulta por igualdad que usa el
+# índice compuesto; nunca se hace un LIKE sobre Postgres.
+SUGERENCIAS_MAX = int(os.environ.get("SUGERENCIAS_MAX", "3"))
+SUGERENCIAS_DISTANCIA = int(os.environ.get("SUGERENCIAS_DISTANCIA", "1"))
+
+
+def _distancia(a, b, tope):
+    """
+    Distancia de edición con transposición de vecinos (168 <-> 186 = 1).
+    Corta en cuanto supera `tope` y devuelve tope + 1.
+    """
+    if abs(len(a) - len(b)) > tope:
+        return tope + 1
+    anterior2 = None
+    anterior = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        actual = [i] + [0] * len(b)
+        minimo = i
+        for j in range(1, len(b) + 1):
+            costo = a[i - 1] != b[j - 1]
+            v = min(anterior[j] + 1, actual[j - 1] + 1, anterior[j - 1] + costo)
+            if (costo and i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                    and a[i - 2] == b[j - 1]):
+                v = min(v, anterior2[j - 2] + 1)
+            actual[j] = v
+            if v < minimo:
+                minimo = v
+        if minimo > tope:
+            return tope + 1
+        anterior2, anterior = anterior, actual
+    return anterior[-1]
+
+
+def _borrados(texto, tope):
+    """El texto y todas sus variantes con hasta `tope` caracteres borrados."""
+    variantes = {texto}
+    frontera = {texto}
+    for _ in range(tope):
+        frontera = {v[:i] + v[i + 1:] for v in frontera for i in range(len(v))}
+        variantes |= frontera
+    return variantes
+
+
+class IndiceClaves:
+    """
+    Claves válidas de una máquina ("168-4", "E0117(2)") indexadas por sus
+    variantes con borrados: dos textos a distancia <= tope comparten alguna.
+    Así una búsqueda genera unas pocas decenas de variantes de la entrada
+    y sólo mide la distancia contra las claves que coinciden, en vez de
+    recorrer todas.
+    """
+
+    __slots__ = ("tope", "variantes", "total")
+
+    def __init__(self, claves, tope=SUGERENCIAS_DISTANCIA):
+        self.tope = tope
+        variantes = {}
+        unicas = set(claves)
+        for clave in unicas:
+            for v in _borrados(clave, tope):
+                variantes.setdefault(v, []).append(clave)
+        self.variantes = variantes
+        self.total = len(unicas)
+
+    def __len__(self):
+        # Un índice vacío (máquina desconocida) se cachea con el TTL negativo
+        return self.total
+
+    def parecidas(self, texto, maximo=SUGERENCIAS_MAX):
+        candidatas = set()
+        for v in _borrados(texto, self.tope):
+            candidatas.update(self.variantes.get(v, ()))
+        puntuadas = sorted(
+            (d, clave) for clave in candidatas
+            if (d := _distancia(texto, clave, self.tope)) <= self.tope
+        )
+        return [clave for _, clave in puntuadas[:maximo]]
+
+
+def _clave_texto(nombre, a, b):
+    return f"{a}-{b}" if nombre == "codigos" else f"{a}({b})"
+
+
+indices_sugerencias = CacheTTL(
+    max_items=int(os.environ.get("SUGERENCIAS_MAQUINAS", "500")),
+    ttl=float(os.environ.get("CACHE_TTL", "3600")),
+    ttl_negativo=float(os.environ.get("CACHE_TTL_NEGATIVO", "300")),
+)
+generaciones_cache.registrar("sugerencias", indices_sugerencias)
+
+
+def sql_claves_maquina(nombre, marcador="%s"):
+    tabla, campos, _ = CatalogoSnapshot.TABLAS[nombre]
+    p1, p2 = ("$1", "$2") if marcador == "$" else ("%s", "%s")
+    return (
+        f"SELECT DISTINCT {campos[0]} AS a, {campos[1]} AS b FROM {tabla} "
+        f"WHERE model = {p1} AND serial3 = {p2}"
+    )
+
+def guardar_indice(nombre, model, serial3, filas):
+    """Arma y cachea el IndiceClaves de una máquina a partir de filas {a, b}."""
+    indice = IndiceClaves(_clave_texto(nombre, _norm(f["a"]), _norm(f["b"])) for f in filas)
+    indices_sugerencias.guardar((nombre, _norm(model), _norm(serial3)), indice)
+    return indice
+
+def indice_claves(nombre, model, serial3):
+    """IndiceClaves de la tabla `nombre` ("codigos"/"eventos") para una máquina."""
+    maquina = (_norm(model), _norm(serial3))
+    indice = indices_sugerencias.obtener((nombre,) + maquina)
+    if indice is not None:
+        return indice
+
+    if not maquinas.existe(model, serial3):
+        filas = []
+    elif catalogo.listo:
+        filas = [
+            {"a": a, "b": b}
+            for (m, s3, a, b) in catalogo.indices[nombre] if (m, s3) == maquina
+        ]
+    else:
+        filas = ejecutar_consulta(sql_claves_maquina(nombre), (model, serial3))
+    return guardar_indice(nombre, model, serial3, filas)
+
+
+def sugerencias(model, serial3, fragmento):
+    """Claves parecidas a un código/evento que no se encontró (puede ser [])."""
+    if fragmento.tipo == "codigo":
+        nombre, texto = "codigos", _clave_texto("codigos", _norm(fragmento.cid), _norm(fragmento.fmi))
+    elif fragmento.tipo == "evento":
+        nombre, texto = "eventos", _clave_texto("eventos", _norm(fragmento.eid), fragmento.level)
+    else:
+        return []
+    try:
+        return indice_claves(nombre, model, serial3).parecidas(texto)
+    except Exception:
+        app.logger.exception("No se pudieron calcular sugerencias")
+        return []
+
+# ============================================================
+#  MIGRACIONES E ÍNDICES
+# ============================================================
+MIGRACIONES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Columnas que deben encabezar algún índice para que las búsquedas no escaneen
+INDICES_REQUERIDOS = {
+    "codigos_falla": ("model", "serial3", "cid", "fmi"),
+    "eventos": ("model", "serial3", "eid", "level"),
+}
+
+def _sentencias_sql(texto):
+    """Separa un archivo .sql en sentencias (sin comentarios de línea)."""
+    lineas = [l for l in texto.splitlines() if not l.strip().startswith("--")]
+    return [s.strip() for s in "\n".join(lineas).split(";") if s.strip()]
+
+def aplicar_migraciones():
+    """Aplica en orden los .sql de migrations/ que aún no estén registrados."""
+    aplicadas = []
+    with pool.conexion() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS schema_migraciones ("
+            " nombre text PRIMARY KEY,"
+            " aplicada_en timestamptz NOT NULL DEFAULT now())"
+        )
+        cur.execute("SELECT nombre FROM schema_migraciones")
+        hechas = {r[0] for r in cur.fetchall()}
+        conn.commit()
+
+        for nombre in sorted(os.listdir(MIGRACIONES_DIR)):
+            if not nombre.endswith(".sql") or nombre in hechas:
+                continue
+            with open(os.path.join(MIGRACIONES_DIR, nombre), encoding="utf-8") as f:
+                sentencias = _sentencias_sql(f.read())
+            try:
+                for sentencia in sentencias:
+                    cur.execute(sentencia)
+                cur.execute("INSERT INTO schema_migraciones (nombre) VALUES (%s)", (nombre,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            aplicadas.append(nombre)
+        cur.close()
+    return aplicadas
+
+def indices_faltantes():
+    """Tablas cuyo índice compuesto de búsqueda no existe."""
     sql = """
-        SELECT warning_description, url_main
-        FROM eventos
-        WHERE model = %s
-          AND LEFT(serial, 3) = %s
-          AND eid = %s
-          AND level = %s
-    """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(sql, (model, serial3, eid, level))
-    rows = [dict(zip([c[0] for c in cur.description], r)) for r in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return rows
+        SELECT t.relname AS tabla,
+               array_agg(a.attname::text ORDER BY k.ord) AS columnas
+        FROM pg_index i
+        JOIN pg_class t ON t.oid = i.indrelid
+        CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+        JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+        WHERE t.relname::text = ANY(%s)
+        GROUP BY i.indexrelid, t.relname
+    """
+    filas = ejecutar_consulta(sql, (list(INDICES_REQUERIDOS),))
+    faltan = []
+    for tabla, columnas in INDICES_REQUERIDOS.items():
+        n = len(columnas)
+        if not any(f["tabla"] == tabla and tuple(f["columnas"][:n]) == columnas for f in filas):
+            faltan.append(tabla)
+    return faltan
+
+class EsquemaDesactualizado(RuntimeError):
+    pass
+
+def columnas_faltantes():
+    """Tablas de búsqueda que todavía no tienen la columna serial3 (migración 001)."""
+    filas = ejecutar_consulta(
+        "SELECT table_name AS tabla FROM information_schema.columns "
+        "WHERE column_name = 'serial3' AND table_name = ANY(%s)",
+        (list(INDICES_REQUERIDOS),)
+    )
+    con_columna = {f["tabla"] for f in filas}
+    return [t for t in INDICES_REQUERIDOS if t not in con_columna]
+
+def verificar_esquema():
+    """
+    Se llama al arrancar (gunicorn on_starting, lifespan ASGI, `flask verificar`),
+    no al importar. Sin la columna serial3 ninguna búsqueda funcionaría:
+    se niega a arrancar. Sin los índices solo se advierte. Devuelve si
+    pudo verificar.
+    """
+    if not os.environ.get("DATABASE_URL"):
+        return False
+    try:
+        sin_columna = columnas_faltantes()
+        faltan = indices_faltantes()
+    except (pg8000.InterfaceError, OSError) as e:
+        # Base caída al arrancar: no es un problema de esquema
+        app.logger.warning("No se pudo verificar el esquema de búsqueda: %s", e)
+        return False
+    finally:
+        # Puede correr en el proceso maestro: no dejar conexiones abiertas
+        pool.cerrar_todas()
+    if sin_columna:
+        raise EsquemaDesactualizado(
+            f"Falta la columna serial3 en {', '.join(sin_columna)}. "
+            "Ejecuta `flask --app app migrar` antes de arrancar."
+        )
+    for tabla in faltan:
+        app.logger.warning(
+            "Falta el índice (%s) en %s: las búsquedas harán scan. "
+            "Ejecuta `flask --app app migrar`.",
+            ", ".join(INDICES_REQUERIDOS[tabla]), tabla
+        )
+    return True
+
+@app.cli.command("verificar")
+def verificar_cmd():
+    """Comprueba el parche del motor PDF y que la base tenga las migraciones."""
+    try:
+        verificar_parche_pdf()
+    except ParchePDFRoto as e:
+        raise click.ClickException(f"Motor PDF: {e}")
+    print("Motor PDF OK")
+    if not os.environ.get("DATABASE_URL"):
+        print("Esquema: sin DATABASE_URL, no se verificó")
+        return
+    try:
+        verificado = verificar_esquema()
+    except EsquemaDesactualizado as e:
+        raise click.ClickException(str(e))
+    if not verificado:
+        raise click.ClickException("DATABASE_URL no responde.")
+    print("Esquema OK")
+
+@app.cli.command("migrar")
+def migrar_cmd():
+    """Aplica las migraciones pendientes de migrations/."""
+    aplicadas = aplicar_migraciones()
+    print("Migraciones aplicadas: " + (", ".join(aplicadas) or "ninguna"))
+
+if SNAPSHOT_ACTIVO and os.environ.get("DATABASE_URL"):
+    # Con gunicorn --preload se carga una vez en el maestro y los workers
+    # lo heredan; sin preload cada worker lo carga al importar.
+    catalogo.cargar(forzar=True)
+    pool.cerrar_todas()
 
 # ============================================================
 # CONTACTOS PARA PDF
@@ -590,492 +2182,1734 @@ CONTACTOS_SOPORTE = [
 # ============================================================
 #  GENERAR PDF (XHTML2PDF)
 # ============================================================
-def generar_pdf(html_string):
-    pdf_bytes = BytesIO()
-    pisa.CreatePDF(html_string, dest=pdf_bytes)
-    return pdf_bytes.getvalue()
+# xhtml2pdf vuelve a parsear su CSS por defecto (varios KB) y el <style>
+# del template en cada documento, y luego para cada (elemento, atributo)
+# recorre TODAS las reglas. Como ambos textos son siempre los mismos, el
+# contexto de abajo guarda por proceso las hojas ya parseadas e indexadas
+# por atributo, y sólo crea el parser liviano que necesita cada documento
+# (estilos inline).
+_CSS_PARSEADO = {}   # (cssText, cssDefaultText) -> (css, cssDefault)
+
+def _indice_css(ruleset):
+    """
+    Reglas de una hoja agrupadas por atributo y ordenadas por especificidad.
+    El índice vive en el propio ruleset: se libera con él y no se confunde
+    con otro objeto que reutilice su id().
+    """
+    indice = getattr(ruleset, "indice_por_atributo", None)
+    if indice is None:
+        indice = {}
+        for selector, declaraciones in ruleset.items():
+            for atributo in declaraciones:
+                indice.setdefault(atributo, []).append((selector, declaraciones))
+        for reglas in indice.values():
+            reglas.sort()
+        ruleset.indice_por_atributo = indice
+    return indice
+
+def _regla_indexada(ruleset, elemento, atributo):
+    # Igual que ruleset.findCSSRuleFor() pero sin recorrer todas las reglas
+    for regla in reversed(_indice_css(ruleset).get(atributo, ())):
+        if regla[0].matches(elemento):
+            return [regla]
+    return []
+
+class CascadaCSS(pisa_css.CSSCascadeStrategy):
+    """
+    Cascada sobre hojas precompiladas: por cada (elemento, atributo) sólo
+    se evalúan los selectores que declaran ese atributo. Guarda sus propias
+    referencias a las hojas en vez de leer los atributos de xhtml2pdf
+    (el del user agent se llama "userAgenr").
+    """
 
-# ============================================================
-#  RUTA PRINCIPAL
-# ============================================================
-@app.route("/")
-def home():
-    return render_template("index.html")
+    def __init__(self, author=None, user=None, userAgent=None):
+        super().__init__(author, user, userAgent)
+        self.hojas_autor = author
+        self.hojas_usuario = user
+        self.hojas_agente = userAgent
 
-# ============================================================
-#  RUTA PDF DIRECTO
-# ============================================================
-@app.route("/generar_reporte", methods=["POST"])
-def generar_reporte():
-    data = request.get_json()
+    def findCSSRulesFor(self, element, attrName):
+        rules = []
+        inline = element.getInlineStyle()
 
-    html = render_template(
-        "reporte_diagnostico.html",
-        modelo=data.get("modelo"),
-        serie=data.get("serie"),
-        codigos=data.get("codigos", []),
-        eventos=data.get("eventos", []),
-        contactos=CONTACTOS_SOPORTE,
-        now=datetime.now().strftime("%Y-%m-%d %H:%M")
-    )
+        if self.hojas_agente is not None:
+            rules += _regla_indexada(self.hojas_agente[0], element, attrName)
+            rules += _regla_indexada(self.hojas_agente[1], element, attrName)
 
-    pdf_bytes = generar_pdf(html)
+        if self.hojas_usuario is not None:
+            rules += _regla_indexada(self.hojas_usuario[0], element, attrName)
 
-    return Response(
-        pdf_bytes,
-        mimetype="application/pdf",
-        headers={"Content-Disposition": "attachment; filename=FerreyDoc_Reporte.pdf"}
-    )
+        if self.hojas_autor is not None:
+            rules += self.hojas_autor[0].findCSSRuleFor(element, attrName)
+            rules += self.hojas_autor[1].findCSSRuleFor(element, attrName)
 
-# ============================================================
-#  CHATBOT PRINCIPAL
-# ============================================================
-@app.route("/enviar", methods=["POST"])
-def enviar():
+        if inline:
+            rules += inline[0].findCSSRuleFor(element, attrName)
+            rules += inline[1].findCSSRuleFor(element, attrName)
 
-    data = request.get_json()
-    mensaje = data.get("mensaje", "").strip()
-    user_id = "usuario_unico"
-
-    ses = obtener_sesion(user_id)
-    estado = ses["estado"]
-
-    # -------- Función responder() interna --------
-    def responder(texto, extra=None):
-        texto = f"<div style='max-width:100%; word-wrap:break-word;'>{texto}</div>"
-        payload = {"respuesta": texto}
-        if extra:
-            payload.update(extra)
-        return jsonify(payload)
-
-    # ========= RESET GLOBAL CON "hola" =========
-    if mensaje.lower() == "hola":
-        resetear_sesion(user_id)
-        ses = obtener_sesion(user_id)
-        ses["estado"] = "esperando_consentimiento"
-        return responder(
-            "👋 ¡Hola, soy <b>FerreyDoc</b>, tu asistente técnico CAT.<br><br>"
-            "Estoy diseñado para orientarte respecto a Códigos y Eventos<br>"
-            "Además puedo brindarte consejos acerca del Mantenimiento de tu Equipo<br>"
-            "Antes de comenzar necesitaré unos datos<br>"
-            "¿Estás de acuerdo con brindar información sobre tu equipo CAT?<br>"
-            "1️⃣ Sí<br>2️⃣ No"
-        )
+        if self.hojas_usuario is not None:
+            rules += _regla_indexada(self.hojas_usuario[1], element, attrName)
 
-    # ===================== BIENVENIDA =====================
-    if estado == "inicio":
-        ses["estado"] = "esperando_consentimiento"
-        return responder(
-            "👋 ¡Hola, soy <b>FerreyDoc</b>, tu asistente técnico CAT.<br><br>"
-            "Estoy diseñado para orientarte respecto a Códigos y Eventos<br>"
-            "Además puedo brindarte consejos acerca del Mantenimiento de tu Equipo<br>"
-            "Antes de comenzar necesitaré unos datos<br>"
-            "¿Estás de acuerdo con brindar información sobre tu equipo CAT?<br>"
-            "1️⃣ Sí<br>2️⃣ No"
-        )
+        rules.sort()
+        return rules
 
-    # ================= CONSENTIMIENTO =====================
-    if estado == "esperando_consentimiento":
-        if mensaje == "1":
-            ses["estado"] = "pidiendo_modelo"
-            return responder("Perfecto 🙌<br>Ingresa el <b>MODELO</b> (ej: 950H, 320D).")
-
-        if mensaje == "2":
-            resetear_sesion(user_id)
-            return responder("Ok 👍<br>Escribe <b>hola</b> si deseas volver.")
-
-        return responder("Debes responder 1 o 2.")
-
-    # ===================== MODELO =====================
-    if estado == "pidiendo_modelo":
-        ses["model"] = mensaje.upper()
-        ses["estado"] = "pidiendo_serie"
-        return responder(
-            f"Modelo registrado: <b>{ses['model']}</b><br>"
-            "Ahora ingresa los <b>primeros 3 dígitos</b> de la serie."
-        )
 
-    # ===================== SERIE ======================
-    if estado == "pidiendo_serie":
-        ses["serial3"] = mensaje[:3].upper()
-        ses["estado"] = "menu_principal"
-        return responder(
-            f"✔ Modelo: <b>{ses['model']}</b><br>"
-            f"✔ Serie: <b>{ses['serial3']}</b><br><br>"
-            "A continuación, escribe el número de la consulta que deseas realizar:<br>"
-            "1️⃣ Códigos<br>"
-            "2️⃣ Eventos<br>"
-            "3️⃣ Consejos de Mantenimiento Preventivo<br>"
-            "4️⃣ ¿Cómo diferencio un Código de un Evento?<br>"
-            "5️⃣ Cambiar máquina<br>"
-            "6️⃣ Finalizar<br>"
-        )
+class ContextoPDF(pisaContext):
+    """pisaContext que reutiliza las hojas de estilo ya parseadas."""
 
-    # ==================== MENU PRINCIPAL ====================
-    if estado == "menu_principal":
+    def parseCSS(self):
+        clave = (self.cssText, self.cssDefaultText)
+        hojas = _CSS_PARSEADO.get(clave)
+        # @page / @font-face registran cosas en el contexto al parsear:
+        # esos documentos siguen el camino normal y no se guardan
+        if hojas is None or "@page" in self.cssText or "@font-face" in self.cssText:
+            super().parseCSS()
+            if "@page" not in self.cssText and "@font-face" not in self.cssText:
+                _CSS_PARSEADO[clave] = (self.css, self.cssDefault)
+            self.cssCascade = CascadaCSS(userAgent=self.cssDefault, user=self.css)
+            self.cssCascade.parser = self.cssParser
+            return
 
-        if mensaje == "1":
-            ses["estado"] = "pidiendo_codigos"
-            return responder(
-                "Por favor escribe el código CID/FMI del que necesitas información. "
-                "Puedes ingresar hasta 5 códigos separados por coma.<br>"
-                "Ej: 168-4"
-            )
+        self.cssBuilder = pisaCSSBuilder(mediumSet=["all", "print", "pdf"])
+        self.cssBuilder._c = weakref.ref(self)
+        self.cssParser = pisaCSSParser(self.cssBuilder)
+        self.cssParser.rootPath = self.pathDirectory
+        self.cssParser._c = weakref.ref(self)
 
-        if mensaje == "2":
-            ses["estado"] = "pidiendo_eventos"
-            return responder(
-                "Por favor escribe el evento EID/Level del que necesitas información. "
-                "Puedes ingresar hasta 5 eventos separados por coma.<br>"
-                "Formato obligatorio: <b>E####(L)</b> con L = 1, 2 o 3.<br>"
-                "Ej: E0117(2)"
-            )
+        self.css, self.cssDefault = hojas
+        self.cssCascade = CascadaCSS(userAgent=self.cssDefault, user=self.css)
+        self.cssCascade.parser = self.cssParser
 
-        if mensaje == "3":
-            ses["estado"] = "mant_elegir_maquina"
-            return responder(
-                "Selecciona el tipo de maquinaria:<br>"
-                "1️⃣ Rodillo<br>"
-                "2️⃣ Cargador<br>"
-                "3️⃣ Excavadora<br>"
-                "4️⃣ Tractor<br>"
-                "9️⃣ Volver"
-            )
 
-        if mensaje == "4":
-            ses["estado"] = "explicando_cod_evento"
-            return responder(
-                "<b>¿Cuál es la diferencia entre un Código y un Evento?</b><br><br>"
-                "<b>🔧 Código (CID/FMI):</b><br>"
-                "• Formato: <b>XXXX-Y</b>.<br>"
-                "• Ejemplo: <b>4651-9</b>.<br>"
-                "• Describe una <u>falla mecánica o eléctrica puntual</u>.<br><br>"
-                "<b>📘 Evento (EID/Level):</b><br>"
-                "• Formato: <b>E#####(L)</b>.<br>"
-                "• Ejemplo: <b>E60104(2)</b>.<br>"
-                "• Describe una <u>condición operativa o mal uso detectado</u>.<br><br>"
-                "Aquí tienes un ejemplo real sobre cómo aparece en pantalla:<br><br>"
-                "Escribe <b>1</b> para volver al menú principal.",
-                extra={"imagen": "/static/ejemplos/codigos_eventos.jpeg"}
-            )
+# pisaDocument crea su propio contexto y no permite inyectarlo
+pisa_document.pisaContext = ContextoPDF
 
-        if mensaje == "5":
-            resetear_sesion(user_id)
-            return responder("Ingresa el nuevo <b>MODELO</b>.")
-
-        if mensaje == "6":
-            resetear_sesion(user_id)
-            return responder("Gracias por usar FerreyDoc 🤝")
-
-        # ============= GENERAR PDF =============
-        if mensaje == "7":
-
-            html = render_template(
-                "reporte_diagnostico.html",
-                modelo=ses.get("model") or "N/D",
-                serie=ses.get("serial3") or "N/D",
-                codigos=ses.get("reporte_codigos", []),
-                eventos=ses.get("reporte_eventos", []),
-                contactos=CONTACTOS_SOPORTE,
-                now=datetime.now().strftime("%Y-%m-%d %H:%M")
-            )
+class ParchePDFRoto(RuntimeError):
+    pass
 
-            pdf_bytes = generar_pdf(html)
-            pdf_b64 = base64.b64encode(pdf_bytes).decode("utf-8")
+def verificar_parche_pdf():
+    """
+    Comprueba que ContextoPDF/CascadaCSS siguen enganchados a xhtml2pdf
+    (requirements.txt lo fija a una versión exacta). Corre al calentar el
+    motor y en `flask --app app verificar`: si una actualización cambia
+    lo que se parchea, el arranque falla en vez de degradar en silencio.
+    """
+    if "pisaContext" not in pisa_document.pisaDocument.__code__.co_names:
+        raise ParchePDFRoto("xhtml2pdf.document.pisaDocument ya no usa pisaContext")
+    # Mismo orden de cascada que el de xhtml2pdf (iterCSSRulesets)
+    autor, usuario, agente, inline = (
+        (pisa_css.CSSRuleset(), pisa_css.CSSRuleset()) for _ in range(4)
+    )
+    cascada = CascadaCSS(author=autor, user=usuario, userAgent=agente)
+    esperado = [agente[0], agente[1], usuario[0], autor[0], autor[1], inline[0], inline[1], usuario[1]]
+    if [id(h) for h in cascada.iterCSSRulesets(inline)] != [id(h) for h in esperado]:
+        raise ParchePDFRoto("cambió el orden de la cascada CSS de xhtml2pdf")
+    contexto = pisa.CreatePDF(_HTML_CALENTAMIENTO, dest=BytesIO())
+    if not isinstance(contexto, ContextoPDF) or not isinstance(contexto.cssCascade, CascadaCSS):
+        raise ParchePDFRoto("xhtml2pdf no está usando ContextoPDF/CascadaCSS")
+    if contexto.err:
+        raise ParchePDFRoto(f"el motor parcheado falló al renderizar ({contexto.err} errores)")
 
-            # Resetear historial tras generar reporte
-            ses["reporte_codigos"] = []
-            ses["reporte_eventos"] = []
+def generar_pdf(html_string):
+    pdf_bytes = BytesIO()
+    pisa.CreatePDF(html_string, dest=pdf_bytes)
+    return pdf_bytes.getvalue()
 
-            return responder(
-                "📄 Tu reporte PDF está listo para descargar.",
-                {"pdf_base64": pdf_b64, "filename": "FerreyDoc_Reporte.pdf"}
-            )
+_motor_caliente = False
 
-        return responder("Elige una opción válida (1–7).")
-
-    # ========== EXPLICACIÓN CÓDIGO vs EVENTO ==========
-    if estado == "explicando_cod_evento":
-        if mensaje == "1":
-            ses["estado"] = "menu_principal"
-            return responder(
-                "¿Qué deseas hacer?<br>"
-                "1️⃣ Códigos<br>"
-                "2️⃣ Eventos<br>"
-                "3️⃣ Consejos de Mantenimiento Preventivo<br>"
-                "4️⃣ ¿Cómo diferencio un Código de un Evento?<br>"
-                "5️⃣ Cambiar máquina<br>"
-                "6️⃣ Finalizar<br>"
-                "7️⃣ Generar reporte PDF<br>"
-            )
-        return responder(
-            "Si ya revisaste el ejemplo, escribe <b>1</b> para volver al menú principal."
+def precalentar_motor_pdf(html=None):
+    """
+    Deja listo el motor en este proceso: CSS parseado y métricas de fuentes
+    de reportlab cargadas. Se llama al arrancar cada worker (gunicorn
+    post_fork) y en cada proceso del pool de reportes.
+    """
+    global _motor_caliente
+    if _motor_caliente and html is None:
+        return
+    if not _motor_caliente:
+        verificar_parche_pdf()
+    generar_pdf(html or _HTML_CALENTAMIENTO)
+    _motor_caliente = True
+
+def precalentar_reportes():
+    """Calienta con el template real para que el primer reporte ya sea rápido."""
+    with app.app_context():
+        html = html_reporte(
+            "N/D", "N/D",
+            [{"raw": "0-0", "cid": "0", "fmi": "0", "descripcion": "-", "causas": "-", "url": ""}],
+            [{"raw": "E0(1)", "eid": "E0", "level": "1", "descripcion": "-", "url": ""}],
+            datetime.now().strftime("%Y-%m-%d %H:%M")
         )
+    precalentar_motor_pdf(html)
+    # El pool de procesos se crea después: sus hijos heredan el motor caliente
+    cola_reportes.iniciar()
 
-    # ==================== MANTENIMIENTO — ELEGIR MÁQUINA ====================
-    if estado == "mant_elegir_maquina":
+_HTML_CALENTAMIENTO = "<html><body><p>FerreyDoc</p></body></html>"
 
-        if mensaje == "1":
-            ses["mant_maquina"] = "rodillo"
+# ============================================================
+#  REPORTES EN SEGUNDO PLANO (POOL DE PROCESOS)
+# ============================================================
+# El HTML se renderiza en el request (necesita Jinja/Flask) y xhtml2pdf
+# corre en un pool de procesos, así el worker de gunicorn no se bloquea.
+# Los PDFs terminados quedan en REPORTES_DIR, visibles para todos los
+# workers de la máquina:  <id>.pdf (listo), <id>.error, <id>.pendiente.
+REPORTES_DIR = os.environ.get(
+    "REPORTES_DIR", os.path.join(tempfile.gettempdir(), "ferreydoc_reportes")
+)
+REPORTES_WORKERS = int(os.environ.get("REPORTES_WORKERS", "2"))
+REPORTES_COLA_MAX = int(os.environ.get("REPORTES_COLA_MAX", "20"))
+REPORTES_TIMEOUT = float(os.environ.get("REPORTES_TIMEOUT", "60"))
+REPORTES_RETENCION = float(os.environ.get("REPORTES_RETENCION", "3600"))
+
+_ID_REPORTE = re.compile(r"[0-9a-f]{32}")
+
+class ColaLlena(Exception):
+    pass
+
+def _renderizar_a_archivo(html, ruta):
+    """Corre en un proceso del pool: genera el PDF y lo publica con os.replace."""
+    pdf = generar_pdf(html)
+    if os.path.exists(os.path.splitext(ruta)[0] + ".error"):
+        return 0   # se dio por vencido mientras corría: no publicar
+    tmp = ruta + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(pdf)
+    os.replace(tmp, ruta)
+    return len(pdf)
+
+def _ruta_reporte(job_id, ext="pdf"):
+    return os.path.join(REPORTES_DIR, f"{job_id}.{ext}")
+
+def _marcar_error(job_id, mensaje):
+    with open(_ruta_reporte(job_id, "error"), "w", encoding="utf-8") as f:
+        f.write(mensaje)
+    _borrar_silencioso(_ruta_reporte(job_id, "pendiente"))
+
+def _borrar_silencioso(ruta):
+    try:
+        os.remove(ruta)
+    except FileNotFoundError:
+        pass
+
+
+def _terminar_pool(executor):
+    """Mata los procesos de un pool: sus futures fallan con BrokenProcessPool."""
+    if hasattr(executor, "terminate_workers"):   # Python 3.14+
+        executor.terminate_workers()
+        return
+    for proceso in list((executor._processes or {}).values()):
+        proceso.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ColaReportes:
+    """Cola acotada de trabajos PDF sobre un ProcessPoolExecutor por worker."""
+
+    def __init__(self, workers, max_pendientes, timeout):
+        self.workers = workers
+        self.max_pendientes = max_pendientes
+        self.timeout = timeout
+        self._executor = None
+        self._pid = None
+        self._activos = {}    # job_id -> [inicio, future, vencido]
+        self._directos = 0    # renders de renderizar() aún sin terminar
+        self._lock = threading.Lock()
+        self.reciclados = 0
+
+    def _nuevo_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=precalentar_motor_pdf)
+
+    def _pool(self):
+        if self._pid != os.getpid():
+            # Tras un fork el executor del padre no sirve
+            self._executor = self._nuevo_executor()
+            self._pid = os.getpid()
+            self._activos = {}
+            self._directos = 0
+        return self._executor
+
+    def iniciar(self):
+        with self._lock:
+            self._pool()
+
+    def renderizar(self, html):
+        """
+        Render directo en el pool (sin cola ni archivo): Future con los bytes.
+        Ocupa un lugar de max_pendientes igual que encolar().
+        """
+        with self._lock:
+            if len(self._activos) + self._directos >= self.max_pendientes:
+                raise ColaLlena()
+            future = self._pool().submit(generar_pdf, html)
+            self._directos += 1
+        future.add_done_callback(self._directo_terminado)
+        return medir_future(future, "pdf_cola_y_render")
+
+    def _directo_terminado(self, future):
+        with self._lock:
+            self._directos -= 1
+
+    def encolar(self, html, al_terminar=None):
+        """Encola el render; `al_terminar(ruta_pdf)` se llama si sale bien."""
+        os.makedirs(REPORTES_DIR, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if len(self._activos) + self._directos >= self.max_pendientes:
+                raise ColaLlena()
+            open(_ruta_reporte(job_id, "pendiente"), "w").close()
+            future = medir_future(
+                self._pool().submit(_renderizar_a_archivo, html, _ruta_reporte(job_id)), "pdf_cola_y_render"
+            )
+            self._activos[job_id] = [time.monotonic(), future, False]
+        future.add_done_callback(lambda f, j=job_id: self._terminado(j, f, al_terminar))
+        return job_id
+
+    def _terminado(self, job_id, future, al_terminar):
+        with self._lock:
+            trabajo = self._activos.pop(job_id, None)
+        if trabajo is None:
+            return   # el pool se recreó tras un fork
+        if trabajo[2]:
+            # Ya se informó "timeout": un PDF tardío no debe aparecer como listo
+            _borrar_silencioso(_ruta_reporte(job_id))
+            return
+        if future.cancelled():
+            _marcar_error(job_id, "cancelado")
+        elif future.exception() is not None:
+            _marcar_error(job_id, f"{type(future.exception()).__name__}: {future.exception()}")
+        else:
+            _borrar_silencioso(_ruta_reporte(job_id, "pendiente"))
+            if al_terminar is not None:
+                try:
+                    al_terminar(_ruta_reporte(job_id))
+                except Exception:
+                    app.logger.exception("Falló el post-proceso del reporte %s", job_id)
+
+    def vencer_atrasados(self):
+        """
+        Da por fallidos los trabajos que superan el timeout. Siguen contando
+        en la cola hasta que su proceso termine de verdad; si al doble del
+        timeout aún no terminan, el pool se recicla y sus procesos se matan.
+        """
+        ahora = time.monotonic()
+        vencidos, colgado = [], False
+        with self._lock:
+            for job_id, trabajo in self._activos.items():
+                if not trabajo[2] and ahora - trabajo[0] > self.timeout:
+                    trabajo[2] = True
+                    vencidos.append((job_id, trabajo[1]))
+                elif trabajo[2] and ahora - trabajo[0] > 2 * self.timeout:
+                    colgado = True
+            viejo = None
+            if colgado and self._pid == os.getpid():
+                viejo, self._executor = self._executor, self._nuevo_executor()
+                self.reciclados += 1
+        for job_id, future in vencidos:
+            # Si aún no empezó se cancela; si ya corre, _terminado descarta el PDF
+            future.cancel()
+            _marcar_error(job_id, "timeout")
+        if viejo is not None:
+            app.logger.warning("Renders de PDF colgados: se recicla el pool de reportes")
+            _terminar_pool(viejo)
+        return len(vencidos)
+
+    def pendientes(self):
+        return len(self._activos) + self._directos
+
+
+def estado_reporte(job_id):
+    """'listo' | 'error' | 'en_proceso' | None (no existe o ya se limpió)."""
+    # El error manda: un render vencido puede dejar su PDF un instante
+    if os.path.exists(_ruta_reporte(job_id, "error")):
+        return "error"
+    if os.path.exists(_ruta_reporte(job_id)):
+        return "listo"
+    if os.path.exists(_ruta_reporte(job_id, "pendiente")):
+        return "en_proceso"
+    return None
+
+def limpiar_reportes():
+    """Borra PDFs y marcas más antiguos que REPORTES_RETENCION."""
+    if not os.path.isdir(REPORTES_DIR):
+        return 0
+    limite = time.time() - REPORTES_RETENCION
+    n = 0
+    for nombre in os.listdir(REPORTES_DIR):
+        ruta = os.path.join(REPORTES_DIR, nombre)
+        try:
+            if os.path.getmtime(ruta) < limite:
+                os.remove(ruta)
+                n += 1
+        except FileNotFoundError:
+            pass
+    return n
+
+
+cola_reportes = ColaReportes(REPORTES_WORKERS, REPORTES_COLA_MAX, REPORTES_TIMEOUT)
+
+@tarea_periodica("mantenimiento-reportes", 5)
+def _mantener_reportes():
+    cola_reportes.vencer_atrasados()
+    limpiar_reportes()
+
+# ---------- Tokens de descarga de corta duración ----------
+DESCARGA_TOKEN_TTL = int(os.environ.get("DESCARGA_TOKEN_TTL", "900"))
+
+def _firmador_descargas():
+    return URLSafeTimedSerializer(app.secret_key, salt="descarga-reporte")
+
+def url_descarga(job_id):
+    return f"/descargas/{_firmador_descargas().dumps(job_id)}"
+
+def _huella_cliente():
+    return hashlib.sha256(id_sesion_cliente().encode("utf-8")).hexdigest()
+
+def registrar_dueno(job_id):
+    """Guarda (hasheado) el ID de sesión que pidió el reporte: <id>.dueno."""
+    with open(_ruta_reporte(job_id, "dueno"), "w", encoding="utf-8") as f:
+        f.write(_huella_cliente())
+
+def es_dueno(job_id):
+    try:
+        with open(_ruta_reporte(job_id, "dueno"), encoding="utf-8") as f:
+            return secrets.compare_digest(f.read(), _huella_cliente())
+    except FileNotFoundError:
+        return False
+
+def job_de_token(token):
+    """job_id firmado en el token, o None si es inválido o ya venció."""
+    try:
+        return _firmador_descargas().loads(token, max_age=DESCARGA_TOKEN_TTL)
+    except BadSignature:
+        return None
+
+# ---------- Caché de PDFs por contenido ----------
+PDF_CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+PDF_CACHE_DIR = os.environ.get("PDF_CACHE_DIR")   # opcional: compartida en disco
+PDF_CACHE_DISCO_MAX_BYTES = int(os.environ.get("PDF_CACHE_DISCO_MAX_BYTES", str(512 * 1024 * 1024)))
+
+class CachePDF:
+    """
+    PDFs terminados indexados por el hash de sus datos de entrada.
+    En memoria es una LRU acotada por bytes totales; si hay directorio,
+    cada PDF también se guarda como <hash>.pdf (compartido entre workers).
+    """
 
-        elif mensaje == "2":
-            ses["mant_maquina"] = "cargador"
+    def __init__(self, max_bytes, directorio=None, max_bytes_disco=0):
+        self.max_bytes = max_bytes
+        self.directorio = directorio
+        self.max_bytes_disco = max_bytes_disco
+        self._datos = OrderedDict()   # hash -> bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.hits_disco = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, f"{clave}.pdf")
+
+    def _guardar_memoria(self, clave, pdf):
+        if len(pdf) > self.max_bytes:
+            return
+        with self._lock:
+            anterior = self._datos.pop(clave, None)
+            if anterior is not None:
+                self._bytes -= len(anterior)
+            self._datos[clave] = pdf
+            self._bytes += len(pdf)
+            while self._bytes > self.max_bytes:
+                _, viejo = self._datos.popitem(last=False)
+                self._bytes -= len(viejo)
+                self.evictions += 1
+
+    def obtener(self, clave):
+        with self._lock:
+            pdf = self._datos.get(clave)
+            if pdf is not None:
+                self._datos.move_to_end(clave)
+                self.hits += 1
+                return pdf
+        if self.directorio:
+            try:
+                with open(self._ruta(clave), "rb") as f:
+                    pdf = f.read()
+            except FileNotFoundError:
+                pdf = None
+            if pdf is not None:
+                os.utime(self._ruta(clave))   # LRU en disco por mtime
+                self._guardar_memoria(clave, pdf)
+                with self._lock:
+                    self.hits_disco += 1
+                return pdf
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def guardar(self, clave, pdf):
+        self._guardar_memoria(clave, pdf)
+        if self.directorio:
+            os.makedirs(self.directorio, exist_ok=True)
+            tmp = self._ruta(clave) + f".{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(pdf)
+            os.replace(tmp, self._ruta(clave))
+            self._recortar_disco()
+
+    def _recortar_disco(self):
+        archivos = []
+        for nombre in os.listdir(self.directorio):
+            if nombre.endswith(".pdf"):
+                ruta = os.path.join(self.directorio, nombre)
+                try:
+                    st = os.stat(ruta)
+                except FileNotFoundError:
+                    continue
+                archivos.append((st.st_mtime, st.st_size, ruta))
+        total = sum(a[1] for a in archivos)
+        for _, tam, ruta in sorted(archivos):
+            if total <= self.max_bytes_disco:
+                break
+            _borrar_silencioso(ruta)
+            total -= tam
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "entradas": len(self._datos),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "directorio": self.directorio,
+                "hits": self.hits,
+                "hits_disco": self.hits_disco,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
 
-        elif mensaje == "3":
-            ses["mant_maquina"] = "excavadora"
 
-        elif mensaje == "4":
-            ses["mant_maquina"] = "tractor"
+cache_pdf = CachePDF(PDF_CACHE_MAX_BYTES, PDF_CACHE_DIR, PDF_CACHE_DISCO_MAX_BYTES)
 
-        elif mensaje == "9":
-            ses["estado"] = "menu_principal"
-            return responder(
-                "¿Qué deseas hacer?<br>"
-                "1️⃣ Códigos<br>"
-                "2️⃣ Eventos<br>"
-                "3️⃣ Consejos de Mantenimiento Preventivo<br>"
-                "4️⃣ ¿Cómo diferencio un Código de un Evento?<br>"
-                "5️⃣ Cambiar máquina<br>"
-                "6️⃣ Finalizar<br>"
-                "7️⃣ Generar reporte PDF<br>"
-            )
+def clave_reporte(modelo, serie, codigos, eventos, ahora):
+    """Hash de las entradas normalizadas; `ahora` ya viene redondeado al minuto."""
+    datos = {
+        "modelo": modelo,
+        "serie": serie,
+        "codigos": codigos,
+        "eventos": eventos,
+        "now": ahora,
+    }
+    texto = json.dumps(datos, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
 
-        else:
-            return responder("Selecciona una opción válida (1–4 o 9).")
+@medir_fase("render_template")
+def html_reporte(modelo, serie, codigos, eventos, ahora):
+    return render_template(
+        "reporte_diagnostico.html",
+        modelo=modelo,
+        serie=serie,
+        codigos=codigos,
+        eventos=eventos,
+        contactos=CONTACTOS_SOPORTE,
+        now=ahora
+    )
 
-        # Si eligió máquina válida
-        ses["estado"] = "mant_elegir_intervalo"
-        maquina = ses["mant_maquina"]
-        info = PLAN_MANTENIMIENTO.get(maquina)
+def solicitar_reporte(modelo, serie, codigos, eventos):
+    """
+    Devuelve el job_id del reporte. Si un PDF idéntico (mismo minuto) ya
+    se generó, se publica al instante sin renderizar nada.
+    """
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M")
+    clave = clave_reporte(modelo, serie, codigos, eventos, ahora)
+
+    pdf = cache_pdf.obtener(clave)
+    if pdf is not None:
+        os.makedirs(REPORTES_DIR, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        tmp = _ruta_reporte(job_id, "tmp")
+        with open(tmp, "wb") as f:
+            f.write(pdf)
+        os.replace(tmp, _ruta_reporte(job_id))
+    else:
+        def guardar_en_cache(ruta):
+            with open(ruta, "rb") as f:
+                cache_pdf.guardar(clave, f.read())
+
+        html = html_reporte(modelo, serie, codigos, eventos, ahora)
+        job_id = cola_reportes.encolar(html, al_terminar=guardar_en_cache)
+    registrar_dueno(job_id)
+    return job_id
 
-        if not info:
-            return responder("❌ No existe plan de mantenimiento para esa máquina.")
+# ============================================================
+#  RUTA PRINCIPAL
+# ============================================================
+@app.route("/")
+def home():
+    return render_template("index.html")
 
-        # Construcción dinámica del menú de intervalos
-        lista = ""
-        claves = list(info["intervalos"].keys())
-        ses["mant_intervalos_lista"] = claves  # guardamos orden real
+# ============================================================
+#  RUTAS DE ADMINISTRACIÓN
+# ============================================================
+@app.route("/admin/pool")
+def admin_pool():
+    requerir_admin()
+    return jsonify(dict(pool.estadisticas(), busquedas=busquedas.estadisticas()))
+
+@app.route("/admin/cache")
+def admin_cache():
+    requerir_admin()
+    return jsonify({
+        "codigos": cache_codigos.estadisticas(),
+        "eventos": cache_eventos.estadisticas(),
+        "pdf": cache_pdf.estadisticas(),
+        "sugerencias": indices_sugerencias.estadisticas(),
+    })
+
+@app.route("/admin/catalogo")
+def admin_catalogo():
+    requerir_admin()
+    return jsonify(catalogo.estadisticas())
+
+@app.route("/admin/maquinas")
+def admin_maquinas():
+    requerir_admin()
+    return jsonify(maquinas.estadisticas())
+
+@app.route("/admin/catalogo/recargar", methods=["POST"])
+def admin_catalogo_recargar():
+    requerir_admin()
+    if not SNAPSHOT_ACTIVO:
+        return jsonify({"error": "CATALOGO_SNAPSHOT no está activo."}), 409
+    catalogo.cargar(forzar=True)
+    return jsonify(catalogo.estadisticas())
+
+@app.route("/admin/plan")
+def admin_plan():
+    requerir_admin()
+    return jsonify(plan_mant.estadisticas())
+
+@app.route("/admin/plan/recargar", methods=["POST"])
+def admin_plan_recargar():
+    requerir_admin()
+    try:
+        recargar_plan(forzar=True)
+    except (OSError, PlanInvalido) as e:
+        return jsonify({"error": str(e), "vigente": plan_mant.estadisticas()}), 422
+    return jsonify(plan_mant.estadisticas())
+
+@app.route("/admin/cache/invalidar", methods=["POST"])
+def admin_cache_invalidar():
+    requerir_admin()
+    tabla = (request.get_json(silent=True) or {}).get("tabla")
+    if tabla is not None and tabla not in generaciones_cache.caches:
+        return jsonify({"error": f"tabla desconocida: {tabla}"}), 400
+    # Los demás workers vacían su copia en su próximo request
+    borradas = generaciones_cache.invalidar([tabla] if tabla else list(generaciones_cache.caches))
+    return jsonify({"invalidadas": borradas})
 
-        i = 1
-        for clave in claves:
-            etiqueta = info["intervalos"][clave]["label"]
-            lista += f"{i}️⃣ {etiqueta}<br>"
-            i += 1
+# ============================================================
+#  MÉTRICAS (PROMETHEUS)
+# ============================================================
+# Protegido como /admin/*: sin METRICAS_TOKEN exige X-Admin-Token
+# (scrape_configs: http_headers). Con METRICAS_TOKEN el scraper usa
+# authorization: {credentials: <token>} (Bearer) y no necesita ADMIN_TOKEN.
+@app.route("/metrics")
+def metricas():
+    token = os.environ.get("METRICAS_TOKEN")
+    if not token:
+        requerir_admin()
+    elif not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        abort(403)
+
+    caches = {
+        "codigos": cache_codigos.estadisticas(),
+        "eventos": cache_eventos.estadisticas(),
+        "pdf": cache_pdf.estadisticas(),
+        "sugerencias": indices_sugerencias.estadisticas(),
+    }
+    def tasa(s):
+        total = s["hits"] + s.get("hits_disco", 0) + s["misses"]
+        return round((s["hits"] + s.get("hits_disco", 0)) / total, 4) if total else 0.0
+
+    try:
+        n_sesiones = sesiones.contar()
+    except Exception:
+        app.logger.exception("No se pudieron contar las sesiones")
+        n_sesiones = "NaN"
+    conexiones = pool.estadisticas()
+
+    lineas = []
+    for h in (METRICA_REQUEST, METRICA_FASE, METRICA_ESTADO):
+        lineas += h.exponer()
+    lineas += exponer_valores(
+        "ferreydoc_sesiones", "gauge", "Sesiones de chat guardadas.", None, {"": n_sesiones}
+    )
+    lineas += exponer_valores(
+        "ferreydoc_cache_hits_total", "counter", "Aciertos por caché.", "cache",
+        {n: s["hits"] + s.get("hits_disco", 0) for n, s in caches.items()},
+    )
+    lineas += exponer_valores(
+        "ferreydoc_cache_misses_total", "counter", "Fallos por caché.", "cache",
+        {n: s["misses"] for n, s in caches.items()},
+    )
+    lineas += exponer_valores(
+        "ferreydoc_cache_hit_ratio", "gauge", "Proporción de aciertos por caché.", "cache",
+        {n: tasa(s) for n, s in caches.items()},
+    )
+    lineas += exponer_valores(
+        "ferreydoc_cache_entradas", "gauge", "Entradas en cada caché.", "cache",
+        {n: s["entradas"] for n, s in caches.items()},
+    )
+    lineas += exponer_valores(
+        "ferreydoc_pool_conexiones", "gauge", "Conexiones a Postgres de este worker.", "estado",
+        {"libres": conexiones["libres"], "en_uso": conexiones["en_uso"]},
+    )
+    lineas += exponer_valores(
+        "ferreydoc_pool_esperas_total", "counter", "Pedidos de conexión que esperaron o agotaron el timeout.",
+        "resultado", {"esperas": conexiones["esperas"], "timeouts": conexiones["timeouts"]},
+    )
+    lineas += exponer_valores(
+        "ferreydoc_reportes_pendientes", "gauge", "Reportes PDF en la cola de este worker.",
+        None, {"": cola_reportes.pendientes()},
+    )
+    lineas += exponer_valores(
+        "ferreydoc_busquedas_vencidas_total", "counter",
+        "Búsquedas que no terminaron dentro de BUSQUEDA_PLAZO.", None, {"": busquedas.vencidas},
+    )
+    return Response("\n".join(lineas) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
 
-        total = len(claves)
-        return responder(
-            f"📘 <b>Plan de mantenimiento — {info['nombre']}</b><br><br>"
-            f"Selecciona el intervalo:<br><br>{lista}<br>"
-            f"0️⃣ Volver al menú de máquinas"
+# ============================================================
+#  RUTA PDF DIRECTO
+# ============================================================
+@app.route("/generar_reporte", methods=["POST"])
+def generar_reporte():
+    data = request.get_json()
+
+    try:
+        job_id = solicitar_reporte(
+            data.get("modelo"),
+            data.get("serie"),
+            data.get("codigos", []),
+            data.get("eventos", []),
         )
+    except ColaLlena:
+        return jsonify({"error": "Hay demasiados reportes en cola, intenta en unos segundos."}), 503
+
+    # Compatibilidad: ?esperar=1 devuelve el PDF como antes (sin renderizar aquí)
+    if request.args.get("esperar") == "1":
+        limite = time.monotonic() + REPORTES_TIMEOUT
+        while estado_reporte(job_id) == "en_proceso" and time.monotonic() < limite:
+            time.sleep(0.1)
+        if estado_reporte(job_id) != "listo":
+            return jsonify({"error": "No se pudo generar el reporte."}), 500
+        return _enviar_pdf(job_id)
+
+    return jsonify({
+        "reporte_id": job_id,
+        "estado_url": f"/reportes/{job_id}",
+        "descarga_url": url_descarga(job_id),
+    }), 202
 
-    # ==================== MANTENIMIENTO — ELEGIR INTERVALO ====================
-    if estado == "mant_elegir_intervalo":
-        intervalos = ses.get("mant_intervalos_lista") or []
-        maquina = ses.get("mant_maquina")
-
-        # Si se rompió el contexto, devolvemos al menú principal
-        if not intervalos or not maquina:
-            ses["estado"] = "menu_principal"
-            return responder(
-                "Hubo un problema leyendo los intervalos de mantenimiento. "
-                "Te regreso al menú principal.<br><br>"
-                "1️⃣ Códigos<br>"
-                "2️⃣ Eventos<br>"
-                "3️⃣ Mantenimiento<br>"
-                "4️⃣ Dif. código vs evento<br>"
-                "5️⃣ Cambiar máquina<br>"
-                "6️⃣ Finalizar<br>"
-                "7️⃣ Generar PDF"
-            )
+# ============================================================
+#  ESTADO Y DESCARGA DE REPORTES
+# ============================================================
+@app.route("/reportes/<job_id>")
+def estado_reporte_ruta(job_id):
+    if not _ID_REPORTE.fullmatch(job_id):
+        abort(404)
+    estado = estado_reporte(job_id)
+    if estado is None:
+        abort(404)
+    payload = {"reporte_id": job_id, "estado": estado}
+    # Solo la sesión que lo pidió recibe un enlace firmado; si no, este
+    # endpoint sería una descarga sin firma para cualquier job_id
+    if estado == "listo" and es_dueno(job_id):
+        payload["descarga_url"] = url_descarga(job_id)
+    return jsonify(payload)
+
+@app.route("/descargas/<token>")
+def descargar_por_token(token):
+    job_id = job_de_token(token)
+    if job_id is None:
+        abort(404)
+    estado = estado_reporte(job_id)
+    if estado == "en_proceso":
+        return jsonify({"reporte_id": job_id, "estado": estado}), 202
+    if estado != "listo":
+        abort(404)
+    return _enviar_pdf(job_id)
+
+def _enviar_pdf(job_id):
+    # conditional=True: Content-Length, ETag/Last-Modified, 304 y Range (206)
+    resp = send_file(
+        _ruta_reporte(job_id),
+        mimetype="application/pdf",
+        as_attachment=True,
+        download_name="FerreyDoc_Reporte.pdf",
+        conditional=True,
+        etag=True,
+        max_age=DESCARGA_TOKEN_TTL
+    )
+    resp.headers["Cache-Control"] = f"private, max-age={DESCARGA_TOKEN_TTL}"
+    return resp
 
-        # Volver al menú de selección de máquina
-        if mensaje == "0":
-            ses["estado"] = "mant_elegir_maquina"
-            return responder(
-                "Selecciona el tipo de maquinaria:<br>"
-                "1️⃣ Rodillo<br>"
-                "2️⃣ Cargador<br>"
-                "3️⃣ Excavadora<br>"
-                "4️⃣ Tractor<br>"
-                "9️⃣ Volver"
-            )
+# ============================================================
+#  REPORTE DE FLOTA (VARIAS MÁQUINAS)
+# ============================================================
+FLOTA_MAX_MAQUINAS = int(os.environ.get("FLOTA_MAX_MAQUINAS", "100"))
+FLOTA_EN_VUELO = int(os.environ.get("FLOTA_EN_VUELO", str(REPORTES_WORKERS)))
 
-        # Validar input numérico
-        if not mensaje.isdigit():
-            total = len(intervalos)
-            return responder(f"Selecciona una opción válida (1–{total} o 0).")
+def _entrada_valida(valor):
+    """None, un texto o una lista de textos: lo que _lista_entrada sabe leer."""
+    return (valor is None or isinstance(valor, str)
+            or isinstance(valor, list) and all(isinstance(v, str) for v in valor))
 
-        opcion = int(mensaje)
-        total = len(intervalos)
+def _lista_entrada(valor):
+    """Acepta "168-4, 110-3" o ["168-4", "110-3"]."""
+    if isinstance(valor, str):
+        valor = valor.split(",")
+    return [str(v).strip() for v in valor or [] if str(v).strip()]
 
-        if opcion < 1 or opcion > total:
-            return responder(f"Selecciona una opción válida (1–{total} o 0).")
+def resolver_flota(maquinas):
+    """
+    Arma los datos de reporte de todas las máquinas resolviendo TODOS los
+    códigos en una consulta y TODOS los eventos en otra.
+    """
+    fichas = []
+    claves_cod, claves_ev = [], []
+    for m in maquinas:
+        modelo = str(m.get("modelo") or "").strip().upper()
+        serie = str(m.get("serie") or "").strip().upper()
+        ficha = {"modelo": modelo or "N/D", "serie": serie[:3] or "N/D", "codigos": [], "eventos": []}
+        for raw in _lista_entrada(m.get("codigos")):
+            mid, cid, fmi = extraer_codigo(raw)
+            ficha["codigos"].append((raw, cid, fmi))
+            if cid and fmi:
+                claves_cod.append((modelo, serie[:3], cid, fmi))
+        for raw in _lista_entrada(m.get("eventos")):
+            eid, level = extraer_evento(raw)
+            ficha["eventos"].append((raw, eid, level))
+            if eid and level:
+                claves_ev.append((modelo, serie[:3], eid, level))
+        fichas.append(ficha)
 
-        clave_intervalo = intervalos[opcion - 1]
-        ses["mant_intervalo"] = clave_intervalo
+    filas_cod = iter(resolver_codigos(claves_cod))
+    filas_ev = iter(resolver_eventos(claves_ev))
 
-        info = PLAN_MANTENIMIENTO.get(maquina)
-        if not info:
-            ses["estado"] = "menu_principal"
-            return responder("❌ No existe plan de mantenimiento para esa máquina.")
+    for ficha in fichas:
+        codigos = []
+        for raw, cid, fmi in ficha["codigos"]:
+            if not cid or not fmi:
+                codigos.append({"raw": raw, "descripcion": "Formato no reconocido.", "causas": "—", "url": ""})
+                continue
+            filas = next(filas_cod)
+            codigos.append(
+                item_codigo(raw, cid, fmi, filas[0]) if filas else
+                {"raw": raw, "descripcion": "No encontrado en el catálogo.", "causas": "—", "url": ""}
+            )
+        eventos = []
+        for raw, eid, level in ficha["eventos"]:
+            if not eid or not level:
+                eventos.append({"raw": raw, "descripcion": "Formato no reconocido.", "url": ""})
+                continue
+            filas = next(filas_ev)
+            eventos.append(
+                item_evento(raw, eid, level, filas[0]) if filas else
+                {"raw": raw, "descripcion": "No encontrado en el catálogo.", "url": ""}
+            )
+        ficha["codigos"] = codigos
+        ficha["eventos"] = eventos
+    return fichas
+
+def _pdf_aviso(ficha, motivo):
+    """PDF de una página en lugar del reporte de una máquina que falló."""
+    return generar_pdf(
+        f"<html><body><h2>FerreyDoc — {escape(ficha['modelo'])} / {escape(ficha['serie'])}</h2>"
+        f"<p>No se pudo generar el reporte de esta máquina ({motivo}).<br>"
+        "Vuelve a pedirlo en unos minutos.</p></body></html>"
+    )
 
-        data_intervalo = info["intervalos"].get(clave_intervalo)
-        if not data_intervalo:
-            ses["estado"] = "menu_principal"
-            return responder("❌ No encontré el intervalo seleccionado.")
+def _pdfs_flota(fichas):
+    """
+    Renderiza cada máquina en el pool de procesos (o la saca de la caché de
+    PDFs) y va entregando (indice, pdf) a medida que terminan.
 
-        bloques = data_intervalo.get("bloques", {})
+    Un request tiene como mucho FLOTA_EN_VUELO renders en el pool, y cada
+    uno ocupa un lugar de la cola acotada: una flota grande no deja sin
+    turno a los reportes del chat. Si una máquina falla o vence el plazo
+    se entrega un PDF de aviso en su lugar, así la respuesta nunca se corta.
+    """
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M")
+    por_renderizar = deque()
+    for i, f in enumerate(fichas):
+        clave = clave_reporte(f["modelo"], f["serie"], f["codigos"], f["eventos"], ahora)
+        pdf = cache_pdf.obtener(clave)
+        if pdf is not None:
+            yield i, pdf
+        else:
+            html = html_reporte(f["modelo"], f["serie"], f["codigos"], f["eventos"], ahora)
+            por_renderizar.append((i, clave, html))
+
+    limite = time.monotonic() + REPORTES_TIMEOUT
+    en_vuelo = {}   # future -> (indice, clave)
+    while por_renderizar or en_vuelo:
+        while por_renderizar and len(en_vuelo) < FLOTA_EN_VUELO:
+            i, clave, html = por_renderizar[0]
+            try:
+                futuro = cola_reportes.renderizar(html)
+            except ColaLlena:
+                break   # se reintenta cuando termine alguno
+            por_renderizar.popleft()
+            en_vuelo[futuro] = (i, clave)
+
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            break
+        if not en_vuelo:
+            time.sleep(min(0.1, restante))   # la cola está llena con trabajos ajenos
+            continue
+        listos, _ = wait(en_vuelo, timeout=restante, return_when=FIRST_COMPLETED)
+        for futuro in listos:
+            i, clave = en_vuelo.pop(futuro)
+            try:
+                pdf = futuro.result()
+            except Exception as e:
+                app.logger.warning("Falló el PDF de flota de la máquina %d: %r", i + 1, e)
+                yield i, _pdf_aviso(fichas[i], "error al generarlo")
+                continue
+            cache_pdf.guardar(clave, pdf)
+            yield i, pdf
+
+    for futuro, (i, _) in en_vuelo.items():
+        futuro.cancel()
+        yield i, _pdf_aviso(fichas[i], "tardó demasiado")
+    for i, _, _ in por_renderizar:
+        yield i, _pdf_aviso(fichas[i], "tardó demasiado")
+
+
+class _SalidaStream(io.RawIOBase):
+    """Destino no seekable para zipfile: acumula bytes hasta que se extraen."""
+
+    def __init__(self):
+        self._partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def extraer(self):
+        datos = b"".join(self._partes)
+        self._partes = []
+        return datos
+
+def _stream_zip(fichas):
+    salida = _SalidaStream()
+    with zipfile.ZipFile(salida, "w", compression=zipfile.ZIP_STORED) as zf:
+        for i, pdf in _pdfs_flota(fichas):
+            f = fichas[i]
+            nombre = re.sub(r"[^A-Za-z0-9_-]", "_", f"{i + 1:03d}_{f['modelo']}_{f['serie']}")
+            zf.writestr(f"{nombre}.pdf", pdf)
+            yield salida.extraer()
+    yield salida.extraer()
+
+def _pdf_unido(fichas):
+    # Las páginas van en el orden de la flota: el PDF unido se arma completo
+    # en memoria antes de responder (no es streaming, a diferencia del zip)
+    pdfs = dict(_pdfs_flota(fichas))
+    escritor = PdfWriter()
+    for i in range(len(fichas)):
+        escritor.append(PdfReader(BytesIO(pdfs[i])))
+    salida = BytesIO()
+    escritor.write(salida)
+    return salida.getvalue()
+
+@app.route("/generar_reporte_flota", methods=["POST"])
+def generar_reporte_flota():
+    """
+    Body: {"maquinas": [{"modelo", "serie", "codigos", "eventos"}, ...],
+           "formato": "pdf" (uno solo, unido) | "zip" (un PDF por máquina)}
 
-        texto_resp = (
-            f"📘 <b>Plan de mantenimiento — {info['nombre']}</b><br><br>"
-            f"<b>Intervalo:</b> {data_intervalo['label']}<br><br>"
+    "zip" se envía a medida que cada PDF termina. "pdf" se arma completo en
+    memoria y recién entonces se envía. Una máquina que falla o excede
+    REPORTES_TIMEOUT aparece como una página de aviso.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    maquinas = data.get("maquinas")
+    formato = data.get("formato", "pdf")
+
+    if not isinstance(maquinas, list) or not maquinas:
+        return jsonify({"error": "Envía una lista no vacía en 'maquinas'."}), 400
+    if len(maquinas) > FLOTA_MAX_MAQUINAS:
+        return jsonify({"error": f"Máximo {FLOTA_MAX_MAQUINAS} máquinas por reporte."}), 413
+    for n, m in enumerate(maquinas, 1):
+        if not isinstance(m, dict):
+            return jsonify({"error": f"La máquina {n} debe ser un objeto."}), 400
+        if not (_entrada_valida(m.get("codigos")) and _entrada_valida(m.get("eventos"))):
+            return jsonify({
+                "error": f"Máquina {n}: 'codigos' y 'eventos' deben ser un texto o una lista de textos."
+            }), 400
+    if formato not in ("pdf", "zip"):
+        return jsonify({"error": "formato debe ser 'pdf' o 'zip'."}), 400
+
+    fichas = resolver_flota(maquinas)
+
+    if formato == "zip":
+        return Response(
+            stream_with_context(_stream_zip(fichas)),
+            mimetype="application/zip",
+            headers={"Content-Disposition": "attachment; filename=FerreyDoc_Flota.zip"}
         )
 
-        for titulo, tareas in bloques.items():
-            texto_resp += f"{titulo}:<br>"
-            for t in tareas:
-                texto_resp += f"• {t}<br>"
-            texto_resp += "<br>"
+    return Response(
+        _pdf_unido(fichas),
+        mimetype="application/pdf",
+        headers={"Content-Disposition": "attachment; filename=FerreyDoc_Flota.pdf"}
+    )
 
-        link_manual = info.get("link")
-        if link_manual:
-            texto_resp += (
-                "<b>Consulta más detalles en el manual oficial:</b><br>"
-                f"<a href=\"{link_manual}\" target=\"_blank\">{link_manual}</a><br><br>"
-            )
+# ============================================================
+#  PLAN DE MANTENIMIENTO (HTTP)
+# ============================================================
+# Los mismos fragmentos que usa el chat, con ETag para que el cliente
+# pueda revalidar con If-None-Match y recibir 304.
+def _texto_cacheable(fijo):
+    resp = Response(fijo.texto, mimetype="text/html")
+    resp.set_etag(fijo.etag)
+    resp.headers["Cache-Control"] = "public, max-age=300"
+    return resp.make_conditional(request)
+
+@app.route("/mantenimiento/<maquina>")
+def mantenimiento_menu(maquina):
+    fijo = plan_mant.menus.get(maquina)
+    if fijo is None:
+        abort(404)
+    return _texto_cacheable(fijo)
+
+@app.route("/mantenimiento/<maquina>/<intervalo>")
+def mantenimiento_intervalo(maquina, intervalo):
+    fijo = plan_mant.respuestas.get((maquina, intervalo))
+    if fijo is None:
+        abort(404)
+    return _texto_cacheable(fijo)
+
+@app.route("/api/mantenimiento/calculo", methods=["POST"])
+def api_mantenimiento_calculo():
+    """
+    Body: {"maquina", "horometro", "ultimo_servicio"} o una lista de ellos
+    (planificador de flota). Devuelve los intervalos vencidos de cada uno.
+    """
+    data = request.get_json(silent=True)
+    lote = isinstance(data, list)
+    pedidos = data if lote else [data]
+    if not pedidos or len(pedidos) > FLOTA_MAX_MAQUINAS:
+        return jsonify({"error": f"Envía entre 1 y {FLOTA_MAX_MAQUINAS} cálculos."}), 400
+
+    plan = plan_mant
+    resultados = []
+    for i, pedido in enumerate(pedidos):
+        pedido = pedido if isinstance(pedido, dict) else {}
+        maquina = pedido.get("maquina")
+        horometro = pedido.get("horometro")
+        ultimo = pedido.get("ultimo_servicio", 0)
+
+        if maquina not in plan.plan:
+            return jsonify({"error": f"[{i}] maquina debe ser una de {list(plan.plan)}."}), 400
+        if not all(isinstance(v, (int, float)) and not isinstance(v, bool)
+                   and (isinstance(v, int) or math.isfinite(v)) and v >= 0
+                   for v in (horometro, ultimo)) or ultimo > horometro:
+            return jsonify({"error": f"[{i}] horometro y ultimo_servicio deben ser "
+                                     "números finitos ≥ 0, con ultimo_servicio ≤ horometro."}), 400
+
+        resultados.append({
+            "maquina": maquina,
+            "horometro": horometro,
+            "ultimo_servicio": ultimo,
+            "intervalos": plan.vencimientos(maquina, horometro, ultimo),
+        })
+
+    cuerpo = {"version": plan.version}
+    cuerpo.update({"resultados": resultados} if lote else resultados[0])
+    return jsonify(cuerpo)
 
-        # Permitir seguir consultando más intervalos
-        ses["estado"] = "mant_elegir_intervalo"
-        texto_resp += (
-            f"Selecciona otro intervalo (1–{total}) o 0️⃣ Volver al menú de máquinas."
+# ============================================================
+#  MOTOR DE DIÁLOGO
+# ============================================================
+# Cada mensaje se resuelve con búsquedas O(1) en tablas:
+#   1) COMANDOS_GLOBALES[mensaje]       (válidos en cualquier estado)
+#   2) OPCIONES[(estado, mensaje)]      (opciones de menú)
+#   3) MANEJADORES[estado]              (texto libre / opción inválida)
+# Para agregar un flujo nuevo basta registrar sus funciones con los
+# decoradores de abajo.
+class Respuesta:
+    __slots__ = ("texto", "extra")
+
+    def __init__(self, texto, extra=None):
+        self.texto = texto
+        self.extra = extra
+
+
+class Mensaje:
+    """Lo que recibe cada manejador."""
+    __slots__ = ("user_id", "texto", "ses")
+
+    def __init__(self, user_id, texto, ses):
+        self.user_id = user_id
+        self.texto = texto
+        self.ses = ses
+
+
+COMANDOS_GLOBALES = {}   # texto.lower() -> manejador
+OPCIONES = {}            # (estado, texto) -> manejador
+MANEJADORES = {}         # estado -> manejador por defecto
+
+def comando(*textos):
+    def registrar(funcion):
+        for t in textos:
+            COMANDOS_GLOBALES[t] = funcion
+        return funcion
+    return registrar
+
+def opcion(estado, *textos):
+    def registrar(funcion):
+        for t in textos:
+            OPCIONES[(estado, t)] = funcion
+        return funcion
+    return registrar
+
+def en_estado(*estados):
+    def registrar(funcion):
+        for e in estados:
+            MANEJADORES[e] = funcion
+        return funcion
+    return registrar
+
+def despachar(m):
+    manejador = (
+        COMANDOS_GLOBALES.get(m.texto.lower())
+        or OPCIONES.get((m.ses.estado, m.texto))
+        or MANEJADORES.get(m.ses.estado)
+    )
+    if manejador is None:
+        return Respuesta("No entendí 😅<br>Escribe <b>hola</b> para reiniciar.")
+    with METRICA_ESTADO.medir(m.ses.estado):
+        return manejador(m)
+
+# ---------- Fragmentos de respuesta prearmados ----------
+TEXTO_BIENVENIDA = (
+    "👋 ¡Hola, soy <b>FerreyDoc</b>, tu asistente técnico CAT.<br><br>"
+    "Estoy diseñado para orientarte respecto a Códigos y Eventos<br>"
+    "Además puedo brindarte consejos acerca del Mantenimiento de tu Equipo<br>"
+    "Antes de comenzar necesitaré unos datos<br>"
+    "¿Estás de acuerdo con brindar información sobre tu equipo CAT?<br>"
+    "1️⃣ Sí<br>2️⃣ No"
+)
+
+OPCIONES_MENU_PRINCIPAL = (
+    "1️⃣ Códigos<br>"
+    "2️⃣ Eventos<br>"
+    "3️⃣ Consejos de Mantenimiento Preventivo<br>"
+    "4️⃣ ¿Cómo diferencio un Código de un Evento?<br>"
+    "5️⃣ Cambiar máquina<br>"
+    "6️⃣ Finalizar<br>"
+    "7️⃣ Generar reporte PDF<br>"
+    "8️⃣ Calcular mantenimiento por horómetro<br>"
+    "💬 O escribe directamente códigos y eventos (ej: 168-4, E0117(2))<br>"
+)
+
+MENU_PRINCIPAL = "¿Qué deseas hacer?<br>" + OPCIONES_MENU_PRINCIPAL
+
+MENU_TRAS_CODIGOS = (
+    "<br><br>¿Qué deseas hacer?<br>"
+    "1️⃣ Más códigos<br>"
+    "2️⃣ Eventos<br>"
+    "3️⃣ Mantenimiento<br>"
+    "7️⃣ Generar PDF<br>"
+    "6️⃣ Finalizar"
+)
+
+MENU_TRAS_EVENTOS = (
+    "<br><br>¿Qué deseas hacer?<br>"
+    "1️⃣ Códigos<br>"
+    "2️⃣ Más eventos<br>"
+    "3️⃣ Mantenimiento<br>"
+    "7️⃣ Generar PDF<br>"
+    "6️⃣ Finalizar"
+)
+
+TEXTO_PEDIR_CODIGOS = (
+    "Por favor escribe el código CID/FMI del que necesitas información. "
+    "Puedes ingresar hasta 5 códigos separados por coma.<br>"
+    "Ej: 168-4"
+)
+
+TEXTO_PEDIR_EVENTOS = (
+    "Por favor escribe el evento EID/Level del que necesitas información. "
+    "Puedes ingresar hasta 5 eventos separados por coma.<br>"
+    "Formato obligatorio: <b>E####(L)</b> con L = 1, 2 o 3.<br>"
+    "Ej: E0117(2)"
+)
+
+TEXTO_COD_VS_EVENTO = (
+    "<b>¿Cuál es la diferencia entre un Código y un Evento?</b><br><br>"
+    "<b>🔧 Código (CID/FMI):</b><br>"
+    "• Formato: <b>XXXX-Y</b>.<br>"
+    "• Ejemplo: <b>4651-9</b>.<br>"
+    "• Describe una <u>falla mecánica o eléctrica puntual</u>.<br><br>"
+    "<b>📘 Evento (EID/Level):</b><br>"
+    "• Formato: <b>E#####(L)</b>.<br>"
+    "• Ejemplo: <b>E60104(2)</b>.<br>"
+    "• Describe una <u>condición operativa o mal uso detectado</u>.<br><br>"
+    "Aquí tienes un ejemplo real sobre cómo aparece en pantalla:<br><br>"
+    "Escribe <b>1</b> para volver al menú principal."
+)
+
+EXTRA_COD_VS_EVENTO = {"imagen": "/static/ejemplos/codigos_eventos.jpeg"}
+
+# ========= RESET GLOBAL CON "hola" =========
+@comando("hola")
+def _hola(m):
+    resetear_sesion(m.user_id)
+    ses = obtener_sesion(m.user_id)
+    ses.estado = "esperando_consentimiento"
+    return Respuesta(TEXTO_BIENVENIDA)
+
+# ===================== BIENVENIDA =====================
+@en_estado("inicio")
+def _bienvenida(m):
+    m.ses.estado = "esperando_consentimiento"
+    return Respuesta(TEXTO_BIENVENIDA)
+
+# ================= CONSENTIMIENTO =====================
+@opcion("esperando_consentimiento", "1")
+def _consiente(m):
+    m.ses.estado = "pidiendo_modelo"
+    return Respuesta("Perfecto 🙌<br>Ingresa el <b>MODELO</b> (ej: 950H, 320D).")
+
+@opcion("esperando_consentimiento", "2")
+def _no_consiente(m):
+    resetear_sesion(m.user_id)
+    return Respuesta("Ok 👍<br>Escribe <b>hola</b> si deseas volver.")
+
+@en_estado("esperando_consentimiento")
+def _consentimiento_invalido(m):
+    return Respuesta("Debes responder 1 o 2.")
+
+# ===================== MODELO =====================
+@en_estado("pidiendo_modelo")
+def _modelo(m):
+    model = m.texto.strip().upper()
+    if not maquinas.existe_modelo(model):
+        opciones = maquinas.autocompletar(model)
+        return Respuesta(
+            f"❌ No tengo el modelo <b>{model}</b> en el catálogo.<br>"
+            + (f"¿Quizás: {', '.join(f'<b>{o}</b>' for o in opciones)}?<br>" if opciones else "")
+            + "Vuelve a escribir el <b>MODELO</b>."
         )
 
-        return responder(texto_resp)
+    m.ses.model = model
+    m.ses.estado = "pidiendo_serie"
+    return Respuesta(
+        f"Modelo registrado: <b>{m.ses.model}</b><br>"
+        "Ahora ingresa los <b>primeros 3 dígitos</b> de la serie."
+    )
 
-    # ================= CÓDIGOS =================
-    if estado == "pidiendo_codigos":
+# ===================== SERIE ======================
+@en_estado("pidiendo_serie")
+def _serie(m):
+    serial3 = m.texto.strip()[:3].upper()
+    if not maquinas.existe(m.ses.model, serial3):
+        series = maquinas.series_de(m.ses.model)
+        return Respuesta(
+            f"❌ No tengo la serie <b>{serial3}</b> para el modelo <b>{m.ses.model}</b>.<br>"
+            + (f"Series disponibles: {', '.join(series[:10])}{'…' if len(series) > 10 else ''}<br>"
+               if series else "")
+            + "Vuelve a escribir los <b>primeros 3 dígitos</b> de la serie."
+        )
 
-        model = ses["model"]
-        serial3 = ses["serial3"]
-        codigos_raw = mensaje.split(",")
-        respuestas = []
+    m.ses.serial3 = serial3
+    m.ses.estado = "menu_principal"
+    return Respuesta(
+        f"✔ Modelo: <b>{m.ses.model}</b><br>"
+        f"✔ Serie: <b>{m.ses.serial3}</b><br><br>"
+        "A continuación, escribe el número de la consulta que deseas realizar:<br>"
+        + OPCIONES_MENU_PRINCIPAL
+    )
 
-        ses["reporte_codigos"] = []
+# ==================== MENU PRINCIPAL ====================
+@opcion("menu_principal", "1")
+def _menu_codigos(m):
+    m.ses.estado = "pidiendo_codigos"
+    return Respuesta(TEXTO_PEDIR_CODIGOS)
+
+@opcion("menu_principal", "2")
+def _menu_eventos(m):
+    m.ses.estado = "pidiendo_eventos"
+    return Respuesta(TEXTO_PEDIR_EVENTOS)
+
+@opcion("menu_principal", "3")
+def _menu_mantenimiento(m):
+    m.ses.estado = "mant_elegir_maquina"
+    return Respuesta(plan_mant.menu_maquinas)
+
+@opcion("menu_principal", "4")
+def _menu_cod_vs_evento(m):
+    m.ses.estado = "explicando_cod_evento"
+    return Respuesta(TEXTO_COD_VS_EVENTO, EXTRA_COD_VS_EVENTO)
+
+@opcion("menu_principal", "5")
+def _menu_cambiar_maquina(m):
+    resetear_sesion(m.user_id)
+    return Respuesta("Ingresa el nuevo <b>MODELO</b>.")
+
+@opcion("menu_principal", "6")
+def _menu_finalizar(m):
+    resetear_sesion(m.user_id)
+    return Respuesta("Gracias por usar FerreyDoc 🤝")
+
+# ============= GENERAR PDF =============
+@opcion("menu_principal", "7")
+def _menu_reporte(m):
+    ses = m.ses
+    try:
+        job_id = solicitar_reporte(
+            ses.model or "N/D",
+            ses.serial3 or "N/D",
+            ses.reporte_codigos,
+            ses.reporte_eventos,
+        )
+    except ColaLlena:
+        return Respuesta(
+            "⏳ Hay muchos reportes generándose ahora mismo.<br>"
+            "Escribe <b>7</b> otra vez en unos segundos."
+        )
 
-        for raw in codigos_raw:
+    # Resetear historial tras generar reporte
+    ses.reporte_codigos = []
+    ses.reporte_eventos = []
 
-            raw = raw.strip()
-            mid, cid, fmi = extraer_codigo(raw)
+    return Respuesta(
+        "📄 Estoy generando tu reporte PDF, se descargará en unos segundos.",
+        {
+            "reporte_id": job_id,
+            "reporte_estado_url": f"/reportes/{job_id}",
+            "descarga_url": url_descarga(job_id),
+        }
+    )
 
-            if not cid or not fmi:
-                respuestas.append(f"❌ No pude interpretar {raw}")
-                continue
+# ========== EXPLICACIÓN CÓDIGO vs EVENTO ==========
+@opcion("explicando_cod_evento", "1")
+def _volver_de_explicacion(m):
+    m.ses.estado = "menu_principal"
+    return Respuesta(MENU_PRINCIPAL)
 
-            filas = query_codigo(model, serial3, cid, fmi)
-            if not filas:
-                respuestas.append(f"❌ No encontré datos para {raw}")
-                continue
+@en_estado("explicando_cod_evento")
+def _explicacion_invalida(m):
+    return Respuesta(
+        "Si ya revisaste el ejemplo, escribe <b>1</b> para volver al menú principal."
+    )
 
-            fila = filas[0]
-            desc = fila["description"] or "Sin descripción."
-            causas = fila["causes"] or "Sin causas."
-            url = fila["url"] or ""
+# ==================== MANTENIMIENTO — ELEGIR MÁQUINA ====================
+@en_estado("mant_elegir_maquina")
+def _elegir_maquina(m):
+    ses = m.ses
+    plan = plan_mant
+    maquina = plan.maquinas.get(m.texto)
+    if maquina is None:
+        return Respuesta(f"Selecciona una opción válida (1–{len(plan.maquinas)} o 9).")
+
+    ses.mant_maquina = maquina
+    ses.estado = "mant_elegir_intervalo"
+    menu = plan.menus.get(maquina)
+
+    if not menu:
+        return Respuesta("❌ No existe plan de mantenimiento para esa máquina.")
+
+    ses.mant_intervalos_lista = list(menu.claves)  # guardamos orden real
+    return Respuesta(menu.texto)
+
+@opcion("mant_elegir_maquina", "9")
+def _volver_de_maquinas(m):
+    m.ses.estado = "menu_principal"
+    return Respuesta(MENU_PRINCIPAL)
+
+# ==================== MANTENIMIENTO — ELEGIR INTERVALO ====================
+@opcion("mant_elegir_intervalo", "0")
+def _volver_a_maquinas(m):
+    m.ses.estado = "mant_elegir_maquina"
+    return Respuesta(plan_mant.menu_maquinas)
+
+@en_estado("mant_elegir_intervalo")
+def _elegir_intervalo(m):
+    ses = m.ses
+    intervalos = ses.mant_intervalos_lista
+    maquina = ses.mant_maquina
+
+    # Si se rompió el contexto, devolvemos al menú principal
+    if not intervalos or not maquina:
+        ses.estado = "menu_principal"
+        return Respuesta(
+            "Hubo un problema leyendo los intervalos de mantenimiento. "
+            "Te regreso al menú principal.<br><br>" + OPCIONES_MENU_PRINCIPAL
+        )
 
-            url_html = f'<a href="{url}" target="_blank">{url}</a>' if url else "—"
+    total = len(intervalos)
 
-            ses["reporte_codigos"].append({
-                "raw": raw,
-                "cid": cid,
-                "fmi": fmi,
-                "descripcion": desc,
-                "causas": causas,
-                "url": url
-            })
+    # Validar input numérico
+    if not m.texto.isdigit() or not 1 <= int(m.texto) <= total:
+        return Respuesta(f"Selecciona una opción válida (1–{total} o 0).")
 
-            respuestas.append(
-                f"🔧 <b>Código:</b> {raw}<br><br>"
-                f"<b>Descripción:</b> {desc}<br><br>"
-                f"<b>Causas:</b> {causas}<br><br>"
-                f"<b>Más información:</b> {url_html}"
-            )
+    clave_intervalo = intervalos[int(m.texto) - 1]
+    ses.mant_intervalo = clave_intervalo
+
+    plan = plan_mant
+    if maquina not in plan.menus:
+        ses.estado = "menu_principal"
+        return Respuesta("❌ No existe plan de mantenimiento para esa máquina.")
+
+    respuesta = plan.respuestas.get((maquina, clave_intervalo))
+    if not respuesta:
+        ses.estado = "menu_principal"
+        return Respuesta("❌ No encontré el intervalo seleccionado.")
+
+    return Respuesta(respuesta.texto)
 
-        ses["estado"] = "menu_principal"
+# ============ MANTENIMIENTO POR HORÓMETRO ============
+ESTADOS_VENCIMIENTO = {
+    "atrasado": "⚠️ Atrasado",
+    "vencido": "🔔 Toca ahora",
+    "incluido": "↳ Incluido por un intervalo mayor",
+}
 
-        return responder(
-            "<br><br>".join(respuestas) +
-            "<br><br>¿Qué deseas hacer?<br>"
-            "1️⃣ Más códigos<br>"
-            "2️⃣ Eventos<br>"
-            "3️⃣ Mantenimiento<br>"
-            "7️⃣ Generar PDF<br>"
-            "6️⃣ Finalizar"
+def html_vencimientos(plan, maquina, horometro, ultimo):
+    info = plan.plan[maquina]
+    items = plan.vencimientos(maquina, horometro, ultimo)
+    partes = [
+        f"🕒 <b>Mantenimiento por horómetro — {info['nombre']}</b><br>"
+        f"Horómetro actual: <b>{horometro:g} h</b> · Último servicio: <b>{ultimo:g} h</b><br><br>"
+    ]
+    if not items:
+        partes.append("✅ No hay intervalos vencidos desde el último servicio.<br><br>")
+
+    for item in items:
+        partes.append(
+            f"<b>{item['label']}</b> — {ESTADOS_VENCIMIENTO[item['estado']]}"
+            + (f" ({item['ciclos']} ciclos)" if item["ciclos"] > 1 else "")
+            + "<br>"
+        )
+        for titulo, tareas in item["bloques"].items():
+            partes.append(f"{titulo}:<br>")
+            partes.extend(f"• {t}<br>" for t in tareas)
+        partes.append("<br>")
+
+    link_manual = info.get("link")
+    if link_manual:
+        partes.append(
+            "<b>Consulta más detalles en el manual oficial:</b><br>"
+            f"<a href=\"{link_manual}\" target=\"_blank\">{link_manual}</a><br><br>"
         )
+    return "".join(partes)
+
+@opcion("menu_principal", "8")
+def _menu_horometro(m):
+    m.ses.estado = "horometro_maquina"
+    return Respuesta(plan_mant.menu_maquinas)
+
+@opcion("horometro_maquina", "9")
+def _volver_de_horometro(m):
+    m.ses.estado = "menu_principal"
+    return Respuesta(MENU_PRINCIPAL)
+
+@en_estado("horometro_maquina")
+def _horometro_maquina(m):
+    plan = plan_mant
+    maquina = plan.maquinas.get(m.texto)
+    if maquina is None:
+        return Respuesta(f"Selecciona una opción válida (1–{len(plan.maquinas)} o 9).")
+
+    m.ses.mant_maquina = maquina
+    m.ses.estado = "horometro_horas"
+    return Respuesta(
+        "Escribe las <b>horas actuales del horómetro</b> y las del "
+        "<b>último servicio</b>, separadas por coma.<br>"
+        "Ej: 5230, 4980"
+    )
 
-    # ================= EVENTOS =================
-    if estado == "pidiendo_eventos":
+@en_estado("horometro_horas")
+def _horometro_horas(m):
+    ses = m.ses
+    plan = plan_mant
+    if ses.mant_maquina not in plan.plan:
+        ses.estado = "menu_principal"
+        return Respuesta("❌ No existe plan de mantenimiento para esa máquina.<br><br>" + MENU_PRINCIPAL)
+
+    horas = re.findall(r"\d+", m.texto)
+    if len(horas) != 2 or int(horas[1]) > int(horas[0]):
+        return Respuesta(
+            "Necesito dos números: horómetro actual y último servicio "
+            "(el último no puede ser mayor). Ej: 5230, 4980"
+        )
 
-        model = ses["model"]
-        serial3 = ses["serial3"]
-        eventos_raw = mensaje.split(",")
-        respuestas = []
+    ses.estado = "menu_principal"
+    return Respuesta(
+        html_vencimientos(plan, ses.mant_maquina, int(horas[0]), int(horas[1]))
+        + MENU_PRINCIPAL
+    )
 
-        ses["reporte_eventos"] = []
+# ============ DIAGNÓSTICO LIBRE (CÓDIGOS + EVENTOS) ============
+def _enlace(url):
+    return f'<a href="{url}" target="_blank">{url}</a>' if url else "—"
 
-        for raw in eventos_raw:
-            raw = raw.strip()
+def html_codigo(item):
+    return (
+        f"🔧 <b>Código:</b> {item['raw']}<br><br>"
+        f"<b>Descripción:</b> {item['descripcion']}<br><br>"
+        f"<b>Causas:</b> {item['causas']}<br><br>"
+        f"<b>Más información:</b> {_enlace(item['url'])}"
+    )
 
-            eid, level = extraer_evento(raw)
+def html_evento(item):
+    return (
+        f"📘 <b>Evento:</b> {item['raw']}<br><br>"
+        f"<b>Descripción:</b> {item['descripcion']}<br><br>"
+        f"<b>Más información:</b> {_enlace(item['url'])}"
+    )
 
-            # Validación estricta del formato único
-            if not eid or not level:
-                respuestas.append(
-                    f"❌ Formato inválido para {raw}. "
-                    f"Usa el formato <b>E####(L)</b> con L = 1, 2 o 3. Ej: E0117(2)"
-                )
-                continue
+REPORTE_MAX_ITEMS = int(os.environ.get("REPORTE_MAX_ITEMS", "25"))
 
-            filas = query_evento(model, serial3, eid, level)
+def _clave_item(item):
+    if "cid" in item:
+        return int(item["cid"]), int(item["fmi"])
+    return item["eid"].upper(), item["level"]
 
-            if not filas:
-                respuestas.append(f"❌ No encontré datos para {raw}")
-                continue
+def agregar_al_reporte(lista, item):
+    """
+    Suma un resultado a reporte_codigos/reporte_eventos de la sesión: sin
+    repetidos (queda la consulta más reciente) y con a lo sumo
+    REPORTE_MAX_ITEMS por lista (se descartan los más antiguos), así la
+    sesión que se serializa en cada request no crece sin límite.
+    """
+    clave = _clave_item(item)
+    lista[:] = [i for i in lista if _clave_item(i) != clave]
+    lista.append(item)
+    del lista[:-REPORTE_MAX_ITEMS]
+
+def aun_pendiente(f):
+    return f"⏳ {f.raw}: la consulta está tardando. Vuelve a enviarlo en unos segundos."
+
+def no_encontrado(ses, f):
+    texto = f"❌ No encontré datos para {f.raw}"
+    parecidas = sugerencias(ses.model, ses.serial3, f)
+    if parecidas:
+        texto += "<br>¿Quisiste decir " + " o ".join(f"<b>{p}</b>" for p in parecidas) + "?"
+    return texto
+
+@en_estado("menu_principal")
+def _diagnostico_libre(m):
+    """
+    Desde el menú principal se puede escribir directamente cualquier mezcla
+    de códigos y eventos: se resuelven juntos y se suman al reporte.
+    Una lista separada por comas se interpreta fragmento a fragmento; en un
+    fragmento que no es código ni evento se buscan los que aparezcan en
+    cualquier parte de su texto ("tengo 168-4 y E0117(2)").
+    """
+    ses = m.ses
+    fragmentos = fragmentos_texto_libre(m.texto)
+    if not any(f.tipo != "invalido" for f in fragmentos):
+        return Respuesta(
+            "Elige una opción válida (1–8) o escribe directamente tus códigos "
+            "y eventos. Ej: 168-4, E0117(2)"
+        )
 
-            fila = filas[0]
-            desc = fila["warning_description"] or "Sin descripción."
-            url = fila["url_main"] or ""
-            url_html = f'<a href="{url}" target="_blank">{url}</a>' if url else "—"
-
-            ses["reporte_eventos"].append({
-                "raw": raw,
-                "eid": eid,
-                "level": level,
-                "descripcion": desc,
-                "url": url
-            })
+    respuestas = []
+    for f, fila in zip(fragmentos, resolver_fragmentos(ses.model, ses.serial3, fragmentos)):
+        if f.tipo == "invalido":
+            respuestas.append(
+                f"❌ No pude interpretar {f.raw}. "
+                "Usa <b>CID-FMI</b> (ej: 168-4) o <b>E####(L)</b> (ej: E0117(2))."
+            )
+        elif fila is PENDIENTE:
+            respuestas.append(aun_pendiente(f))
+        elif fila is None:
+            respuestas.append(no_encontrado(ses, f))
+        elif f.tipo == "codigo":
+            item = item_codigo(f.raw, f.cid, f.fmi, fila)
+            agregar_al_reporte(ses.reporte_codigos, item)
+            respuestas.append(html_codigo(item))
+        else:
+            item = item_evento(f.raw, f.eid, f.level, fila)
+            agregar_al_reporte(ses.reporte_eventos, item)
+            respuestas.append(html_evento(item))
+
+    en_reporte = len(ses.reporte_codigos) + len(ses.reporte_eventos)
+    return Respuesta(
+        "<br><br>".join(respuestas)
+        + f"<br><br>📋 Llevas <b>{en_reporte}</b> códigos/eventos en el reporte.<br>"
+        + "Escribe más códigos/eventos o elige una opción:<br>"
+        + OPCIONES_MENU_PRINCIPAL
+    )
 
+# ================= CÓDIGOS =================
+@en_estado("pidiendo_codigos")
+def _codigos(m):
+    ses = m.ses
+    respuestas = []
+
+    # Primero se interpretan todos; luego se resuelven los válidos por lote
+    items = tokenizar(m.texto)
+    validos = [f for f in items if f.tipo == "codigo"]
+    resultados = iter(resolver_fragmentos(ses.model, ses.serial3, validos))
+
+    for f in items:
+        raw = f.raw
+
+        if f.tipo == "evento":
+            respuestas.append(f"❌ {raw} es un evento; elige 2️⃣ Eventos para consultarlo.")
+            continue
+
+        if f.tipo != "codigo":
+            respuestas.append(f"❌ No pude interpretar {raw}")
+            continue
+
+        fila = next(resultados)
+        if fila is PENDIENTE:
+            respuestas.append(aun_pendiente(f))
+            continue
+        if fila is None:
+            respuestas.append(no_encontrado(ses, f))
+            continue
+
+        item = item_codigo(raw, f.cid, f.fmi, fila)
+        agregar_al_reporte(ses.reporte_codigos, item)
+        respuestas.append(html_codigo(item))
+
+    ses.estado = "menu_principal"
+    return Respuesta("<br><br>".join(respuestas) + MENU_TRAS_CODIGOS)
+
+# ================= EVENTOS =================
+@en_estado("pidiendo_eventos")
+def _eventos(m):
+    ses = m.ses
+    respuestas = []
+
+    # Primero se validan todos; luego se resuelven los válidos por lote
+    items = tokenizar(m.texto)
+    validos = [f for f in items if f.tipo == "evento"]
+    resultados = iter(resolver_fragmentos(ses.model, ses.serial3, validos))
+
+    for f in items:
+        raw = f.raw
+
+        if f.tipo == "codigo":
+            respuestas.append(f"❌ {raw} es un código; elige 1️⃣ Códigos para consultarlo.")
+            continue
+
+        # Validación estricta del formato único
+        if f.tipo != "evento":
             respuestas.append(
-                f"📘 <b>Evento:</b> {raw}<br><br>"
-                f"<b>Descripción:</b> {desc}<br><br>"
-                f"<b>Más información:</b> {url_html}"
+                f"❌ Formato inválido para {raw}. "
+                f"Usa el formato <b>E####(L)</b> con L = 1, 2 o 3. Ej: E0117(2)"
             )
+            continue
 
-        ses["estado"] = "menu_principal"
+        fila = next(resultados)
+        if fila is PENDIENTE:
+            respuestas.append(aun_pendiente(f))
+            continue
+        if fila is None:
+            respuestas.append(no_encontrado(ses, f))
+            continue
 
-        return responder(
-            "<br><br>".join(respuestas) +
-            "<br><br>¿Qué deseas hacer?<br>"
-            "1️⃣ Códigos<br>"
-            "2️⃣ Más eventos<br>"
-            "3️⃣ Mantenimiento<br>"
-            "7️⃣ Generar PDF<br>"
-            "6️⃣ Finalizar"
-        )
+        item = item_evento(raw, f.eid, f.level, fila)
+        agregar_al_reporte(ses.reporte_eventos, item)
+        respuestas.append(html_evento(item))
 
-    return responder("No entendí 😅<br>Escribe <b>hola</b> para reiniciar.")
+    ses.estado = "menu_principal"
+    return Respuesta("<br><br>".join(respuestas) + MENU_TRAS_EVENTOS)
+
+# ============================================================
+#  CHATBOT PRINCIPAL
+# ============================================================
+def mensaje_enviado():
+    """
+    Texto de un body {"mensaje": "..."} de /enviar (WSGI y ASGI), o None si
+    el body no es un objeto JSON con un texto en "mensaje".
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("mensaje", ""), str):
+        return None
+    return data.get("mensaje", "").strip()
+
+ERROR_MENSAJE = {"error": 'Envía un objeto JSON: {"mensaje": "..."}.'}
+
+@app.route("/enviar", methods=["POST"])
+def enviar():
+    mensaje = mensaje_enviado()
+    if mensaje is None:
+        return jsonify(ERROR_MENSAJE), 400
+    user_id = id_sesion_cliente()
+
+    with bloqueo_sesion(user_id):
+        respuesta = procesar_mensaje(user_id, mensaje)
+        guardar_sesiones_abiertas()
+    return respuesta
+
+def procesar_mensaje(user_id, mensaje):
+    r = despachar(Mensaje(user_id, mensaje, obtener_sesion(user_id)))
+    payload = {"respuesta": f"<div style='max-width:100%; word-wrap:break-word;'>{r.texto}</div>"}
+    if r.extra:
+        payload.update(r.extra)
+    return jsonify(payload)
+
+# ============================================================
+#  REPRODUCCIÓN DE CONVERSACIONES (arnés de pruebas)
+# ============================================================
+def reproducir_conversacion(pasos, cliente=None):
+    """
+    Reproduce una conversación contra /enviar con su propia sesión.
+    Cada paso: {"mensaje": "...", "contiene": ["..."], "estado": "..."}.
+    Devuelve la lista de fallos (vacía si todo coincide).
+    """
+    cliente = cliente or app.test_client()
+    sid = secrets.token_urlsafe(24)
+    fallos = []
+    for n, paso in enumerate(pasos, start=1):
+        resp = cliente.post(
+            "/enviar", json={"mensaje": paso["mensaje"]}, headers={SESION_HEADER: sid}
+        )
+        texto = (resp.get_json() or {}).get("respuesta", "")
+        for esperado in paso.get("contiene", []):
+            if esperado not in texto:
+                fallos.append(f"paso {n} ({paso['mensaje']!r}): falta {esperado!r}")
+        if "estado" in paso:
+            ses = sesiones.cargar(sid)
+            estado = ses.estado if ses else None
+            if estado != paso["estado"]:
+                fallos.append(
+                    f"paso {n} ({paso['mensaje']!r}): estado {estado!r}, se esperaba {paso['estado']!r}"
+                )
+    return fallos
+
+@app.cli.command("reproducir")
+@click.argument("archivos", nargs=-1, type=click.Path(exists=True))
+def reproducir_cmd(archivos):
+    """Reproduce conversaciones guardadas (JSON) y reporta diferencias."""
+    total = 0
+    for ruta in archivos:
+        with open(ruta, encoding="utf-8") as f:
+            fallos = reproducir_conversacion(json.load(f))
+        total += len(fallos)
+        print(f"{'OK  ' if not fallos else 'FALLA'} {ruta}")
+        for fallo in fallos:
+            print(f"      {fallo}")
+    sys.exit(1 if total else 0)
 
 # ============================================================
 # MAIN
 # ============================================================
 if __name__ == "__main__":
+    verificar_esquema()
     app.run(host="0.0.0.0", port=5000)
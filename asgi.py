@@ -0,0 +1,252 @@
+# ============================================================
+#  SERVIDOR ASGI (opcional)
+# ============================================================
+# Mismo bot, pero /enviar atiende de forma asíncrona: las búsquedas a
+# Postgres se hacen con asyncpg (sin bloquear el proceso) y recién
+# después corre el motor de diálogo de app.py, que encuentra todo en la
+# caché. El motor corre en un hilo (asyncio.to_thread): si igual tiene que
+# ir a Postgres (una entrada que venció entre la precarga y el motor, el
+# reporte PDF de la opción 7...) bloquea ese hilo y no el event loop.
+# El resto de rutas (PDF, admin, flota...) pasa intacto a la app Flask
+# por WSGI (a2wsgi), en su propio pool de hilos.
+#
+#   SECRET_KEY=... WEB_CONCURRENCY=2 uvicorn asgi:app
+#
+# (WEB_CONCURRENCY es lo que uvicorn usa para --workers; con más de uno
+# el arranque exige SECRET_KEY, igual que gunicorn.conf.py.)
+#
+# La ruta WSGI de siempre (gunicorn app:app) sigue igual.
+import asyncio
+import json
+import os
+import weakref
+
+import asyncpg
+from a2wsgi import WSGIMiddleware
+
+import app as bot
+from app import app as flask_app, request
+
+ASYNC_DB_POOL_MIN = int(os.environ.get("ASYNC_DB_POOL_MIN", "2"))
+ASYNC_DB_POOL_MAX = int(os.environ.get("ASYNC_DB_POOL_MAX", "20"))
+ASYNC_DB_TIMEOUT = float(os.environ.get("ASYNC_DB_TIMEOUT", "10"))
+ENVIAR_MAX_BYTES = 64 * 1024
+
+# Estados cuyo mensaje puede traer códigos o eventos a resolver
+ESTADOS_CON_BUSQUEDA = ("menu_principal", "pidiendo_codigos", "pidiendo_eventos")
+CACHES = {"codigos": bot.cache_codigos, "eventos": bot.cache_eventos}
+
+db = None           # asyncpg.Pool (se crea en el lifespan)
+_tipos = {}         # tabla -> {columna: conversor} para los parámetros
+_bloqueos = weakref.WeakValueDictionary()
+
+
+# ---------- Postgres asíncrono ----------
+async def abrir_db():
+    global db
+    url = os.environ.get("DATABASE_URL")
+    if not url or db is not None:
+        return
+    db = await asyncpg.create_pool(
+        url.replace("postgres://", "postgresql://", 1),
+        min_size=ASYNC_DB_POOL_MIN,
+        max_size=ASYNC_DB_POOL_MAX,
+        command_timeout=ASYNC_DB_TIMEOUT,
+    )
+    # asyncpg no convierte "168" a int como pg8000: se miran los tipos una vez
+    for tabla, campos, _ in bot.CatalogoSnapshot.TABLAS.values():
+        filas = await db.fetch(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_name = $1",
+            tabla,
+        )
+        _tipos[tabla] = {
+            f["column_name"]: int if f["data_type"] in ("integer", "bigint", "smallint") else str
+            for f in filas
+        }
+    if not bot.maquinas.listo and not bot.catalogo.listo:
+        bot.maquinas.publicar([dict(f) for f in await db.fetch(bot.maquinas.SQL)])
+
+
+async def cerrar_db():
+    global db
+    if db is not None:
+        await db.close()
+        db = None
+
+
+def _parametros(tabla, campos, clave):
+    """Convierte una clave (model, serial3, a, b) a los tipos de la tabla."""
+    tipos = _tipos.get(tabla, {})
+    return [
+        tipos.get(col, str)(valor)
+        for col, valor in zip(("model", "serial3") + campos, clave)
+    ]
+
+
+async def _precargar_lote(nombre, claves):
+    """Trae de Postgres las claves que faltan en la caché y las cachea."""
+    tabla, campos, columnas = bot.CatalogoSnapshot.TABLAS[nombre]
+    cache = CACHES[nombre]
+    pendientes = list(dict.fromkeys(bot.pendientes_en_cache(cache, claves)))
+
+    params, validas = [], []
+    for clave in pendientes:
+        try:
+            params.extend(_parametros(tabla, campos, clave))
+            validas.append(clave)
+        except ValueError:
+            pass   # p. ej. "ABC" contra una columna entera: no puede existir
+    encontrados = {}
+    if validas:
+        sql = bot.sql_lote(", ".join(columnas), tabla, campos, len(validas), marcador="$")
+        with bot.METRICA_FASE.medir("precarga_" + nombre):
+            filas = [dict(f) for f in await db.fetch(sql, *params)]
+        encontrados = bot.agrupar_lote(filas, campos)
+    bot.cachear_lote(cache, pendientes, encontrados)
+
+    # Lo que no existe va a pedir sugerencias: se deja listo el índice de
+    # cada máquina que tenga alguna clave sin resultado
+    sin_resultado = {
+        c[:2] for c in pendientes if not encontrados.get(tuple(map(bot._norm, c)))
+    }
+    for model, serial3 in sin_resultado:
+        if bot.indices_sugerencias.obtener((nombre, bot._norm(model), bot._norm(serial3))) is None:
+            filas = await db.fetch(bot.sql_claves_maquina(nombre, marcador="$"), model, serial3)
+            bot.guardar_indice(nombre, model, serial3, [dict(f) for f in filas])
+
+
+async def precargar_busquedas(ses, mensaje):
+    """
+    Resuelve por adelantado (y en paralelo) los códigos y eventos que el
+    motor de diálogo va a buscar para este mensaje.
+    """
+    # maquinas.existe() sólo se consulta si ya está cargado: si no, lo
+    # cargaría con pg8000 dentro del event loop
+    if (db is None or bot.catalogo.listo or ses.estado not in ESTADOS_CON_BUSQUEDA
+            or not ses.model
+            or (bot.maquinas.listo and not bot.maquinas.existe(ses.model, ses.serial3))):
+        return
+    maquina = (ses.model, ses.serial3)
+    por_tabla = {"codigos": [], "eventos": []}
+    if ses.estado == "menu_principal":
+        fragmentos = bot.fragmentos_texto_libre(mensaje)   # como _diagnostico_libre
+    else:
+        fragmentos = bot.tokenizar(mensaje)
+    for f in fragmentos:
+        if f.tipo == "codigo":
+            por_tabla["codigos"].append(maquina + (f.cid, f.fmi))
+        elif f.tipo == "evento":
+            por_tabla["eventos"].append(maquina + (f.eid, f.level))
+    await asyncio.gather(*(
+        _precargar_lote(nombre, claves) for nombre, claves in por_tabla.items() if claves
+    ))
+
+
+# ---------- /enviar asíncrono ----------
+def _procesar_y_guardar(user_id, mensaje):
+    respuesta = bot.procesar_mensaje(user_id, mensaje)
+    bot.guardar_sesiones_abiertas()
+    return respuesta
+
+
+def _bloqueo(user_id):
+    lock = _bloqueos.get(user_id)
+    if lock is None:
+        lock = _bloqueos.setdefault(user_id, asyncio.Lock())
+    return lock
+
+
+async def _leer_cuerpo(receive):
+    partes, total = [], 0
+    while True:
+        evento = await receive()
+        cuerpo = evento.get("body", b"")
+        total += len(cuerpo)
+        if total > ENVIAR_MAX_BYTES:
+            return None
+        partes.append(cuerpo)
+        if not evento.get("more_body"):
+            return b"".join(partes)
+
+
+async def _responder(send, status, headers, cuerpo):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": cuerpo})
+
+
+async def enviar(scope, receive, send):
+    cuerpo = await _leer_cuerpo(receive)
+    if cuerpo is None:
+        await _responder(send, 413, [(b"content-type", b"application/json")],
+                         json.dumps({"error": "Mensaje demasiado grande."}).encode())
+        return
+
+    headers = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]]
+    cliente = (scope.get("client") or ("127.0.0.1", 0))[0]
+    host = dict((k.lower(), v) for k, v in headers).get("host") or "%s:%s" % scope["server"]
+
+    # El motor de diálogo usa request/g de Flask: se arma un contexto con
+    # el mismo request y se corren los mismos hooks que en la ruta WSGI.
+    # El esquema y root_path vienen del scope para que request.is_secure
+    # (cookie Secure) sea el mismo que detrás del WSGI.
+    with flask_app.test_request_context(
+        "/enviar", method="POST", headers=headers, data=cuerpo,
+        base_url=f'{scope["scheme"]}://{host}{scope.get("root_path", "")}',
+        environ_base={"REMOTE_ADDR": cliente},
+    ):
+        respuesta = flask_app.preprocess_request()
+        mensaje = bot.mensaje_enviado() if respuesta is None else None
+        if respuesta is None and mensaje is None:
+            respuesta = (bot.jsonify(bot.ERROR_MENSAJE), 400)
+        if respuesta is None:
+            user_id = bot.id_sesion_cliente()
+
+            async with _bloqueo(user_id):
+                # El backend de sesiones puede ser Postgres: fuera del event loop
+                ses = await asyncio.to_thread(bot.obtener_sesion, user_id)
+                await precargar_busquedas(ses, mensaje)
+                # to_thread copia el contexto: request y g de Flask siguen visibles
+                respuesta = await asyncio.to_thread(_procesar_y_guardar, user_id, mensaje)
+
+        respuesta = flask_app.process_response(flask_app.make_response(respuesta))
+        await _responder(
+            send,
+            respuesta.status_code,
+            [(k.encode("latin-1"), v.encode("latin-1")) for k, v in respuesta.headers.items()],
+            respuesta.get_data(),
+        )
+
+
+# ---------- Aplicación ASGI ----------
+wsgi = WSGIMiddleware(flask_app)
+
+
+async def _lifespan(receive, send):
+    while True:
+        evento = await receive()
+        if evento["type"] == "lifespan.startup":
+            try:
+                # Lo que en gunicorn hacen on_starting y post_fork: esquema,
+                # motor PDF y pool de reportes
+                bot.exigir_secret_key(int(os.environ.get("WEB_CONCURRENCY", "1")))
+                await asyncio.to_thread(bot.verificar_esquema)
+                await asyncio.to_thread(bot.precalentar_reportes)
+                await abrir_db()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif evento["type"] == "lifespan.shutdown":
+            await cerrar_db()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/enviar" and scope["method"] == "POST":
+        await enviar(scope, receive, send)
+    else:
+        await wsgi(scope, receive, send)
@@ -0,0 +1,103 @@
+"""
+Prueba de carga de /enviar: N conversaciones simultáneas, cada una con su
+propia sesión, contra un servidor ya levantado.
+
+Para comparar ambos caminos contra la misma base de datos:
+  export SECRET_KEY=...                               # obligatorio con 2 workers
+  gunicorn app:app -w 2 -b :8000                     # WSGI, workers sync
+  WEB_CONCURRENCY=2 uvicorn asgi:app --port 8001     # ASGI, /enviar con asyncpg
+
+  python bench/bench_carga.py http://localhost:8000 [opciones]
+  python bench/bench_carga.py http://localhost:8001 [opciones]
+
+Con workers sync cada conversación en espera de Postgres ocupa un worker,
+así que la concurrencia efectiva es la cantidad de workers; en ASGI un
+mismo proceso atiende cientos de conversaciones mientras espera la red.
+
+Opciones:
+  --concurrencia N      conversaciones en paralelo (200)
+  --rondas N            veces que cada conversación se repite (3)
+  --modelo / --serie    máquina para la conversación por defecto
+  --codigos TEXTO       mensaje de diagnóstico ("168-4, 110-3, E0117(2)")
+  --conversacion RUTA   usa los mensajes de un JSON de conversaciones/
+"""
+import argparse
+import http.client
+import json
+import secrets
+import statistics
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _mensajes(args):
+    if args.conversacion:
+        with open(args.conversacion, encoding="utf-8") as f:
+            return [paso["mensaje"] for paso in json.load(f)]
+    return ["hola", "1", args.modelo, args.serie, args.codigos]
+
+
+def _conversacion(url, mensajes, rondas, tiempos, errores, lock):
+    destino = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(destino.hostname, destino.port or 80, timeout=60)
+    sid = secrets.token_urlsafe(24)
+    try:
+        for _ in range(rondas):
+            for mensaje in mensajes:
+                t0 = time.perf_counter()
+                try:
+                    conn.request(
+                        "POST", "/enviar", body=json.dumps({"mensaje": mensaje}),
+                        headers={"Content-Type": "application/json", "X-Session-Id": sid},
+                    )
+                    resp = conn.getresponse()
+                    resp.read()
+                    ok = resp.status == 200
+                except (OSError, http.client.HTTPException):
+                    ok = False
+                    conn.close()
+                dt = time.perf_counter() - t0
+                with lock:
+                    (tiempos if ok else errores).append(dt)
+    finally:
+        conn.close()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Prueba de carga de /enviar")
+    p.add_argument("url")
+    p.add_argument("--concurrencia", type=int, default=200)
+    p.add_argument("--rondas", type=int, default=3)
+    p.add_argument("--modelo", default="950H")
+    p.add_argument("--serie", default="A8J")
+    p.add_argument("--codigos", default="168-4, 110-3, E0117(2)")
+    p.add_argument("--conversacion")
+    args = p.parse_args()
+
+    mensajes = _mensajes(args)
+    tiempos, errores, lock = [], [], threading.Lock()
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+        for _ in range(args.concurrencia):
+            pool.submit(_conversacion, args.url, mensajes, args.rondas, tiempos, errores, lock)
+    total = time.perf_counter() - t0
+
+    if not tiempos:
+        print(f"sin respuestas correctas ({len(errores)} errores)")
+        return
+    tiempos.sort()
+    print(
+        f"{args.url}  concurrencia {args.concurrencia}  "
+        f"{len(tiempos)} ok / {len(errores)} errores en {total:.1f} s\n"
+        f"  {len(tiempos) / total:8.1f} mensajes/s | "
+        f"mediana {statistics.median(tiempos) * 1000:7.1f} ms | "
+        f"p95 {tiempos[int(len(tiempos) * 0.95) - 1] * 1000:7.1f} ms | "
+        f"máx {tiempos[-1] * 1000:7.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Benchmark y fuzz del parser de códigos/eventos.
+
+  - corpus:  bench/corpus_parser.jsonl (entrada -> fragmentos esperados)
+  - fuzz:    textos aleatorios; tokenizar() nunca falla y devuelve un
+             fragmento por cada elemento no vacío separado por comas
+  - tiempos: antes (split + ambos extraer_* por fragmento, lo necesario para
+             aceptar códigos y eventos mezclados) vs tokenizar()
+
+Uso:  python bench/bench_parser.py [repeticiones] [casos_fuzz]
+"""
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.pop("DATABASE_URL", None)
+
+import app as A  # noqa: E402
+
+MENSAJES = [
+    "168-4",
+    "168-4, 110-3, 100-1, 91-8, 41-3",
+    "E0117(2), E0360(1), E2143(3)",
+    "168-4, E0117(2), MID 27 CID 168 FMI 4, e0360 (1), 4651-9",
+    "no sé qué código es, 168 4",
+]
+ALFABETO = "0123456789 ,.-/():=EeMIDCFmidcfx\t"
+
+
+# ---------- Implementación anterior (para comparar) ----------
+def _codigo_antes(texto):
+    t = texto.upper().replace("-", " ").replace(".", " ")
+    nums = re.findall(r"\d+", t)
+    if len(nums) >= 3:
+        return nums[-3], nums[-2], nums[-1]
+    if len(nums) == 2:
+        return None, nums[0], nums[1]
+    return None, None, None
+
+
+def _evento_antes(texto):
+    m = re.fullmatch(r"E(\d+)\(([123])\)", texto.strip().upper())
+    return (f"E{m.group(1)}", m.group(2)) if m else (None, None)
+
+
+def antes(mensaje):
+    salida = []
+    for raw in mensaje.split(","):
+        raw = raw.strip()
+        salida.append((raw, _codigo_antes(raw), _evento_antes(raw)))
+    return salida
+
+
+# ---------- Verificaciones ----------
+def _resumen(f):
+    if f.tipo == "codigo":
+        return ["codigo", f.mid, f.cid, f.fmi]
+    if f.tipo == "evento":
+        return ["evento", f.eid, f.level]
+    return ["invalido"]
+
+
+def verificar_corpus():
+    fallos = 0
+    with open(os.path.join(RAIZ, "bench", "corpus_parser.jsonl"), encoding="utf-8") as f:
+        casos = [json.loads(linea) for linea in f if linea.strip()]
+    for caso in casos:
+        obtenido = [_resumen(fr) for fr in A.tokenizar(caso["entrada"])]
+        if obtenido != caso["esperado"]:
+            fallos += 1
+            print(f"  FALLA {caso['entrada']!r}: {obtenido} != {caso['esperado']}")
+    print(f"corpus   {len(casos) - fallos}/{len(casos)} casos OK")
+    return fallos
+
+
+def fuzz(casos, semilla=1234):
+    rnd = random.Random(semilla)
+    fallos = 0
+    for _ in range(casos):
+        texto = "".join(rnd.choice(ALFABETO) for _ in range(rnd.randint(0, 40)))
+        fragmentos = A.tokenizar(texto)
+        esperados = [x.strip() for x in texto.split(",") if x.strip()]
+        if [fr.raw for fr in fragmentos] != esperados:
+            fallos += 1
+            print(f"  FALLA {texto!r}")
+    print(f"fuzz     {casos - fallos}/{casos} textos OK")
+    return fallos
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        for mensaje in MENSAJES:
+            funcion(mensaje)
+        tiempos.append(time.perf_counter() - t0)
+    return tiempos
+
+
+def main():
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    casos_fuzz = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    fallos = verificar_corpus() + fuzz(casos_fuzz)
+
+    for nombre, funcion in (("antes", antes), ("despues", A.tokenizar)):
+        tiempos = medir(funcion, repeticiones)
+        print(
+            f"{nombre:8s} mediana {statistics.median(tiempos) * 1e6 / len(MENSAJES):6.2f} µs/mensaje | "
+            f"p95 {sorted(tiempos)[int(len(tiempos) * 0.95) - 1] * 1e6 / len(MENSAJES):6.2f} µs/mensaje"
+        )
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == "__main__":
+    main()
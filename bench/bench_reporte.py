@@ -0,0 +1,77 @@
+"""
+Benchmark del render de reportes PDF (xhtml2pdf).
+
+Compara, en procesos nuevos para medir también el arranque en frío:
+  - antes:   pisa.CreatePDF con el pisaContext original
+  - después: motor precompilado de app.py (CSS parseado una vez + warm-up)
+
+Uso:  python bench/bench_reporte.py [repeticiones]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CODIGOS = [
+    {"raw": f"{cid}-{fmi}", "cid": str(cid), "fmi": str(fmi),
+     "descripcion": "Presión de aceite del motor baja", "causas": "Sensor dañado; nivel bajo",
+     "url": "https://sis2.cat.com/#/detail?keyword=" + "x" * 80}
+    for cid, fmi in [(168, 4), (110, 3), (100, 1), (91, 8), (41, 3)]
+]
+EVENTOS = [
+    {"raw": f"E{eid}(2)", "eid": f"E{eid}", "level": "2",
+     "descripcion": "Alta temperatura del refrigerante", "url": ""}
+    for eid in ("0117", "0360", "2143")
+]
+
+
+def _medir(modo, repeticiones):
+    sys.path.insert(0, RAIZ)
+    import app as A
+    from xhtml2pdf.context import pisaContext
+
+    if modo == "antes":
+        A.pisa_document.pisaContext = pisaContext
+
+    with A.app.app_context():
+        html = A.html_reporte("950H", "ABC", CODIGOS, EVENTOS, "2026-01-01 10:00")
+
+    t0 = time.perf_counter()
+    if modo == "despues":
+        A.precalentar_motor_pdf(html)   # lo que hace post_fork al arrancar
+    arranque = time.perf_counter() - t0
+
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        A.generar_pdf(html)
+        tiempos.append(time.perf_counter() - t0)
+    return arranque, tiempos
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--hijo":
+        arranque, tiempos = _medir(sys.argv[2], int(sys.argv[3]))
+        print(arranque, *tiempos)
+        return
+
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for modo in ("antes", "despues"):
+        salida = subprocess.run(
+            [sys.executable, __file__, "--hijo", modo, str(repeticiones)],
+            capture_output=True, text=True, check=True, cwd=RAIZ
+        ).stdout.split()
+        arranque, *tiempos = map(float, salida)
+        print(
+            f"{modo:8s} warm-up {arranque * 1000:7.1f} ms | "
+            f"1er reporte {tiempos[0] * 1000:7.1f} ms | "
+            f"mediana {statistics.median(tiempos) * 1000:7.1f} ms | "
+            f"p95 {sorted(tiempos)[int(len(tiempos) * 0.95) - 1] * 1000:7.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+# ============================================================
+#  CONFIGURACIÓN DE GUNICORN
+# ============================================================
+# gunicorn carga este archivo solo si se ejecuta desde la raíz del repo
+# (gunicorn app:app).
+
+def on_starting(server):
+    # Una sola vez, en el maestro: sin SECRET_KEY (con varios workers) o sin
+    # la migración de serial3 no se arranca
+    from app import exigir_secret_key, verificar_esquema
+    exigir_secret_key(server.cfg.workers)
+    verificar_esquema()
+
+
+def post_fork(server, worker):
+    # Cada worker calienta el motor PDF (CSS precompilado, fuentes) antes
+    # de atender requests; el pool de reportes se crea después y hereda
+    # el motor ya caliente.
+    from app import precalentar_reportes
+    precalentar_reportes()
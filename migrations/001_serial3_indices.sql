@@ -0,0 +1,18 @@
+-- ============================================================
+--  001: columna serial3 almacenada + índices compuestos
+-- ============================================================
+-- LEFT(serial, 3) en el WHERE impide usar cualquier índice sobre serial.
+-- Guardamos el prefijo como columna generada y lo indexamos junto con
+-- el resto de la clave de búsqueda (requiere PostgreSQL 12+).
+
+ALTER TABLE codigos_falla
+    ADD COLUMN IF NOT EXISTS serial3 text GENERATED ALWAYS AS (LEFT(serial, 3)) STORED;
+
+ALTER TABLE eventos
+    ADD COLUMN IF NOT EXISTS serial3 text GENERATED ALWAYS AS (LEFT(serial, 3)) STORED;
+
+CREATE INDEX IF NOT EXISTS ix_codigos_falla_busqueda
+    ON codigos_falla (model, serial3, cid, fmi);
+
+CREATE INDEX IF NOT EXISTS ix_eventos_busqueda
+    ON eventos (model, serial3, eid, level);
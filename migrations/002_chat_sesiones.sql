@@ -0,0 +1,9 @@
+-- ============================================================
+--  002: sesiones del chat compartidas (SESIONES_BACKEND=postgres)
+-- ============================================================
+
+CREATE TABLE IF NOT EXISTS chat_sesiones (
+    id             text PRIMARY KEY,
+    datos          text NOT NULL,
+    actualizado_en timestamptz NOT NULL DEFAULT now()
+);
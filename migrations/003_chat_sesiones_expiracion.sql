@@ -0,0 +1,6 @@
+-- ============================================================
+--  003: índice para la purga de sesiones inactivas
+-- ============================================================
+
+CREATE INDEX IF NOT EXISTS ix_chat_sesiones_actualizado
+    ON chat_sesiones (actualizado_en);